@@ -1,34 +1,2355 @@
+from __future__ import annotations
+
 import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import functools
+import hashlib
+import heapq
+import hmac
+import inspect
+import json
+import logging.handlers
 import os
-from http.client import responses
-from keyword import kwlist
-
-from telegram import (
-    Update,
-    BotCommand,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    ReplyKeyboardMarkup,
-    ReplyKeyboardRemove,
-    KeyboardButton
-)
-
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-    CallbackQueryHandler
-)
+import queue
+import random
+import re
+import sys
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
 
 from typing import (
+    TYPE_CHECKING,
     Callable,
     Optional,
     Union,
     List,
 )
 
+# telegram takes most of the import time, it is imported where it is needed (registering handlers doesn't need it)
+if TYPE_CHECKING:
+    from telegram import BotCommandScope, Update
+    from telegram.ext import Application, ContextTypes
+
+
+class _RequestContext:
+    """State of the update that is handled in the current task"""
+
+    __slots__ = ("update", "context", "chat_id", "user", "user_text", "outbox", "loop", "handler", "failed")
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, coalesce: bool = False,
+                 handler: str = "update"):
+        self.update = update
+        self.context = context
+        self.user = update.effective_user
+        self.chat_id = update.effective_chat.id if update.effective_chat else None
+        self.user_text = None
+        self.outbox = [] if coalesce else None  # messages of the handler, flushed at the end
+        self.loop = None  # event loop of the update, set when a handler runs in a worker thread
+        self.handler = handler  # name of the handler in the metrics
+        self.failed = False  # the handler failed (also when the error was caught and answered)
+
+
+# every update is handled in its own task, so the request is task-local
+_current_request = contextvars.ContextVar("Library_Fast_Bot_request", default=None)
+
+# logging: the records of the library go through a queue to a writer thread, so a slow stdout never stalls the loop
+_log = logging.getLogger("Library_Fast_Bot")
+_log_listener = None
+
+
+class _RequestFields(logging.Filter):
+    """chat_id, user_id and handler of the update that is handled in the current task"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request = _current_request.get()
+        if request is None:
+            record.chat_id = record.user_id = record.handler = None
+        else:
+            record.chat_id = request.chat_id
+            record.user_id = request.user.id if request.user else None
+            record.handler = request.handler
+        return True
+
+
+def _plain_value(value):
+    """The value itself if it is a plain one, otherwise its type (hashable and cheap, nothing is formatted)"""
+    if isinstance(value, tuple):
+        return tuple(_plain_value(item) for item in value)
+    return value if isinstance(value, (str, int, float, type(None))) else type(value)
+
+
+class _RepeatFilter(logging.Filter):
+    """The same warning or error is written at most once per `interval` seconds, with the number of repeats"""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self._seen = {}  # (level, format, arguments) -> [time it was written, repeats since then]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.repeated = 0
+        if record.levelno < logging.WARNING or not self.interval:
+            return True
+        # the message is not formatted here (that is the job of the writer thread): the key is the format string
+        # with its plain arguments, other objects (exceptions ...) count by their type
+        args = record.args
+        if isinstance(args, dict):
+            args = tuple(args.items())
+        key = (record.levelno, _plain_value(record.msg), _plain_value(args))
+        seen = self._seen.get(key)
+        if seen is not None and record.created - seen[0] < self.interval:
+            seen[1] += 1
+            return False
+        if seen is None and len(self._seen) >= 1024:
+            self._seen.clear()
+        record.repeated = seen[1] if seen else 0
+        self._seen[key] = [record.created, 0]
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Records are queued as they are, the message is formatted in the writer thread"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1  # the writer can't keep up, the loop doesn't wait for it
+
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = [f"{name} {value}" for name, value in
+                  (("chat", getattr(record, "chat_id", None)), ("user", getattr(record, "user_id", None)),
+                   ("handler", getattr(record, "handler", None))) if value is not None]
+        if fields:
+            text += f" [{', '.join(fields)}]"
+        if getattr(record, "repeated", 0):
+            text += f" (repeated {record.repeated} times)"
+        return text
+
+
+class _JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for name in ("chat_id", "user_id", "handler", "repeated"):
+            value = getattr(record, name, None)
+            if value:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _start_logging(level: Union[int, str], log_format: Optional[str], log_file: Optional[str],
+                   repeat_interval: float, queue_size: int = 10_000):
+    """QueueHandler on the library logger and the writer thread (once per process)"""
+    global _log_listener
+    _log.setLevel(level)
+    if _log_listener is not None or log_format is None:
+        return  # log_format=None: the records go to the logging of the application
+    if log_format not in ("text", "json"):
+        raise ValueError(f"Error log_format: unknown format {log_format!r}, use text, json or None")
+
+    writer = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stderr)
+    writer.setFormatter(_JsonFormatter() if log_format == "json" else _TextFormatter())
+    handler = _QueueHandler(queue.Queue(queue_size))
+    handler.addFilter(_RequestFields())
+    handler.addFilter(_RepeatFilter(repeat_interval))
+    _log.addHandler(handler)
+    _log.propagate = False
+
+    _log_listener = logging.handlers.QueueListener(handler.queue, writer)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)  # the records that are still queued are written before exit
+
+
+# start message placeholders: {name} -> function(request) -> str
+
+
+def _user_field(name: str) -> Callable:
+    def field(request: _RequestContext) -> str:
+        value = getattr(request.user, name, None) if request.user is not None else None
+        return "" if value is None else str(value)
+
+    return field
+
+
+_TEMPLATE_FIELDS = {
+    "username": _user_field("username"),
+    "first_name": _user_field("first_name"),
+    "full_name": _user_field("full_name"),
+    "user_id": _user_field("id"),
+    "language": _user_field("language_code"),
+    "chat_id": lambda request: "" if request.chat_id is None else str(request.chat_id),
+}
+
+
+class _Template:
+    """Text with placeholders, parsed once into literal and placeholder segments and rendered per request"""
+
+    __slots__ = ("source", "segments", "text")
+
+    # the old get_* words and {name}
+    _PLACEHOLDER = re.compile(r"get_user_fullname|get_user_name|get_username|\{(\w+)\}")
+    _ALIASES = {"get_username": "username", "get_user_name": "first_name", "get_user_fullname": "full_name"}
+
+    def __init__(self, source: str, fields: dict):
+        self.source = source
+        segments = []
+        position = 0
+        for match in self._PLACEHOLDER.finditer(source):
+            field = fields.get(match.group(1) or self._ALIASES[match.group(0)])
+            if field is None:
+                continue  # unknown {name} stays as it is
+            if match.start() > position:
+                segments.append(source[position:match.start()])
+            segments.append(field)
+            position = match.end()
+        if position < len(source):
+            segments.append(source[position:])
+
+        self.segments = tuple(segments)
+        self.text = source if all(isinstance(segment, str) for segment in segments) else None  # no placeholders
+
+    def render(self, request: _RequestContext) -> str:
+        if self.text is not None:
+            return self.text
+        return "".join([segment if segment.__class__ is str else segment(request) for segment in self.segments])
+
+
+# where plain def handlers run: on the event loop, in a thread pool (I/O) or in a process pool (CPU)
+_EXECUTORS = ("loop", "thread", "process")
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """The event loop of this thread, None in worker threads and processes"""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _call_mode(func: Callable, args: tuple, kwargs: dict, modes: tuple) -> Optional[str]:
+    """The first of the call modes the signature of func accepts (see TelegramBot._bind_handler)"""
+    try:
+        signature = inspect.signature(func)
+    except (TypeError, ValueError):
+        return modes[0]  # no signature (some builtins), call it the preferred way
+
+    for mode in modes:
+        try:
+            if mode == "full":
+                signature.bind(None, None, *args, **kwargs)
+            elif mode == "args":
+                signature.bind(*args, **kwargs)
+            else:
+                signature.bind()
+        except TypeError:
+            continue
+        return mode
+    return None
+
+
+async def _in_request(request: _RequestContext, coro):
+    """Runs a coroutine started by a worker thread handler on the event loop, in the request of the handler"""
+    _current_request.set(request)
+    return await coro
+
+
+def _on_loop(method: Callable) -> Callable:
+    """
+    Decorator: a method that changes the state of the event loop (sessions, inline menus).
+    Called by a handler in a worker thread, it runs on the event loop and the thread waits for its result.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        request = _current_request.get()
+        if request is None or request.loop is None or _running_loop() is not None:
+            return method(*args, **kwargs)
+
+        result = concurrent.futures.Future()
+
+        def call():
+            try:
+                result.set_result(method(*args, **kwargs))
+            except BaseException as e:
+                result.set_exception(e)
+
+        request.loop.call_soon_threadsafe(call, context=contextvars.copy_context())
+        return result.result()
+
+    return wrapper
+
+
+def _run_in_process(func: Callable, args: tuple, kwargs: dict, update: Optional[Update], user_text: Optional[str]):
+    """
+    Runs a handler in a worker process (executor="process")
+    The messages of the handler are collected and returned, the main process sends them.
+    """
+    if update is None:
+        return func(*args, **kwargs), []
+
+    request = _RequestContext(update, None, coalesce=True)
+    request.user_text = user_text
+    token = _current_request.set(request)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        _current_request.reset(token)
+    return result, request.outbox
+
+
+def _seconds(value) -> float:
+    """RetryAfter.retry_after is int or timedelta depending on the library version"""
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+# Telegram limit for the text of one message (in UTF-16 code units)
+MAX_MESSAGE_LENGTH = 4096
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Split a text into parts that fit one message, on line boundaries where possible"""
+    if _utf16_len(text) <= limit:
+        return [text]
+
+    parts = []
+    current = []
+    current_len = 0
+    for line in text.split("\n"):
+        line_len = _utf16_len(line)
+        # a line that is longer than a message is cut into pieces
+        while line_len > limit:
+            cut = limit
+            excess = _utf16_len(line[:cut]) - limit
+            while excess > 0:
+                cut -= (excess + 1) // 2
+                excess = _utf16_len(line[:cut]) - limit
+            if current:
+                parts.append("\n".join(current))
+                current, current_len = [], 0
+            parts.append(line[:cut])
+            line = line[cut:]
+            line_len = _utf16_len(line)
+
+        if current and current_len + 1 + line_len > limit:
+            parts.append("\n".join(current))
+            current, current_len = [], 0
+        current_len += line_len + (1 if current else 0)
+        current.append(line)
+
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+class _FilesToSend:
+    """send_photo / send_document / send_media_group of a handler whose messages go to the outbox"""
+
+    __slots__ = ("kind", "files", "caption", "group")
+
+    def __init__(self, kind: str, files: list, caption: Optional[str], group: bool):
+        self.kind = kind
+        self.files = files
+        self.caption = caption
+        self.group = group
+
+
+def _coalesce_messages(messages: list, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """
+    Merge consecutive messages with the same target into as few messages as possible
+    :param messages: list of (chat_id, reply_to_message_id, text or _FilesToSend - kept as it is)
+    """
+    merged = []
+    run_target = None
+    run_texts = []
+
+    def close_run():
+        if run_texts:
+            for part in _split_message("\n".join(run_texts), limit):
+                merged.append((run_target[0], run_target[1], part))
+
+    for chat_id, reply_to, text in messages:
+        if isinstance(text, _FilesToSend):
+            close_run()
+            run_target, run_texts = None, []
+            merged.append((chat_id, reply_to, text))
+            continue
+        target = (chat_id, reply_to)
+        if target != run_target:
+            close_run()
+            run_target, run_texts = target, []
+        run_texts.append(str(text))
+    close_run()
+    return merged
+
+
+def _silence_exception(future: asyncio.Future):
+    """Nobody has to await a queued message, don't warn about lost exceptions"""
+    if not future.cancelled():
+        future.exception()
+
+
+class _TokenBucket:
+    """`rate` tokens per second, at most `capacity` tokens at once"""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until the next token (0 if there is one)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _SendQueue:
+    """
+    Outbound dispatcher
+    - messages of one chat are sent one after another, in the order they were queued
+    - different chats are sent concurrently
+    - a global token bucket and a bucket per chat keep the bot under Telegram limits
+    - RetryAfter pauses all sending, network errors are retried with backoff
+    """
+
+    def __init__(self, global_rate: Optional[float] = 30, chat_rate: Optional[float] = 1,
+                 chat_burst: int = 3, group_rate: Optional[float] = 20 / 60, group_burst: int = 3,
+                 max_retries: int = 3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+
+        self._chats = {}  # chat_id -> deque of (send, future)
+        self._buckets = {}  # chat_id -> _TokenBucket
+        self._active = set()  # chats that are ready, waiting for a token or sending
+        self._ready = deque()
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._global = None
+        self._paused_until = 0.0
+        self._last_sweep = 0.0
+        self._size = 0
+        self._task = None
+
+        # counters for introspection
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        if self.global_rate:
+            self._global = _TokenBucket(self.global_rate, self.global_rate, loop.time())
+        self._task = loop.create_task(self._run())
+        return self._task
+
+    def put(self, chat_id: int, send: Callable) -> asyncio.Future:
+        """Queue `send` (a function returning a coroutine) for the chat"""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_silence_exception)
+
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+        queue.append((send, future))
+        self._size += 1
+        self._idle.clear()
+
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._requeue(chat_id)
+        return future
+
+    def depth(self, chat_id: int = None) -> int:
+        """Messages that are waiting to be sent (for one chat or in total)"""
+        if chat_id is None:
+            return self._size
+        queue = self._chats.get(chat_id)
+        return len(queue) if queue else 0
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._size,
+            "chats": len(self._chats),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+    async def join(self):
+        """Wait until every queued message is sent"""
+        await self._idle.wait()
+
+    async def close(self):
+        """Stop sending, messages that are still queued are cancelled"""
+        tasks = list(self._in_flight)
+        if self._task:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for queue in self._chats.values():
+            for _, future in queue:
+                future.cancel()
+        self._chats.clear()
+        self._active.clear()
+        self._ready.clear()
+        self._size = 0
+        self._idle.set()
+
+    def _requeue(self, chat_id: int):
+        self._ready.append(chat_id)
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int, now: float) -> Optional[_TokenBucket]:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # negative ids are groups and channels, they have stricter limits ("@channel" - the chat limit)
+            if isinstance(chat_id, int) and chat_id < 0:
+                rate, burst = self.group_rate, self.group_burst
+            else:
+                rate, burst = self.chat_rate, self.chat_burst
+            if not rate:
+                return None
+            bucket = self._buckets[chat_id] = _TokenBucket(rate, burst, now)
+        return bucket
+
+    def _sweep(self, now: float):
+        """Forget buckets of idle chats that are full again, they hold no information"""
+        self._last_sweep = now
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._active and bucket.tokens + (now - bucket.stamp) * bucket.rate >= bucket.capacity:
+                del self._buckets[chat_id]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            now = loop.time()
+            if self._paused_until > now:
+                # flood control of Telegram, nobody sends
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            if now - self._last_sweep > 60:
+                self._sweep(now)
+
+            chat_id = self._ready.popleft()
+            try:
+                queue = self._chats[chat_id]
+                while queue and queue[0][1].cancelled():
+                    # nobody waits for it anymore (a cancelled broadcast), it is not sent
+                    queue.popleft()
+                    self._size -= 1
+                if not queue:
+                    del self._chats[chat_id]
+                    self._active.discard(chat_id)
+                    if not self._active:
+                        self._idle.set()
+                    continue
+
+                bucket = self._bucket(chat_id, now)
+                wait = bucket.delay(now) if bucket else 0.0
+                if wait:
+                    # this chat waits for its token, the other chats go on
+                    loop.call_later(wait, self._requeue, chat_id)
+                    continue
+
+                if self._global is not None:
+                    wait = self._global.delay(now)
+                    if wait:
+                        self._ready.appendleft(chat_id)
+                        await asyncio.sleep(wait)
+                        continue
+                    self._global.take()
+                if bucket:
+                    bucket.take()
+
+                send, future = queue.popleft()
+                self._size -= 1
+                task = loop.create_task(self._deliver(chat_id, send, future))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+            except Exception as e:
+                self._fail_first(chat_id, e)
+
+    def _fail_first(self, chat_id, error: Exception):
+        """The first message of the chat broke the dispatcher: it fails alone, the other messages go on"""
+        _log.error("Error queueing message to %s: %s", chat_id, error)
+        self.failed += 1
+        queue = self._chats.get(chat_id)
+        if queue:
+            _, future = queue.popleft()
+            self._size -= 1
+            if not future.done():
+                future.set_exception(error)
+        if queue:
+            self._requeue(chat_id)
+        else:
+            self._chats.pop(chat_id, None)
+            self._active.discard(chat_id)
+            if not self._active:
+                self._idle.set()
+
+    async def _deliver(self, chat_id: int, send: Callable, future: asyncio.Future):
+        from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = await send()
+                except RetryAfter as e:
+                    delay = _seconds(e.retry_after)
+                    self._paused_until = max(self._paused_until, loop.time() + delay)
+                    self.retried += 1
+                    await asyncio.sleep(delay)
+                except (BadRequest, TimedOut):
+                    # a bad request won't get better, after a timeout the message may be delivered already
+                    raise
+                except NetworkError:
+                    if attempt >= self.max_retries:
+                        raise
+                    self.retried += 1
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    attempt += 1
+                else:
+                    self.sent += 1
+                    if not future.done():
+                        future.set_result(result)
+                    return
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            # a user who blocked the bot is routine (the error is in the future for the caller)
+            _log.log(logging.DEBUG if isinstance(e, Forbidden) else logging.WARNING,
+                     "Error sending message to %s: %s", chat_id, e)
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            queue = self._chats.get(chat_id)
+            if queue:
+                self._requeue(chat_id)
+            else:
+                self._chats.pop(chat_id, None)
+                self._active.discard(chat_id)
+                if not self._active:
+                    self._idle.set()
+
+
+class _Broadcast:
+    """
+    One message to many chats
+    - recipients are read one by one (iterable or async iterable), at most `concurrency` messages are in flight
+    - the messages go through the send queue: its global limit, RetryAfter pauses and retries apply
+    - the position up to which every recipient is done is saved to `checkpoint`, a new run continues from it
+    """
+
+    def __init__(self, queue: _SendQueue, telegram_bot, message: Union[str, Callable], concurrency: int,
+                 checkpoint: Optional[str], progress: Optional[Callable], progress_interval: float):
+        self.queue = queue
+        self.telegram_bot = telegram_bot
+        self.message = message
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self._done = set()  # finished positions after self.position (saved too)
+        self._started = 0.0
+
+        self.position = 0  # every recipient before it is done
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.skipped = 0
+        self._sent_now = 0  # sent by this run (the counters above include the runs before a checkpoint)
+        self.finished = False
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self._started
+        return {
+            "position": self.position,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "skipped": self.skipped,
+            "finished": self.finished,
+            "elapsed": elapsed,
+            "per_second": self._sent_now / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _load(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint, encoding="utf-8") as file:
+            state = json.load(file)
+        self.position = state["position"]
+        self._done = set(state["done"])
+        self.sent, self.failed = state["sent"], state["failed"]
+        self.blocked, self.skipped = state["blocked"], state["skipped"]
+        self.finished = state["finished"]
+
+    def _save(self, state: dict):
+        # a few hundred bytes: written on the loop, so two writes never overlap
+        # a crash in the middle of a write leaves the old checkpoint
+        temporary = f"{self.checkpoint}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({**state, "done": sorted(self._done)}, file)
+        os.replace(temporary, self.checkpoint)
+
+    async def _report(self):
+        state = self.stats()
+        if self.checkpoint is not None:
+            self._save(state)
+        if self.progress is not None:
+            result = self.progress(state)
+            if inspect.isawaitable(result):
+                await result
+        _log.info("Broadcast: %(sent)s sent, %(failed)s failed, %(blocked)s blocked, %(per_second).1f/s", state)
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._report()
+
+    async def run(self, chat_ids) -> dict:
+        self._load()
+        self._started = time.monotonic()
+        if self.finished:
+            return self.stats()
+
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            index = 0
+            if hasattr(chat_ids, "__aiter__"):
+                async for chat_id in chat_ids:
+                    if index >= self.position and index not in self._done:
+                        await self._start(index, chat_id)
+                    index += 1
+            else:
+                for chat_id in chat_ids:
+                    if index >= self.position and index not in self._done:
+                        await self._start(index, chat_id)
+                    index += 1
+            await asyncio.gather(*self._tasks)
+            self.finished = True
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+            await self._report()
+        return self.stats()
+
+    async def _start(self, index: int, chat_id: int):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._send(index, chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, index: int, chat_id: int):
+        from telegram.error import Forbidden
+
+        try:
+            text = self.message(chat_id) if callable(self.message) else self.message
+            if inspect.isawaitable(text):
+                text = await text
+            if text is None:
+                self.skipped += 1
+            else:
+                telegram_bot = self.telegram_bot
+                await self.queue.put(chat_id, lambda: telegram_bot.send_message(chat_id=chat_id, text=text))
+                self.sent += 1
+                self._sent_now += 1
+        except Forbidden:
+            self.blocked += 1  # the user blocked the bot or the bot was removed from the chat
+        except Exception as e:
+            self.failed += 1
+            _log.warning("Broadcast to %s failed: %s", chat_id, e)
+        finally:
+            self._slots.release()
+
+        # (a cancelled message doesn't get here, it is sent again when the broadcast continues)
+        # the checkpoint moves only over recipients that are all done
+        self._done.add(index)
+        while self.position in self._done:
+            self._done.remove(self.position)
+            self.position += 1
+
+
+class _Job:
+    __slots__ = ("id", "chat_id", "text", "when", "interval")
+
+    def __init__(self, job_id: str, chat_id: int, text: Union[str, Callable], when: float,
+                 interval: Optional[float]):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.text = text  # or function(chat_id) -> text, such jobs are not saved
+        self.when = when  # unix time of the next run
+        self.interval = interval  # seconds between runs, None - runs once
+
+    def same(self, other: _Job) -> bool:
+        return (self.chat_id, self.text, self.interval) == (other.chat_id, other.text, other.interval)
+
+
+class _Scheduler:
+    """
+    Delayed and recurring messages
+    - one task sleeps until the earliest job of a heap: O(log n) to add a job
+    - cancel removes the job from the dict only (O(1)), its heap entry is skipped when it comes up
+    and the heap is rebuilt when most of it is such entries
+    - with a path the jobs are kept in SQLite, changes are written in batches in the background;
+    after a restart the overdue jobs run at once, a recurring job runs once for all the runs it missed.
+    A message is deleted from the file when it is sent, so the ones cut off by a stop are sent after the restart
+    """
+
+    def __init__(self, send: Callable, path: Optional[str] = None, flush_interval: float = 1.0):
+        self.send = send  # function(chat_id, text) returning a coroutine
+        self.flush_interval = flush_interval
+        self._jobs = {}  # id -> _Job
+        self._heap = []  # (when, sequence, job id), entries of cancelled and moved jobs stay until they come up
+        self._sequence = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = {}  # task -> id of the job it sends
+        self._counters = {"fired": 0, "sent": 0, "failed": 0}
+
+        self._dirty = {}  # job id -> job to write or None to delete
+        self._flusher = None
+        self._writing = False
+        self._db = None
+        if path:
+            import sqlite3
+
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, "
+                             "text TEXT NOT NULL, at REAL NOT NULL, interval REAL)")
+            self._db.commit()
+            for job_id, chat_id, text, when, interval in self._db.execute("SELECT * FROM jobs"):
+                self._jobs[job_id] = _Job(job_id, chat_id, text, when, interval)
+            self._heap = [(job.when, index, job.id) for index, job in enumerate(self._jobs.values())]
+            self._sequence = len(self._heap)
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        """Starts the timer task (on the running loop), jobs added before just wait for it"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def add(self, job: _Job) -> str:
+        """Adds the job, a job with its id is replaced (or kept, with its next run, if it is the same)"""
+        old = self._jobs.get(job.id)
+        if old is not None and old.same(job):
+            return old.id
+        self._jobs[job.id] = job
+        self._push(job)
+        self._changed(job.id, job)
+        return job.id
+
+    def cancel(self, job_id: str) -> bool:
+        if self._jobs.pop(job_id, None) is None:
+            return False
+        self._changed(job_id, None)
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._jobs):
+            self._heap = [(job.when, index, job.id) for index, job in enumerate(self._jobs.values())]
+            self._sequence = len(self._heap)
+            heapq.heapify(self._heap)
+        return True
+
+    def stats(self) -> dict:
+        return {"pending": len(self._jobs), "heap": len(self._heap), "dirty": len(self._dirty), **self._counters}
+
+    def _push(self, job: _Job):
+        self._sequence += 1
+        heapq.heappush(self._heap, (job.when, self._sequence, job.id))
+        if self._heap[0][2] == job.id:
+            self._wakeup.set()  # earlier than the one the task sleeps for
+
+    async def _run(self):
+        jobs = self._jobs
+        while True:
+            self._wakeup.clear()
+            heap = self._heap  # rebuilt by cancel
+            now = time.time()
+            fired = 0
+            while heap and heap[0][0] <= now:
+                when, _, job_id = heapq.heappop(heap)
+                job = jobs.get(job_id)
+                if job is None or job.when != when:
+                    continue  # cancelled or moved
+                self._fire(job, now)
+                fired += 1
+                if fired % 1000 == 0:
+                    await asyncio.sleep(0)  # a pile of due jobs doesn't block the loop
+                    now = time.time()
+            # the clock can jump (suspend, NTP), so the task wakes up at least once a minute
+            delay = min(heap[0][0] - now, 60.0) if heap else 60.0
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    def _fire(self, job: _Job, now: float):
+        self._counters["fired"] += 1
+        task = asyncio.get_running_loop().create_task(self.send(job.chat_id, job.text))
+        self._sending[task] = job.id
+        task.add_done_callback(self._sent)
+        if job.interval is None:
+            del self._jobs[job.id]  # and from the file when it is sent
+        else:
+            # the runs missed while the bot was down (or the loop was busy) are not sent one by one
+            job.when += job.interval * ((now - job.when) // job.interval + 1)
+            self._push(job)
+            self._changed(job.id, job)
+
+    def _sent(self, task: asyncio.Task):
+        job_id = self._sending.pop(task)
+        if task.cancelled():
+            return
+        if job_id not in self._jobs:
+            self._changed(job_id, None)  # sent (or failed for good) once
+        error = task.exception()
+        if error is None:
+            self._counters["sent"] += 1
+        else:
+            self._counters["failed"] += 1
+            _log.warning("Scheduled message failed: %s", error)
+
+    def _changed(self, job_id: str, job: Optional[_Job]):
+        if self._db is None:
+            return
+        self._dirty[job_id] = None if job is None or callable(job.text) else job
+        if self._flusher is None or self._flusher.done():
+            loop = _running_loop()
+            if loop is not None:  # otherwise written by the next change on the loop or by close()
+                self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write the changed jobs in one transaction, in a worker thread"""
+        if self._db is None or not self._dirty:
+            return
+        writing, self._dirty = self._dirty, {}
+        rows = [(job.id, job.chat_id, job.text, job.when, job.interval) for job in writing.values() if job]
+        deleted = [(job_id,) for job_id, job in writing.items() if job is None]
+        self._writing = True
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, rows, deleted)
+        except Exception as e:
+            self._dirty = {**writing, **self._dirty}  # kept for the next flush, newer changes win
+            _log.warning("Error writing scheduled messages: %s", e)
+        finally:
+            self._writing = False
+
+    def _write(self, rows: list, deleted: list):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO jobs (id, chat_id, text, at, interval) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", deleted)
+
+    async def close(self):
+        """Stops the timers and writes the jobs, the messages being sent are cancelled"""
+        for task in (self._task, self._flusher):
+            if task is not None:
+                if task is self._task or not self._writing:  # a write that has started can't be cancelled
+                    task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._flusher = None
+        for task in list(self._sending):
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        await self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class _PendingEdit:
+    __slots__ = ("state", "send", "at", "task", "started")
+
+    def __init__(self, state: tuple, send: Callable, at: float):
+        self.state = state  # (text, markup, hash of both)
+        self.send = send
+        self.at = at  # loop time the edit is sent at
+        self.task = None
+        self.started = None  # loop time the request went out, None while waiting
+
+
+class _EditManager:
+    """
+    Edits of bot messages (the menus of inline buttons), per (chat_id, message_id):
+    - the hash of the last text and markup is remembered, an edit to the same state is not sent
+    - an edit goes out at once, the edits within `delay` after it are merged: only the last state is sent
+    - a newer state cancels an edit that is still in flight
+    """
+
+    def __init__(self, delay: float = 0.3, size: int = 10_000):
+        self.delay = delay
+        self.size = size
+        self._rendered = OrderedDict()  # (chat_id, message_id) -> (hash, loop time of the edit)
+        self._pending = {}  # (chat_id, message_id) -> _PendingEdit
+        self.requested = 0
+        self.sent = 0
+        self.skipped = 0  # the message already shows this state
+        self.superseded = 0  # replaced by a newer state before they were sent
+        self.cancelled = 0  # cancelled in flight
+
+    def edit(self, key: tuple, text: str, markup, send: Callable):
+        """send(text, markup) - coroutine function that edits the message"""
+        self.requested += 1
+        loop = asyncio.get_running_loop()
+        state = (text, markup, hash((text, markup)))
+        pending = self._pending.get(key)
+        if pending is not None:
+            if pending.started is not None and pending.state[2] == state[2]:
+                self.skipped += 1  # the edit in flight sends this state
+                return
+            self.superseded += 1
+            if pending.started is None:
+                # still waiting: it sends the newest state
+                pending.state, pending.send = state, send
+                return
+            pending.task.cancel()
+            self.cancelled += 1
+            last = pending.started
+        else:
+            rendered = self._rendered.get(key)
+            if rendered is not None and rendered[0] == state[2]:
+                self.skipped += 1
+                return
+            last = rendered[1] if rendered is not None else None
+
+        at = loop.time() if last is None else max(loop.time(), last + self.delay)
+        pending = self._pending[key] = _PendingEdit(state, send, at)
+        pending.task = loop.create_task(self._run(key, pending))
+
+    async def _run(self, key: tuple, pending: _PendingEdit):
+        from telegram.error import BadRequest
+
+        loop = asyncio.get_running_loop()
+        try:
+            delay = pending.at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, markup, digest = pending.state
+            rendered = self._rendered.get(key)
+            if rendered is not None and rendered[0] == digest:
+                self.skipped += 1
+                return
+
+            pending.started = loop.time()
+            try:
+                await pending.send(text, markup)
+            except BadRequest as e:
+                # the message shows this state already (for example it was edited by another client)
+                if "message is not modified" not in str(e).lower():
+                    raise
+            self.sent += 1
+            self._rendered[key] = (digest, pending.started)
+            self._rendered.move_to_end(key)
+            if len(self._rendered) > self.size:
+                self._rendered.popitem(last=False)
+        except asyncio.CancelledError:
+            if pending.started is not None:
+                self._rendered.pop(key, None)  # unknown whether the cancelled edit was applied
+            raise
+        except Exception as e:
+            self._rendered.pop(key, None)
+            _log.warning("Error editing message %s: %s", key, e)
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+    async def close(self):
+        tasks = [pending.task for pending in self._pending.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"requested": self.requested, "sent": self.sent, "skipped": self.skipped,
+                "superseded": self.superseded, "cancelled": self.cancelled, "pending": len(self._pending)}
+
+
+def _file_digest(path: str) -> str:
+    """sha256 of a file, read in chunks (the file is never in memory as a whole)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sent_file_id(message, kind: str) -> Optional[str]:
+    """file_id Telegram gave to the photo (the largest size) or document of a sent message"""
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    return message.document.file_id if message.document else None
+
+
+class _FileIds:
+    """
+    file_id of the files the bot uploaded: path -> (mtime, size, sha256 of the content) and kind:sha256 -> file_id.
+    Kept in a JSON file, so a file is uploaded once, not once per start (and its copies are not uploaded at all).
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._paths = {}  # absolute path -> [mtime_ns, size, sha256]
+        self._files = {}  # "photo:<sha256>" -> file_id
+        self._uploads = {}  # "photo:<sha256>" -> future of the upload in progress
+        self._dirty = False
+        self.uploaded = 0
+        self.reused = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as file:
+                    data = json.load(file)
+                self._paths, self._files = data["paths"], data["files"]
+            except (OSError, ValueError, KeyError) as e:
+                _log.warning("File id cache %s can't be read, files are uploaded again: %s", path, e)
+
+    async def key(self, kind: str, path: str) -> str:
+        """kind:sha256 of a local file, the content is hashed only when the file is new or changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._paths.get(path)
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return f"{kind}:{known[2]}"
+        digest = await asyncio.get_running_loop().run_in_executor(None, _file_digest, path)
+        self._paths[path] = [stat.st_mtime_ns, stat.st_size, digest]
+        self._dirty = True
+        return f"{kind}:{digest}"
+
+    async def get(self, key: str, wait: bool = True) -> Optional[str]:
+        """file_id of the key, with wait an upload of the same file that is in progress is waited for"""
+        upload = self._uploads.get(key)
+        if upload is not None and wait:
+            await asyncio.shield(upload)
+        file_id = self._files.get(key)
+        if file_id is not None:
+            self.reused += 1
+        return file_id
+
+    def uploading(self, key: str) -> bool:
+        return key in self._uploads
+
+    def start_upload(self, key: str):
+        self._uploads[key] = asyncio.get_running_loop().create_future()
+
+    def finish_upload(self, key: str, file_id: Optional[str]):
+        """None - the upload failed, the sends that waited for it upload the file themselves"""
+        if file_id is not None:
+            self._files[key] = file_id
+            self._dirty = True
+            self.uploaded += 1
+        upload = self._uploads.pop(key, None)
+        if upload is not None and not upload.done():
+            upload.set_result(file_id)
+
+    def forget(self, key: str):
+        if self._files.pop(key, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        # written on the loop after an upload (rare), a crash in the middle of a write leaves the old file
+        if not self._dirty or not self.path:
+            return
+        self._dirty = False
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump({"paths": self._paths, "files": self._files}, file)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            _log.warning("Error saving file id cache %s: %s", self.path, e)
+
+    def stats(self) -> dict:
+        return {"files": len(self._files), "uploaded": self.uploaded, "reused": self.reused}
+
+
+class _AhoCorasick:
+    """Aho-Corasick automaton: one pass over the text finds every keyword in it"""
+
+    def __init__(self):
+        self._goto = [{}]  # node -> {char: node}
+        self._fail = [0]
+        self._values = [()]  # values of the keywords that end in the node
+        self._dict_link = [0]  # nearest node on the fail chain that has values
+        self._best = [None]  # smallest value that ends in the node or on its fail chain
+        self._built = True
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def add(self, keyword: str, value: int):
+        node = 0
+        for char in keyword:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][char] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._values.append(())
+                self._dict_link.append(0)
+                self._best.append(None)
+            node = child
+        self._values[node] += (value,)
+        self._built = False
+
+    def build(self):
+        goto, fail, values, best = self._goto, self._fail, self._values, self._best
+        best[0] = min(values[0]) if values[0] else None
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            link = fail[node]
+            own = min(values[node]) if values[node] else None
+            best[node] = own if best[link] is None or (own is not None and own < best[link]) else best[link]
+            self._dict_link[node] = link if values[link] else self._dict_link[link]
+
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(char, 0)
+                fail[child] = target if target != child else 0
+                queue.append(child)
+        self._built = True
+
+    def first(self, text: str) -> Optional[int]:
+        """Smallest value of the keywords that occur in the text"""
+        if not self._built:
+            self.build()
+        goto, fail, best = self._goto, self._fail, self._best
+        found = best[0]
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            value = best[node]
+            if value is not None and (found is None or value < found):
+                found = value
+        return found
+
+    def all(self, text: str) -> set:
+        """Values of all keywords that occur in the text"""
+        if not self._built:
+            self.build()
+        goto, fail, values, dict_link = self._goto, self._fail, self._values, self._dict_link
+        found = set(values[0])
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            state = node if values[node] else dict_link[node]
+            while state:
+                found.update(values[state])
+                state = dict_link[state]
+        return found
+
+
+class _PrefixTrie:
+    """Prefixes in a trie, the longest prefix of the text is found in O(len(prefix))"""
+
+    _END = None  # key of the value in a node (every other key is one char)
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix: str, value: int):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(self._END, value)
+
+    def longest(self, text: str) -> Optional[int]:
+        node = self._root
+        found = node.get(self._END)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._END in node:
+                found = node[self._END]
+        return found
+
+
+def _required_literal(pattern: str) -> str:
+    """
+    The longest literal that every match of the regex contains ('' if we are not sure)
+    Only text outside of groups is used and patterns with alternation or (?...) are skipped.
+    """
+    if "|" in pattern or "(?" in pattern:
+        return ""
+
+    runs = []
+    current = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+
+        if char == "\\":
+            following = pattern[i + 1:i + 2]
+            if following and not following.isalnum():
+                literal = following  # escaped punctuation
+            i += 2
+        elif char == "[":
+            if "\\" in pattern[i:]:
+                return ""
+            start = i + 1
+            if pattern[start:start + 1] == "^":
+                start += 1
+            if pattern[start:start + 1] == "]":
+                start += 1
+            end = pattern.find("]", start)
+            if end == -1:
+                return ""
+            i = end + 1
+        elif char == "(":
+            depth += 1
+            i += 1
+        elif char == ")":
+            depth -= 1
+            i += 1
+        elif char == "{":
+            end = pattern.find("}", i)
+            i = end + 1 if end != -1 else len(pattern)
+        elif char in ".^$*+?":
+            i += 1
+        else:
+            literal = char
+            i += 1
+
+        if literal is None or depth:
+            runs.append(current)
+            current = ""
+            continue
+
+        quantifier = pattern[i:i + 1]
+        if quantifier in ("?", "*", "{"):
+            # the char is optional
+            runs.append(current)
+            current = ""
+        elif quantifier == "+":
+            # the first repetition ends this run, the last one starts the next run
+            runs.append(current + literal)
+            current = literal
+            i += 1
+        else:
+            current += literal
+    runs.append(current)
+
+    literal = max(runs, key=len).lower()
+    # case-insensitive matching of non-ASCII text is not a plain lower()
+    return literal if literal.isascii() else ""
+
+
+class _RegexSet:
+    """
+    Regex rules behind a prefilter: only the rules whose required literal occurs in the text
+    (and the few rules without a literal) are tried, in the order they were registered
+    """
+
+    def __init__(self):
+        self._rules = []  # rule -> compiled regex
+        self._values = []  # rule -> value
+        self._literals = _AhoCorasick()
+        self._always = []  # rules without a literal, they are tried for every text
+        self._always_regex = None
+        self._built = True
+
+    def __len__(self):
+        return len(self._rules)
+
+    def add(self, pattern: str, value: int):
+        rule = len(self._rules)
+        self._rules.append(re.compile(pattern, re.IGNORECASE))
+        self._values.append(value)
+        literal = _required_literal(pattern)
+        if literal:
+            self._literals.add(literal, rule)
+        else:
+            self._always.append(rule)
+        self._built = False
+
+    def build(self):
+        self._literals.build()
+        self._always_regex = None
+        patterns = [self._rules[rule].pattern for rule in self._always]
+        # one combined regex rejects most texts at once; backreferences don't survive combining
+        if len(patterns) > 1 and not any(re.search(r"\\\d|\(\?P=", p) for p in patterns):
+            try:
+                self._always_regex = re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+            except re.error:
+                self._always_regex = None
+        self._built = True
+
+    def first(self, text: str) -> Optional[int]:
+        if not self._built:
+            self.build()
+        candidates = self._literals.all(text) if len(self._literals) else set()
+        if self._always and (self._always_regex is None or self._always_regex.search(text)):
+            candidates.update(self._always)
+        for rule in sorted(candidates):
+            if self._rules[rule].search(text):
+                return self._values[rule]
+        return None
+
+
+class _PatternMatcher:
+    """
+    if_message rules that are not exact: "prefix", "contains" and "regex"
+    Priority: the longest prefix, then the first registered keyword that occurs anywhere in the text,
+    then the first registered regex that matches. The cost depends on the length of the text,
+    not on the number of rules.
+    """
+
+    KINDS = ("prefix", "contains", "regex")
+
+    def __init__(self):
+        self._entries = []  # rule -> (response, args, kwargs)
+        self._rules = {}  # (kind, pattern) -> rule, registering a pattern again replaces its handler
+        self._prefix = _PrefixTrie()
+        self._contains = _AhoCorasick()
+        self._regex = _RegexSet()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, kind: str, pattern: str, entry: tuple):
+        if kind != "regex":
+            pattern = pattern.lower()
+
+        rule = self._rules.get((kind, pattern))
+        if rule is not None:
+            self._entries[rule] = entry
+            return
+
+        rule = self._rules[(kind, pattern)] = len(self._entries)
+        self._entries.append(entry)
+        if kind == "prefix":
+            self._prefix.add(pattern, rule)
+        elif kind == "contains":
+            self._contains.add(pattern, rule)
+        else:
+            self._regex.add(pattern, rule)
+
+    def match(self, text: str):
+        """(response, args, kwargs) of the best rule for a lowercased text or None"""
+        rule = self._prefix.longest(text)
+        if rule is None and len(self._contains):
+            rule = self._contains.first(text)
+        if rule is not None:
+            return self._entries[rule]
+        if len(self._regex):
+            rule = self._regex.first(text)
+            if rule is not None:
+                return self._entries[rule]
+        return None
+
+
+def _matches_text(kind: str, pattern: str, text: str) -> bool:
+    """One rule against a lowercased text (if_message without response)"""
+    if kind == "exact":
+        return text == pattern.lower()
+    if kind == "prefix":
+        return text.startswith(pattern.lower())
+    if kind == "contains":
+        return pattern.lower() in text
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+def _handler_name(func: Callable) -> str:
+    """
+    "module:qualname" of a module-level function. Lambdas, closures, partials and callable objects are told
+    apart by their id, bound methods by the id of their object (the name with an id is not saved to session_db)
+    """
+    if inspect.ismethod(func):
+        return f"{func.__module__}:{func.__qualname__}#{id(func.__self__)}"
+    name = f"{getattr(func, '__module__', '')}:{getattr(func, '__qualname__', '')}"
+    if not (inspect.isfunction(func) or inspect.isbuiltin(func) or inspect.isclass(func)) or "<" in name \
+            or name == ":" or getattr(func, "__closure__", None):
+        name += f"#{id(func)}"
+    return name
+
+
+def _resolve_handler(name: str) -> Optional[Callable]:
+    """The function of a _handler_name, None if it doesn't exist (anymore)"""
+    module_name, _, qualname = name.partition(":")
+    if "#" in name or module_name not in sys.modules:
+        return None
+    obj = sys.modules[module_name]
+    for part in qualname.split("."):
+        obj = getattr(obj, part, None)
+        if obj is None:
+            return None
+    return obj if callable(obj) else None
+
+
+class _ResponseCache:
+    """
+    Messages a handler sent, kept for ttl seconds per key (least recently used leave first when it is full).
+    Concurrent misses of one key wait for the first one, so the handler runs once for all of them.
+    """
+
+    KEYS = ("global", "chat", "user")
+
+    def __init__(self, ttl: float, key: str = "global", maxsize: int = 1024):
+        self.ttl = ttl
+        self.key = key
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires, messages)
+        self._pending = {}  # key -> future of the computation in progress
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # misses that waited for the computation of another update
+
+    def key_of(self, request: _RequestContext):
+        # the text is a part of the key: a list of messages or a pattern (and command arguments) may answer differently
+        text = request.user_text
+        if text is None and request.update.message is not None:
+            text = request.update.message.text  # commands
+        if self.key == "chat":
+            return request.chat_id, text
+        if self.key == "user":
+            return (request.user.id if request.user else None), text
+        return text
+
+    async def get(self, key, compute: Callable):
+        """The cached messages of the key, compute() - coroutine function that makes them on a miss"""
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            self.shared += 1
+            try:
+                messages = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this update was cancelled
+                continue  # the update that computed was cancelled, the next one computes again
+            if messages is not None:
+                return messages
+            return await compute()  # nothing to share, the handler answers this update itself
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            messages = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()  # retrieved, nobody may be waiting
+            raise
+        finally:
+            del self._pending[key]
+
+        if not messages:
+            # the handler answered some other way (update.message.reply_text ...), there is nothing to send again
+            future.set_result(None)
+            return messages
+        self._entries[key] = (time.monotonic() + self.ttl, messages)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        future.set_result(messages)
+        return messages
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "shared": self.shared, "size": len(self._entries)}
+
+
+class _Session:
+    """State of one chat: its menu and the messages waiting for it"""
+
+    __slots__ = ("chat_id", "buttons", "inline", "menu", "pending", "touched", "size")
+
+    BASE_SIZE = 240  # the record, its key and its place in the LRU, bytes (approximately)
+
+    def __init__(self, chat_id: int, buttons: list, inline: bool, menu: Optional[str]):
+        self.chat_id = chat_id
+        self.buttons = buttons  # menus are never changed in place, so the list is shared
+        self.inline = inline
+        self.menu = menu  # id of the inline menu (callback_data -> handler), see TelegramBot._inline_menus
+        self.pending = None  # messages for later: text or ("answer", text)
+        self.touched = 0.0
+        self.size = self.BASE_SIZE
+
+    def same_menu(self, other: "_Session") -> bool:
+        return self.inline == other.inline and self.menu == other.menu and self.buttons == other.buttons
+
+    def estimate_size(self) -> int:
+        # the buttons are shared between chats, only the waiting messages are own
+        size = self.BASE_SIZE
+        if self.pending:
+            size += 64 + sum(100 + len(message if isinstance(message, str) else message[1])
+                             for message in self.pending)
+        return size
+
+    def dumps(self) -> str:
+        return json.dumps({"buttons": self.buttons, "inline": self.inline, "menu": self.menu,
+                           "pending": self.pending}, ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, chat_id: int, data: str, intern: Callable) -> "_Session":
+        state = json.loads(data)
+        session = cls(chat_id, intern([tuple(button) for button in state["buttons"]]), state["inline"], state["menu"])
+        if state["pending"]:
+            session.pending = [message if isinstance(message, str) else tuple(message) for message in state["pending"]]
+        session.size = session.estimate_size()
+        return session
+
+
+class _SessionStore:
+    """
+    Sessions of chats that differ from the default state
+    LRU limited by the number of sessions and by memory, idle sessions expire after ttl seconds.
+    With a path the sessions are also kept in SQLite: changes are written in batches in the background
+    (write-behind), an evicted session is read back on the next update of its chat.
+    """
+
+    def __init__(self, max_sessions: Optional[int] = 100_000, max_memory: Optional[int] = 64 << 20,
+                 ttl: Optional[float] = None, path: Optional[str] = None, flush_interval: float = 1.0,
+                 intern: Callable = list):
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.intern = intern  # shares equal button lists between chats
+        self.memory = 0
+        self._sessions = OrderedDict()  # chat_id -> session, least recently used first
+        self._counters = {"loaded": 0, "evicted": 0, "expired": 0, "written": 0}
+
+        # write-behind: chat_id -> session to write or None to delete
+        self._dirty = {}
+        self._writing = {}
+        self._flusher = None
+        self._wake = None  # event that wakes the flusher up before flush_interval (close, long backlog)
+        self.max_dirty = 10_000  # changed sessions that are written at once, without waiting for flush_interval
+        self._reader = self._writer = None
+        self._stored = set()  # chats that have a row in the database
+        self._dirty_menus = {}  # menu id -> [(callback_data, handler name)]
+        self._stored_menus = set()
+        if path:
+            import sqlite3
+
+            self._writer = sqlite3.connect(path, check_same_thread=False)
+            self._writer.execute("PRAGMA journal_mode=WAL")
+            self._writer.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._writer.execute("CREATE TABLE IF NOT EXISTS menus (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._writer.commit()
+            self._reader = sqlite3.connect(path, check_same_thread=False)
+            self._stored = {row[0] for row in self._reader.execute("SELECT chat_id FROM sessions")}
+            self._stored_menus = {row[0] for row in self._reader.execute("SELECT id FROM menus")}
+
+    @property
+    def persistent(self) -> bool:
+        return self._writer is not None
+
+    def save_menu(self, menu_id: str, handlers: list):
+        """Keeps [(callback_data, handler name)] of an inline menu, so it works after a restart"""
+        if self._writer is not None and menu_id not in self._stored_menus and menu_id not in self._dirty_menus:
+            self._dirty_menus[menu_id] = handlers
+            self._start_flusher()
+
+    def load_menu(self, menu_id: str) -> Optional[list]:
+        if menu_id in self._dirty_menus:
+            return self._dirty_menus[menu_id]
+        if self._reader is None or menu_id not in self._stored_menus:
+            return None
+        row = self._reader.execute("SELECT data FROM menus WHERE id = ?", (menu_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id: int) -> Optional[_Session]:
+        now = time.monotonic()
+        session = self._sessions.get(chat_id)
+        if session is not None:
+            if self.ttl is not None and now - session.touched > self.ttl:
+                self._drop(session, "expired")
+            else:
+                session.touched = now
+                self._sessions.move_to_end(chat_id)
+                return session
+
+        if self._reader is None:
+            return None
+        # evicted, but maybe not written yet
+        for pending in (self._dirty, self._writing):
+            if chat_id in pending:
+                session = pending[chat_id]
+                break
+        else:
+            if chat_id not in self._stored:
+                return None
+            row = self._reader.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+            session = _Session.loads(chat_id, row[0], self.intern) if row else None
+            self._counters["loaded"] += 1
+
+        if session is not None:
+            self._insert(session, now)
+        return session
+
+    def add(self, session: _Session):
+        self._insert(session, time.monotonic())
+        self.changed(session)
+
+    def changed(self, session: _Session):
+        """The session was modified: recount its memory and write it later"""
+        size = session.estimate_size()
+        self.memory += size - session.size
+        session.size = size
+        if self._writer is not None:
+            self._dirty[session.chat_id] = session
+            self._start_flusher()
+            if len(self._dirty) >= self.max_dirty and self._wake is not None:
+                self._wake.set()
+        self._shrink()
+
+    def remove(self, chat_id: int):
+        session = self._sessions.pop(chat_id, None)
+        if session is not None:
+            self.memory -= session.size
+        if self._writer is not None and (chat_id in self._stored or chat_id in self._dirty):
+            self._dirty[chat_id] = None
+            self._start_flusher()
+
+    def items(self):
+        return self._sessions.items()
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "memory": self.memory, "stored": len(self._stored),
+                "dirty": len(self._dirty), **self._counters}
+
+    def _insert(self, session: _Session, now: float):
+        session.touched = now
+        self._sessions[session.chat_id] = session
+        self.memory += session.size
+        self._shrink()
+
+    def _drop(self, session: _Session, reason: str):
+        # evicted from memory only: a dirty session is still written, a stored one is read back when needed
+        del self._sessions[session.chat_id]
+        self.memory -= session.size
+        self._counters[reason] += 1
+
+    def _shrink(self):
+        sessions = self._sessions
+        if self.ttl is not None:
+            deadline = time.monotonic() - self.ttl
+            while sessions:
+                oldest = next(iter(sessions.values()))
+                if oldest.touched >= deadline:
+                    break
+                self._drop(oldest, "expired")
+        while sessions and ((self.max_sessions is not None and len(sessions) > self.max_sessions)
+                            or (self.max_memory is not None and self.memory > self.max_memory)):
+            self._drop(next(iter(sessions.values())), "evicted")
+
+    def _start_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            loop = _running_loop()
+            if loop is not None:  # otherwise written by the next change on the loop or by close()
+                if self._wake is None:
+                    self._wake = asyncio.Event()
+                self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+        self._wake.clear()
+        await self.flush()
+
+    async def flush(self):
+        """Write the changed sessions in one transaction, in a worker thread"""
+        if self._writer is None or not (self._dirty or self._dirty_menus):
+            return
+        self._writing, self._dirty = self._dirty, {}
+        menus, self._dirty_menus = self._dirty_menus, {}
+        self._stored_menus.update(menus)
+        rows, deleted = [], []
+        for chat_id, session in self._writing.items():
+            if session is None:
+                deleted.append((chat_id,))
+                self._stored.discard(chat_id)
+            else:
+                rows.append((chat_id, session.dumps()))
+                self._stored.add(chat_id)
+        try:
+            menu_rows = [(menu_id, json.dumps(handlers)) for menu_id, handlers in menus.items()]
+            await asyncio.get_running_loop().run_in_executor(None, self._write, rows, deleted, menu_rows)
+            self._counters["written"] += len(rows) + len(deleted)
+        except Exception as e:
+            # keep them for the next flush, newer changes win
+            self._dirty = {**self._writing, **self._dirty}
+            self._dirty_menus.update(menus)
+            self._stored_menus.difference_update(menus)
+            _log.warning("Error writing sessions: %s", e)
+        finally:
+            self._writing = {}
+
+    def _write(self, rows: list, deleted: list, menu_rows: list):
+        with self._writer:
+            self._writer.executemany("INSERT OR REPLACE INTO sessions (chat_id, data) VALUES (?, ?)", rows)
+            self._writer.executemany("DELETE FROM sessions WHERE chat_id = ?", deleted)
+            self._writer.executemany("INSERT OR REPLACE INTO menus (id, data) VALUES (?, ?)", menu_rows)
+
+    async def close(self):
+        if self._flusher is not None:
+            # a write that has started can't be cancelled, let the flusher finish now
+            self._wake.set()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._reader.close()
+            self._writer = self._reader = None
+
+
+_HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable",
+}
+
+
+class _HttpServer:
+    """
+    Small asyncio HTTP/1.1 server (keep-alive, bodies with Content-Length only)
+    handler: async (method, path, headers, body) -> (status, body, content_type)
+    A connection holds one of the max_connections slots only while a request is read and handled,
+    an idle keep-alive connection waits keepalive_timeout seconds for its next request without a slot.
+    """
+
+    def __init__(self, handler: Callable, max_connections: int = 40, max_body: int = 1 << 20,
+                 idle_timeout: float = 60, keepalive_timeout: float = 5):
+        self.handler = handler
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout  # the first request line, then headers and body
+        self.keepalive_timeout = keepalive_timeout
+        self._connections = asyncio.Semaphore(max_connections)
+        self._server = None
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            timeout = self.idle_timeout
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if not line:
+                    break
+                # at most max_connections requests are handled at the same time, the rest wait here
+                async with self._connections:
+                    keep_alive = await self._serve_one(line, reader, writer)
+                if not keep_alive:
+                    break
+                timeout = self.keepalive_timeout
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            _log.error("Error in HTTP server: %s", e)
+        finally:
+            writer.close()
+
+    async def _serve_one(self, line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        request_line = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        if len(request_line) != 3:
+            await self._respond(writer, 400, b"", "text/plain", False)
+            return False
+        method, target, version = request_line
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            status, body, content_type = 400, b"", "text/plain"
+            keep_alive = False
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            status, body, content_type = 411, b"", "text/plain"
+            keep_alive = False
+        elif length > self.max_body:
+            status, body, content_type = 413, b"", "text/plain"
+            keep_alive = False
+        else:
+            request_body = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout) if length else b""
+            path = target.split("?", 1)[0]
+            status, body, content_type = await self.handler(method, path, headers, request_body)
+
+        await self._respond(writer, status, body, content_type, keep_alive)
+        return keep_alive
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str, keep_alive: bool):
+        writer.write(
+            f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+
+class _WebhookReceiver:
+    """Receives updates from Telegram and puts them into the update queue of the application"""
+
+    def __init__(self, application: Application, path: str, secret_token: Optional[str]):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+
+    async def __call__(self, method: str, path: str, headers: dict, body: bytes):
+        if path != self.path:
+            return 404, b"", "text/plain"
+        if method != "POST":
+            return 405, b"", "text/plain"
+        if self.secret_token is not None:
+            token = headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                return 403, b"", "text/plain"
+
+        from telegram import Update
+
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                return 400, b"", "text/plain"  # null or a list would put None into the update queue
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, b"", "text/plain"
+
+        # answer at once, handlers run in the application (with its concurrent_updates)
+        await self.application.update_queue.put(update)
+        return 200, b"", "text/plain"
+
+
+class _AdmissionQueue(asyncio.Queue):
+    """
+    Update queue of the application that decides which updates are handled and when:
+    - updates are handed out by priority (a lower number first), in order within a priority
+    - at most `workers` updates are handled at once, the others wait here, where they can still be shed
+    - at most `limit` updates wait; when it is full the oldest update of the lowest priority is shed
+      (policy "newest" - the new update, if it has the lowest priority)
+    - an update_id is handled once, a chat gets at most `chat_rate` updates per second (burst `chat_burst`),
+      an update that waited longer than `max_wait` seconds is shed
+    Only the methods the application and the updater use are implemented, join() is not.
+    """
+
+    CONTROL = 1 << 30  # lane of other objects (the stop signal of the application): last, never shed
+
+    def __init__(self, priority: Callable, on_shed: Callable, limit: int = 10_000, policy: str = "oldest",
+                 chat_rate: Optional[float] = None, chat_burst: float = 10, max_wait: Optional[float] = None):
+        super().__init__()
+        self.priority = priority  # update -> priority
+        self.on_shed = on_shed  # (update, reason)
+        self.limit = limit
+        self.policy = policy
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_wait = max_wait
+        self.workers = 1  # max_concurrent_updates of the application
+        self._lanes = {}  # priority -> deque of (time queued, update)
+        self._size = 0
+        self._running = 0  # handed out and not done yet
+        self._waiter = None
+        self._seen = OrderedDict()  # recent update_ids
+        self._buckets = OrderedDict()  # chat_id -> _TokenBucket
+        self.admitted = 0
+        self.duplicates = 0
+        self.shed = {"full": 0, "flood": 0, "stale": 0}
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def full(self) -> bool:
+        return self._size >= self.limit
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        """Never blocks the updater: an update is queued, dropped as a duplicate or shed"""
+        update_id = getattr(item, "update_id", None)
+        if update_id is None:
+            self._push(self.CONTROL, item)
+            return
+
+        if update_id in self._seen:
+            self.duplicates += 1
+            return
+        self._seen[update_id] = None
+        if len(self._seen) > 10_000:
+            self._seen.popitem(last=False)
+
+        loop = asyncio.get_running_loop()
+        chat = item.effective_chat
+        if self.chat_rate and chat is not None:
+            bucket = self._buckets.get(chat.id)
+            if bucket is None:
+                bucket = self._buckets[chat.id] = _TokenBucket(self.chat_rate, self.chat_burst, loop.time())
+                if len(self._buckets) > 10_000:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(chat.id)
+            if bucket.delay(loop.time()) > 0:
+                self._shed(item, "flood")
+                return
+            bucket.take()
+
+        priority = self.priority(item)
+        if self._size >= self.limit:
+            lowest = max((p for p, lane in self._lanes.items() if lane and p != self.CONTROL), default=None)
+            if lowest is None or lowest < priority or (lowest == priority and self.policy == "newest"):
+                self._shed(item, "full")
+                return
+            self._size -= 1
+            self._shed(self._lanes[lowest].popleft()[1], "full")
+        self.admitted += 1
+        self._push(priority, item)
+
+    def _push(self, priority: int, item):
+        lane = self._lanes.get(priority)
+        if lane is None:
+            lane = self._lanes[priority] = deque()
+        lane.append((asyncio.get_running_loop().time(), item))
+        self._size += 1
+        self._wake()
+
+    def _shed(self, update, reason: str):
+        self.shed[reason] += 1
+        self.on_shed(update, reason)
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _take(self):
+        """The next update by priority, None if it waited too long (it is shed)"""
+        priority = min(p for p, lane in self._lanes.items() if lane)
+        queued, item = self._lanes[priority].popleft()
+        self._size -= 1
+        if (self.max_wait is not None and priority != self.CONTROL
+                and asyncio.get_running_loop().time() - queued > self.max_wait):
+            self._shed(item, "stale")
+            return None
+        self._running += 1
+        return item
+
+    async def get(self):
+        while True:
+            if self._size and self._running < self.workers:
+                item = self._take()
+                if item is not None:
+                    return item
+                continue
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+
+    def get_nowait(self):
+        if not self._size:
+            raise asyncio.QueueEmpty
+        priority = min(p for p, lane in self._lanes.items() if lane)
+        self._size -= 1
+        self._running += 1
+        return self._lanes[priority].popleft()[1]
+
+    def task_done(self):
+        self._running = max(0, self._running - 1)
+        self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._size, "running": self._running, "admitted": self.admitted,
+            "duplicates": self.duplicates, "shed": sum(self.shed.values()),
+            **{f"shed_{reason}": count for reason, count in self.shed.items()},
+            "by_priority": {p: len(lane) for p, lane in sorted(self._lanes.items()) if p != self.CONTROL},
+        }
+
+
+# upper bounds of the latency buckets, seconds (the last bucket is +Inf)
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _metric_label(func: Callable) -> str:
+    """Name of a handler in the metrics: _handler_name without the id (it means nothing to a reader)"""
+    while isinstance(func, functools.partial):
+        func = func.func
+    return _handler_name(func).partition("#")[0]
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class _Histogram:
+    """Latency histogram with fixed buckets, plus the number of failed calls"""
+
+    __slots__ = ("counts", "total", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, failed: bool):
+        self.counts[bisect_left(_LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        if failed:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket with the q-quantile (inf if it is above the last bound)"""
+        rank = q * sum(self.counts)
+        running = 0
+        for bound, count in zip(_LATENCY_BUCKETS, self.counts):
+            running += count
+            if running >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        calls = sum(self.counts)
+        return {
+            "calls": calls,
+            "errors": self.errors,
+            "seconds": self.total,
+            "avg_ms": self.total / calls * 1000 if calls else 0.0,
+            "p50_ms": self.quantile(0.5) * 1000,
+            "p99_ms": self.quantile(0.99) * 1000,
+            "buckets": dict(zip(_LATENCY_BUCKETS + (float("inf"),), self.counts)),
+        }
+
+
+class _Metrics:
+    """
+    Counters of the bot: handler latency per handler, Bot API latency per method, updates per second
+    Only the event loop thread writes them (handlers in pools are timed on the loop), so there are no locks.
+    """
+
+    WINDOW = 60  # seconds of updates per second
+
+    def __init__(self):
+        self.handlers = {}  # handler -> _Histogram
+        self.api = {}  # Bot API method -> _Histogram
+        self.updates = 0
+        self._per_second = [0] * self.WINDOW  # ring of updates in the last seconds
+        self._second = int(time.perf_counter())
+        self._started = self._second
+
+    def observe_update(self, handler: str, started: float, failed: bool):
+        """An update handled by `handler` from `started` (perf_counter) until now"""
+        now = time.perf_counter()
+        histogram = self.handlers.get(handler)
+        if histogram is None:
+            histogram = self.handlers[handler] = _Histogram()
+        # _Histogram.observe inlined, this runs for every update
+        histogram.counts[bisect_left(_LATENCY_BUCKETS, now - started)] += 1
+        histogram.total += now - started
+        if failed:
+            histogram.errors += 1
+
+        self.updates += 1
+        second = int(now)
+        if second != self._second:
+            self._advance(second)
+        self._per_second[second % self.WINDOW] += 1
+
+    def observe_api(self, method: str, seconds: float, failed: bool):
+        histogram = self.api.get(method)
+        if histogram is None:
+            histogram = self.api[method] = _Histogram()
+        histogram.observe(seconds, failed)
+
+    def _advance(self, now: int):
+        # the seconds without updates are zeroed
+        for second in range(max(self._second + 1, now - self.WINDOW + 1), now + 1):
+            self._per_second[second % self.WINDOW] = 0
+        self._second = now
+
+    def updates_per_second(self) -> float:
+        """Average over the last complete seconds (up to a minute)"""
+        now = int(time.perf_counter())
+        if now != self._second:
+            self._advance(now)
+        seconds = min(self.WINDOW - 1, now - self._started)
+        if not seconds:
+            return float(self._per_second[now % self.WINDOW])
+        return (sum(self._per_second) - self._per_second[now % self.WINDOW]) / seconds
+
+    def snapshot(self) -> dict:
+        return {
+            "updates": self.updates,
+            "updates_per_s": self.updates_per_second(),
+            "handlers": {name: histogram.snapshot() for name, histogram in self.handlers.items()},
+            "api": {name: histogram.snapshot() for name, histogram in self.api.items()},
+        }
+
+    def render(self, gauges: dict, counters: Optional[dict] = None) -> str:
+        """Prometheus text format, gauges: name -> value, counters: name -> value or (label, {label value: value})"""
+        lines = [
+            "# HELP fast_bot_updates_total Updates handled by the bot.",
+            "# TYPE fast_bot_updates_total counter",
+            f"fast_bot_updates_total {self.updates}",
+            "# HELP fast_bot_updates_per_second Updates per second over the last minute.",
+            "# TYPE fast_bot_updates_per_second gauge",
+            f"fast_bot_updates_per_second {self.updates_per_second():.3f}",
+        ]
+        for name, value in gauges.items():
+            lines += [f"# TYPE fast_bot_{name} gauge", f"fast_bot_{name} {value}"]
+        for name, value in (counters or {}).items():
+            lines.append(f"# TYPE fast_bot_{name} counter")
+            if isinstance(value, tuple):
+                label, values = value
+                lines += [f'fast_bot_{name}{{{label}="{_escape_label(key)}"}} {count}' for key, count in values.items()]
+            else:
+                lines.append(f"fast_bot_{name} {value}")
+
+        for metric, label, histograms, help_text in (
+            ("handler", "handler", self.handlers, "Time of handling an update"),
+            ("api_request", "method", self.api, "Latency of Bot API requests"),
+        ):
+            lines += [f"# HELP fast_bot_{metric}_seconds {help_text}.", f"# TYPE fast_bot_{metric}_seconds histogram"]
+            errors = []
+            for name, histogram in histograms.items():
+                labels = f'{label}="{_escape_label(name)}"'
+                running = 0
+                for bound, count in zip(_LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    running += count
+                    lines.append(f'fast_bot_{metric}_seconds_bucket{{{labels},le="{bound}"}} {running}')
+                lines.append(f"fast_bot_{metric}_seconds_sum{{{labels}}} {histogram.total}")
+                lines.append(f"fast_bot_{metric}_seconds_count{{{labels}}} {running}")
+                errors.append(f"fast_bot_{metric}_errors_total{{{labels}}} {histogram.errors}")
+            lines += [f"# TYPE fast_bot_{metric}_errors_total counter"] + errors
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=None)
+def _timed_request_class() -> type:
+    """The class is made on first use, so HTTPXRequest (and telegram) is imported only when the bot runs"""
+    from telegram.request import HTTPXRequest
+
+    class _TimedRequest(HTTPXRequest):
+        """HTTPXRequest that puts the latency of every Bot API call into the metrics"""
+
+        def __init__(self, metrics: _Metrics, **kwargs):
+            super().__init__(**kwargs)
+            self._metrics = metrics
+
+        async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+                failed = code >= 400
+                return code, payload
+            finally:
+                # .../bot<token>/<method>
+                self._metrics.observe_api(url.rsplit("/", 1)[-1], time.perf_counter() - started, failed)
+
+    return _TimedRequest
+
 
 class TelegramBot:
     """Initialize bot setting"""
@@ -39,26 +2360,60 @@ class TelegramBot:
         self._initial_buttons = None  # for save start  btn
         self._initial_buttons_inline = None  # for save start btn inline
         self._initial_start_message = None  # for save start msg
+        self._initial_inline_menu = None  # menu id of start_bot_btn_inline, restored on /start
+        self._initial_inline_handlers = None
+        self._start_template = None  # start_message parsed into segments
+        self._placeholders = {}  # custom {name} of the start message -> function(request)
         self.last_message = {}  # last message for delete or edit message
 
-        self.debug_LBF_and_code = False
+        self.debug_LBF_and_code = False  # debug records of the library are written too
+
+        # logs of the library: records are formatted and written by a background thread
+        self.log_level = "INFO"
+        self.log_format = "text"  # "text", "json" (one object per line) or None - use the logging of the application
+        self.log_file = None  # None - stderr
+        self.log_repeat_interval = 10  # seconds, the same warning or error is written once in this time
 
         self._processing_task = None  # Track the processing task
         self._should_process = True  # Control flag for processing loop
-
-        self._current_update = None
-        self._current_context = None
-        self._current_chat_id = None
-
-        # for debug chat_id, user_name, username and full_name
-        self._tmp_chat_id = None
-        self._tmp_user_name = None
-        self._tmp_username = None
-        self._tmp_full_name = None
-        self._tmp_user_id = None
+        self._message_queue = None  # outbound dispatcher, created on the first send
+
+        # outbound limits (Telegram: ~30 msg/s per bot, ~1 msg/s per chat, 20 msg/min per group), None - no limit
+        self.global_rate_limit = 30
+        self.chat_rate_limit = 1
+        self.chat_burst = 3
+        self.group_rate_limit = 20 / 60
+        self.group_burst = 3
+        self._application = None  # set in run(), for sending outside of handlers
+        self._loop = None  # event loop of the running bot, for calls from other threads
+        # admission of incoming updates (see _AdmissionQueue)
+        self.max_update_queue = 10_000  # updates waiting to be handled, then updates are shed
+        self.shed_policy = "oldest"  # when the queue is full: shed the "oldest" waiting update or the "newest" one
+        self.update_priorities = {"start": 0, "callback": 0, "command": 1, "message": 2}  # a lower number first
+        self.chat_update_rate = None  # updates per second a chat may send, the rest is shed (None - no limit)
+        self.chat_update_burst = 10
+        self.update_max_wait = None  # seconds an update may wait in the queue, then it is shed (None - no limit)
+        self.busy_message = None  # reply to the chats whose updates were shed (None - no reply)
+        self._busy_replies = {}  # chat_id -> loop time of the last busy reply
+        self._admission = None
+        self.file_id_cache = None  # JSON file that keeps the file_ids of uploads between restarts (None - in memory)
+        self._file_ids = None
+        self.schedule_db = None  # SQLite file that keeps the scheduled messages between restarts (None - in memory)
+        self._scheduler = None
+        self.base_url = None  # Bot API server, for example "http://127.0.0.1:8081/bot" (None - api.telegram.org)
+        # connections to the Bot API: sends and the other calls share one pool, getUpdates has its own
+        self.connection_pool_size = 256  # calls that can run at the same time, the rest waits up to pool_timeout
+        self.get_updates_pool_size = 1
+        self.connect_timeout = 5.0  # seconds
+        self.read_timeout = 5.0
+        self.write_timeout = 5.0
+        self.media_write_timeout = 20.0  # write timeout of the calls that upload files
+        self.pool_timeout = 1.0  # waiting for a free connection of the pool
+        self.http2 = False  # needs the http2 extra: pip install "python-telegram-bot[http2]"
+        self.keepalive_connections = None  # idle connections kept open (None - the size of the pool)
+        self.keepalive_expiry = 5.0  # seconds an idle connection is kept open
 
         self.debug_user_data = False
-        self._current_user = None
 
         self.default_message = None
         self.is_default_send_msg = False
@@ -66,53 +2421,511 @@ class TelegramBot:
 
         self.commands = {}
         self.command_hints = {}
+        self._scoped_command_hints = {}  # (scope, language_code) -> {command: info}, besides command_hints
+        self._pushed_menus = {}  # (scope, language_code) -> hash of the menu that Telegram has
+        self._command_sync_lock = asyncio.Lock()
+        self._command_sync_stats = {"pushed": 0, "skipped": 0, "failed": 0}
 
         self._msg_to_send = None
         self._msg_to_send_answer = None
-        self.pending_message = {}  # For storing messages by chat_id
+        self.coalesce_messages = False  # merge the messages of one handler into as few messages as possible
         self.message_callbacks = {}
-        self.current_user_text = None
         self.message_handlers = []
-        self.buttons = []
-        self.inline = False  # checking for buttons above the text or just buttons
-        self.buttons_handlers = {}  # for save callback_data
-
-    # Wrapper to support functions without parameters
-    def _wrap_callback(self, callback):
-        async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            # Save context first
-            self._current_update = update
-            self._current_context = context
-            self._current_user = update.effective_user
-
-            # Determine chat_id from either message or callback_query
-            if update.message:
-                self._current_chat_id = update.message.chat_id
-            elif update.callback_query and update.callback_query.message:
-                self._current_chat_id = update.callback_query.message.chat_id
-            else:
-                self._current_chat_id = None
+        # buttons, inline (checking for buttons above the text or just buttons) and buttons_handlers (callback_data)
+        # belong to the chat (see _update_menu), this is the menu of chats that don't have their own
+        self._default_session = _Session(None, [], False, None)
+        self._inline_menus = OrderedDict()  # menu id -> {callback_data: handler}
+        self.inline_menu_limit = 10_000  # menus kept in memory, the least recently used leave first
+        self._built_menus = {}  # buttons of add_buttons_inline -> (layout, menu id)
+        self._button_lists = {}  # layout -> the shared list of buttons
+
+        # sessions of chats with their own menu or waiting messages
+        self._sessions = None
+        self.max_sessions = 100_000
+        self.session_memory_limit = 64 * 1024 * 1024  # bytes
+        self.session_ttl = None  # seconds without updates, after which a session leaves memory
+        self.session_db = None  # SQLite file that keeps the sessions between restarts
+        self._patterns = _PatternMatcher()  # if_message with match="prefix" / "contains" / "regex"
+        self._keyword_sets = {}  # if_message(list) without response -> frozenset of lowercased words
+        self.response_cache_size = 1024  # answers kept by every cached handler (cache= of if_message / add_command)
+        self._response_caches = {}  # message or command -> _ResponseCache
+        self._markup_cache = OrderedDict()  # button layout -> keyboard markup
+        self.edit_debounce = 0.3  # seconds: edits of one message closer than this are merged, the last state is sent
+        self._edit_manager = None
+        self.markup_cache_size = 256
+
+        # where plain def handlers run by default: "loop", "thread" (blocking I/O) or "process" (heavy computations)
+        self.executor = "loop"
+        self.thread_workers = None  # size of the thread pool (None - Python's default)
+        self.process_workers = None  # size of the process pool (None - number of CPUs)
+        self._pools = {}  # "thread" / "process" -> pool, created on first use
+
+        # metrics of handlers and Bot API calls (get_metrics), cheap enough to stay on
+        self.collect_metrics = True
+        self.metrics_port = None  # port of the Prometheus endpoint /metrics (None - no endpoint)
+        self.metrics_listen = "127.0.0.1"
+        self._metrics = _Metrics()
+        self._metrics_server = None
+
+        # profiler of slow handlers: a part of the updates runs under cProfile, the slow ones are written to a file
+        self.profile_threshold = None  # seconds, an update that takes longer is written (None - profiler is off)
+        self.profile_sample_rate = 0.01  # part of the updates that are profiled
+        self.profile_file = "slow_handlers.log"
+        self.profile_file_size = 1024 * 1024  # bytes, then the file is rotated
+        self.profile_file_count = 3  # old files that are kept
+        self.profile_top = 25  # functions in a profile
+        self._profile_next = 0  # profile_next(n)
+        self._profiler_busy = False
+        self._profiler_concurrent = False  # the warning that the profiler is off was written
+        self._profile_log = None
+
+    """request context"""
+
+    @contextlib.contextmanager
+    def _request_scope(self, update: Update, context: ContextTypes.DEFAULT_TYPE, handler: str = "update"):
+        """Bind the update to the current task, so concurrent updates don't share state (and time its handler)"""
+        request = _current_request.get()
+        if request is not None and request.update is update:
+            # nested handler of the same update (for example a button inside handle_message)
+            yield request
+            return
+
+        request = _RequestContext(update, context, self.coalesce_messages, handler)
+        token = _current_request.set(request)
+        profile = self._start_profile() if self.profile_threshold is not None or self._profile_next else None
+        started = time.perf_counter() if self.collect_metrics else None
+        try:
+            yield request
+        except Exception:
+            request.failed = True
+            raise
+        finally:
+            _current_request.reset(token)
+            if started is not None:
+                self._metrics.observe_update(request.handler, started, request.failed)
+            if profile is not None:
+                self._finish_profile(profile, request)
+
+    @property
+    def _current_update(self):
+        request = _current_request.get()
+        return request.update if request else None
+
+    @property
+    def _current_context(self):
+        request = _current_request.get()
+        return request.context if request else None
+
+    @property
+    def _current_chat_id(self):
+        request = _current_request.get()
+        return request.chat_id if request else None
+
+    @property
+    def _current_user(self):
+        request = _current_request.get()
+        return request.user if request else None
+
+    @property
+    def current_user_text(self):
+        request = _current_request.get()
+        return request.user_text if request else None
+
+    """sessions"""
+
+    def _get_sessions(self) -> _SessionStore:
+        if self._sessions is None:
+            self._sessions = _SessionStore(
+                max_sessions=self.max_sessions,
+                max_memory=self.session_memory_limit,
+                ttl=self.session_ttl,
+                path=self.session_db,
+                intern=self._intern_buttons
+            )
+        return self._sessions
+
+    @_on_loop
+    def _menu_state(self) -> _Session:
+        """Session of the current chat, the default one outside of handlers and for chats without their own"""
+        request = _current_request.get()
+        if request is None or request.chat_id is None:
+            return self._default_session
+        sessions = self._sessions if self.session_db is None else self._get_sessions()
+        if sessions is None:
+            return self._default_session
+        return sessions.get(request.chat_id) or self._default_session
+
+    @_on_loop
+    def _update_menu(self, **fields):
+        """Changes the menu of the current chat (outside of handlers - the default menu)"""
+        default = self._default_session
+        request = _current_request.get()
+        if request is None or request.chat_id is None:
+            for name, value in fields.items():
+                setattr(default, name, value)
+            return
+
+        sessions = self._get_sessions()
+        session = sessions.get(request.chat_id)
+        if session is None:
+            session = _Session(request.chat_id, default.buttons, default.inline, default.menu)
+            for name, value in fields.items():
+                setattr(session, name, value)
+            if not session.same_menu(default):
+                sessions.add(session)
+            return
 
+        for name, value in fields.items():
+            setattr(session, name, value)
+        if session.same_menu(default) and not session.pending:
+            sessions.remove(request.chat_id)  # nothing of its own left
+        else:
+            sessions.changed(session)
+
+    @_on_loop
+    def _queue_pending(self, chat_id: int, message):
+        """Keeps a message until the next update of the chat"""
+        sessions = self._get_sessions()
+        session = sessions.get(chat_id)
+        if session is None:
+            default = self._default_session
+            session = _Session(chat_id, default.buttons, default.inline, default.menu)
+            session.pending = [message]
+            sessions.add(session)
+            return
+        if session.pending is None:
+            session.pending = []
+        session.pending.append(message)
+        sessions.changed(session)
+
+    @_on_loop
+    def _take_pending(self, chat_id: int) -> Optional[list]:
+        if self._sessions is None and self.session_db is None:
+            return None
+        sessions = self._get_sessions()
+        session = sessions.get(chat_id)
+        if session is None or not session.pending:
+            return None
+        pending, session.pending = session.pending, None
+        if session.same_menu(self._default_session):
+            sessions.remove(chat_id)
+        else:
+            sessions.changed(session)
+        return pending
+
+    @property
+    def buttons(self) -> list:
+        return self._menu_state().buttons
+
+    @buttons.setter
+    def buttons(self, buttons: list):
+        self._update_menu(buttons=self._intern_buttons(buttons))
+
+    @property
+    def inline(self) -> bool:
+        return self._menu_state().inline
+
+    @inline.setter
+    def inline(self, inline: bool):
+        self._update_menu(inline=inline)
+
+    @property
+    def buttons_handlers(self) -> dict:
+        """callback_data -> handler of the inline menu of the current chat"""
+        return self._get_inline_menu(self._menu_state().menu)
+
+    @_on_loop
+    def _get_inline_menu(self, menu_id: Optional[str]) -> dict:
+        handlers = self._inline_menus.get(menu_id)
+        if handlers is not None:
+            self._inline_menus.move_to_end(menu_id)  # least recently used menus leave first
+            return handlers
+        if menu_id is None or self._sessions is None or not self._sessions.persistent:
+            return {}
+
+        # a menu from before a restart: its handlers are found again by their names
+        saved = self._sessions.load_menu(menu_id)
+        if not saved:
+            return {}
+        handlers = {}
+        for callback_data, name in saved:
+            handler = _resolve_handler(name)
+            if handler is None:
+                return {}
+            handlers[callback_data] = self._inline_wrapper(handler, callback_data)
+        self._add_inline_menu(menu_id, handlers)
+        return handlers
+
+    @buttons_handlers.setter
+    def buttons_handlers(self, handlers: dict):
+        self._update_menu(menu=self._add_inline_menu(f"custom#{id(handlers)}", handlers))
+
+    @property
+    def pending_message(self) -> dict:
+        """chat_id -> messages waiting for the next update of the chat (a copy)"""
+        if self._sessions is None:
+            return {}
+        return {chat_id: list(session.pending) for chat_id, session in self._sessions.items() if session.pending}
+
+    def get_session_stats(self) -> dict:
+        """Sessions of chats: sessions, memory (bytes), stored, dirty, loaded, evicted, expired, written"""
+        if self._sessions is None:
+            return {"sessions": 0, "memory": 0, "stored": 0, "dirty": 0,
+                    "loaded": 0, "evicted": 0, "expired": 0, "written": 0}
+        return self._sessions.stats()
+
+    @_on_loop
+    def _intern_buttons(self, buttons: list) -> list:
+        """One shared list per button layout, chats with the same menu share it (and its index and markup)"""
+        try:
+            key = tuple(buttons)
+            shared = self._button_lists.get(key)
+        except TypeError:
+            return buttons  # unhashable buttons, used as they are
+        if shared is None:
+            if len(self._button_lists) >= 1024:
+                self._button_lists.clear()
+            shared = self._button_lists[key] = buttons
+        return shared
+
+    @_on_loop
+    def _add_inline_menu(self, menu_id: str, handlers: dict) -> str:
+        menus = self._inline_menus
+        menus[menu_id] = handlers
+        menus.move_to_end(menu_id)
+        if len(menus) > self.inline_menu_limit:
+            menus.popitem(last=False)
+        return menu_id
+
+    def _inline_wrapper(self, handler: Callable, callback_data: str):
+        invoke = self._bind_handler(handler, modes=("none", "full"))
+
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
-                if asyncio.iscoroutinefunction(callback):
-                    result = await callback(update, context)
-                else:
-                    result = callback(update, context)
-            except TypeError:
-                if asyncio.iscoroutinefunction(callback):
-                    result = await callback()
-                else:
-                    result = callback()
+                with self._request_scope(update, context) as request:
+                    request.handler = invoke.label
+                    # Execute handler
+                    await invoke(update, context)
 
-            await self._process_pending_message()
-            return result
+                    # Process pending messages
+                    await self._process_pending_message()
+            except Exception as e:
+                request = _current_request.get()
+                if request is not None:
+                    request.failed = True
+                _log.error("Button handler error (%s): %s", callback_data, e)
+
+        return wrapper
+
+    @_on_loop
+    def _build_inline_menu(self, buttons: list):
+        """
+        (buttons with callback_data, menu id) for [(text, handler)] or [(text, handler, payload)]
+        callback_data is "<menu id>:<index>[:<payload>]", so a click on an older message finds its own menu.
+        The id depends on the texts, the handlers and the payloads: the same menu gets the same id (also after
+        a restart) and its handlers are built only once.
+        """
+        # a menu that is shown again (navigation) is found by its buttons, without hashing it again
+        try:
+            key = tuple(buttons)
+            built = self._built_menus.get(key)
+        except TypeError:
+            key = built = None  # unhashable payload
+        if built is not None and built[1] in self._inline_menus:
+            layout, menu_id = built
+            return layout, self._add_inline_menu(menu_id, self._inline_menus[menu_id])
+
+        items = []
+        for button in buttons:
+            btn_text, handler, payload = button if len(button) == 3 else (*button, None)
+            items.append((btn_text, handler, payload, _handler_name(handler)))
+        content = "\n".join(f"{btn_text}\t{name}" if payload is None else f"{btn_text}\t{name}\t{payload}"
+                             for btn_text, _, payload, name in items)
+        menu_id = hashlib.sha1(content.encode()).hexdigest()[:12]
+
+        layout = []
+        for i, (btn_text, _, payload, _) in enumerate(items):
+            callback_data = f"{menu_id}:{i}" if payload is None else f"{menu_id}:{i}:{payload}"
+            if len(callback_data.encode()) > 64:
+                raise ValueError(f"Error inline buttons: the payload of {btn_text!r} is too long "
+                                 f"(callback_data is at most 64 bytes)")
+            layout.append((btn_text, callback_data))
+
+        handlers = self._inline_menus.get(menu_id)
+        if handlers is None:
+            handlers = {callback_data: self._inline_wrapper(handler, callback_data)
+                        for (_, callback_data), (_, handler, _, _) in zip(layout, items)}
+            names = [(callback_data, name) for (_, callback_data), (_, _, _, name) in zip(layout, items)]
+            if self.session_db is not None and not any("#" in name for _, name in names):
+                self._get_sessions().save_menu(menu_id, names)
+
+        layout = self._intern_buttons(layout)
+        if key is not None:
+            if len(self._built_menus) >= 1024:
+                self._built_menus.clear()
+            self._built_menus[key] = (layout, menu_id)
+        return layout, self._add_inline_menu(menu_id, handlers)
+
+    """executors"""
+
+    def use_executor(self, executor: str):
+        """
+        Decorator: where a plain def handler runs
+        :param executor: "loop" - on the event loop, "thread" - in a thread pool (files, requests, databases),
+        "process" - in a process pool (heavy computations, the handler must be a module-level function)
+        """
+        if executor not in _EXECUTORS:
+            raise ValueError(f"Error use_executor: unknown executor {executor!r}, use loop, thread or process")
+
+        def decorator(func):
+            func._executor = executor
+            return func
+
+        return decorator
+
+    def _with_executor(self, func, executor: Optional[str]):
+        """The handler with an executor for one registration (the function itself is not changed)"""
+        if executor is None or not callable(func):
+            return func
+        if executor not in _EXECUTORS:
+            raise ValueError(f"Error executor: unknown executor {executor!r}, use loop, thread or process")
+        handler = functools.partial(func)
+        handler._executor = executor
+        return handler
+
+    def _get_pool(self, executor: str) -> concurrent.futures.Executor:
+        pool = self._pools.get(executor)
+        if pool is None:
+            if executor == "thread":
+                pool = concurrent.futures.ThreadPoolExecutor(self.thread_workers, thread_name_prefix="Library_Fast_Bot")
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor(self.process_workers)
+            self._pools[executor] = pool
+        return pool
+
+    def _spawn(self, coro):
+        """create_task that also works in handlers running in a worker thread"""
+        loop = _running_loop()
+        if loop is not None:
+            return loop.create_task(coro)
+
+        request = _current_request.get()
+        if request is None or request.loop is None:
+            coro.close()  # worker process: there is no event loop to run it
+            return None
+        return asyncio.run_coroutine_threadsafe(_in_request(request, coro), request.loop)
+
+    async def _call_sync(self, func: Callable, *args, **kwargs):
+        """Calls a plain def handler on the event loop or in a worker pool"""
+        executor = getattr(func, "_executor", None) or self.executor
+        if executor == "loop":
+            return func(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        request = _current_request.get()
+        if executor == "thread":
+            if request is not None:
+                request.loop = loop  # send_message in the thread hands the messages over to this loop
+            call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+            return await loop.run_in_executor(self._get_pool("thread"), call)
+
+        if executor != "process":
+            raise ValueError(f"Error executor: unknown executor {executor!r}, use loop, thread or process")
+
+        # update and context can't be sent to another process, the handler gets only its own arguments
+        update = request.update if request else None
+        if request is not None and any(arg is request.update or arg is request.context for arg in args):
+            raise ValueError(f"Error executor: {_metric_label(func)} runs in a worker process "
+                             f"(executor=\"process\") and can't take update and context")
+        result, outbox = await loop.run_in_executor(
+            self._get_pool("process"), _run_in_process, func, args, kwargs,
+            update, request.user_text if request else None
+        )
+        for chat_id, reply_to, text in outbox:
+            if isinstance(text, _FilesToSend):
+                self._send_files(text, chat_id)
+            elif reply_to is None:
+                self.send_message(text, chat_id)
+            else:
+                self.answer_message(text, None if chat_id == request.chat_id else chat_id)
+        return result
 
-        return wrapped
+    _CALL_FORMS = {"full": "(update, context, *args)", "args": "(*args)", "none": "()"}
+
+    def _bind_handler(self, func: Callable, args: tuple = (), kwargs: dict = None,
+                      modes: tuple = ("full", "none"), where: str = "handler"):
+        """
+        Resolves once how a handler is called and returns invoke(update, context) that calls it directly
+        :param modes: accepted calls in order of preference: "full" - func(update, context, *args, **kwargs),
+        "args" - func(*args, **kwargs), "none" - func()
+        :param where: name of the method for the error message
+        """
+        kwargs = kwargs or {}
+        in_process = (not asyncio.iscoroutinefunction(func)
+                      and (getattr(func, "_executor", None) or self.executor) == "process")
+        if in_process and "full" in modes:
+            # update and context can't be sent to another process
+            mode = _call_mode(func, args, kwargs, tuple(mode for mode in modes if mode != "full"))
+            if mode is None and _call_mode(func, args, kwargs, ("full",)) is not None:
+                raise ValueError(f"Error {where}: {_metric_label(func)} runs in a worker process "
+                                 f"(executor=\"process\") and can't take update and context")
+        else:
+            mode = _call_mode(func, args, kwargs, modes)
+        if mode is None:
+            forms = " or ".join(self._CALL_FORMS[mode] for mode in modes)
+            raise ValueError(f"Error {where}: {getattr(func, '__qualname__', func)} can't be called as {forms}")
+
+        call = func if asyncio.iscoroutinefunction(func) else functools.partial(self._call_sync, func)
+
+        if mode == "full":
+            async def invoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
+                return await call(update, context, *args, **kwargs)
+        elif mode == "args":
+            async def invoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
+                return await call(*args, **kwargs)
+        else:
+            async def invoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
+                return await call()
+        invoke.label = _metric_label(func)
+        return invoke
 
     """After click start"""
 
     def start_bot(self, text):
         self.start_message = text
+        self._initial_start_message = text
+        self._get_start_template()  # parse once, not on every /start
+
+    def add_placeholder(self, name: str, func: Callable):
+        """
+        Adds a placeholder {name} for the start message
+        :param name: name of the placeholder (for example "balance" -> "{balance}")
+        :param func: function that returns the text, it gets (update, context) or nothing; not async, the start
+        message is rendered without awaiting
+        """
+        if not name.isidentifier():
+            raise ValueError(f"Error add_placeholder: invalid name {name!r}, use letters, digits and underscores")
+        if asyncio.iscoroutinefunction(func) or asyncio.iscoroutinefunction(getattr(func, "__call__", None)):
+            raise ValueError(f"Error add_placeholder: {getattr(func, '__qualname__', func)} is async, placeholders "
+                             f"must be plain functions")
+
+        mode = _call_mode(func, (), {}, ("full", "none"))
+        if mode is None:
+            raise ValueError(f"Error add_placeholder: {getattr(func, '__qualname__', func)} can't be called as "
+                             f"(update, context) or ()")
+        if mode == "full":
+            self._placeholders[name] = lambda request: str(func(request.update, request.context))
+        else:
+            self._placeholders[name] = lambda request: str(func())
+        self._start_template = None  # parsed again with the new placeholder
+
+    def _get_start_template(self) -> _Template:
+        """start_message parsed into segments, parsed again only when start_message changes"""
+        template = self._start_template
+        if template is None or template.source is not self.start_message:
+            template = _Template(self.start_message, {**_TEMPLATE_FIELDS, **self._placeholders})
+            self._start_template = template
+        return template
 
     """command before start"""
 
@@ -129,20 +2942,23 @@ class TelegramBot:
                     processed_buttons.append((btn_text, btn_text))
                     # Register the handler properly
                     if btn_text.lower() not in self.message_callbacks:
-                        self.message_callbacks[btn_text.lower()] = (self._wrap_callback(handler), (), {})
+                        self.message_callbacks[btn_text.lower()] = (
+                            self._bind_handler(handler, where="start_bot_btn"), (), {}
+                        )
                 else:
                     # If just a string is passed
                     btn_text = item[0] if isinstance(item, tuple) else item
                     processed_buttons.append((btn_text, btn_text))
                     # Register a default handler
-                    self.message_callbacks[btn_text.lower()] = (self._wrap_callback(lambda: None), (), {})
+                    self.message_callbacks[btn_text.lower()] = (self._bind_handler(lambda: None), (), {})
 
                     if len(processed_buttons) > 16:
                         raise ValueError("Error start_bot_btn: max 16 buttons!")
 
-            self.buttons = processed_buttons
-            self._initial_buttons = processed_buttons.copy()
-            self.inline = False  # Ensure this is set to False for regular buttons
+            # inline is set to False for regular buttons
+            self._update_menu(buttons=self._intern_buttons(processed_buttons), inline=False)
+            self._initial_buttons = self.buttons
+            self._get_start_template()
 
     """Inline buttons after start"""
 
@@ -151,286 +2967,628 @@ class TelegramBot:
         if not message.strip():
             raise ValueError("Message cannot be empty")
 
+        layout, menu_id = self._build_inline_menu(buttons)
+
         # Save initial state
         self._initial_start_message = message
         self._initial_buttons_inline = True
-        self._initial_buttons = []
-        self._initial_button_handlers = {}  # Dictionary to store original handlers
-
-        # Clear any existing button state
-        self.buttons = []
-        self.buttons_handlers.clear()
-        self.inline = True
-
-        # Process buttons
-        for i, (btn_text, handler) in enumerate(buttons):
-            callback_data = f"btn_{i}"
-            self._initial_buttons.append((btn_text, callback_data))
-            self._initial_button_handlers[callback_data] = handler  # Save original handler
+        self._initial_buttons = layout
+        self._initial_inline_menu = menu_id
+        self._initial_inline_handlers = self._inline_menus[menu_id]
 
         # Set current state to match initial state
         self.start_message = message
-        self.buttons = self._initial_buttons.copy()
-
-        # Register handlers with proper closure
-        for callback_data, handler in self._initial_button_handlers.items():
-            async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                              func=handler, cb_data=callback_data):
-                try:
-                    self._current_update = update
-                    self._current_context = context
-                    if update.callback_query and update.callback_query.message:
-                        self._current_chat_id = update.callback_query.message.chat_id
-
-                    # Execute handler
-                    if asyncio.iscoroutinefunction(func):
-                        await func()
-                    else:
-                        func()
-
-                    # Process pending messages
-                    await self._process_pending_message()
-                except Exception as e:
-                    if self.debug_LBF_and_code:
-                        print(f"Button handler error ({cb_data}): {e}")
+        self._update_menu(buttons=layout, inline=True, menu=menu_id)
+        self._get_start_template()
+
+    """keyboard markup"""
+
+    def _get_markup(self, buttons: list, inline: bool, resize_keyboard: bool = True,
+                    one_time_keyboard: bool = False):
+        """Keyboard markup for the buttons, built once per layout and reused for every send or edit"""
+        if not buttons:
+            return None
+
+        key = (tuple(buttons), inline, resize_keyboard, one_time_keyboard)
+        markup = self._markup_cache.get(key)
+        if markup is not None:
+            self._markup_cache.move_to_end(key)
+            return markup
+
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+        if inline:
+            keyboard = [
+                [InlineKeyboardButton(text, callback_data=data)
+                 for text, data in buttons if text.strip()]
+            ]
+            markup = InlineKeyboardMarkup(keyboard)
+        else:
+            keyboard = [[KeyboardButton(text)] for text, _ in buttons]
+            markup = ReplyKeyboardMarkup(
+                keyboard,
+                resize_keyboard=resize_keyboard,
+                one_time_keyboard=one_time_keyboard
+            )
 
-            self.buttons_handlers[callback_data] = wrapper
+        # markups are immutable, so one object can be shared by all chats
+        self._markup_cache[key] = markup
+        if len(self._markup_cache) > self.markup_cache_size:
+            self._markup_cache.popitem(last=False)
+        return markup
 
     """Send And answerForMessage"""
 
-    async def _send_message_ordered(self, chat_id: int, text: str, update: Update):
-        """Sends messages in order with a delay"""
-        if not chat_id:
-            chat_id = self._tmp_chat_id  # get chat id user
+    def _get_send_queue(self) -> _SendQueue:
+        """Outbound dispatcher of the running event loop"""
+        if self._message_queue is None:
+            self._message_queue = _SendQueue(
+                global_rate=self.global_rate_limit,
+                chat_rate=self.chat_rate_limit,
+                chat_burst=self.chat_burst,
+                group_rate=self.group_rate_limit,
+                group_burst=self.group_burst
+            )
+            self._processing_task = self._message_queue.start()
+        return self._message_queue
+
+    def _send_message_ordered(self, chat_id: int, send: Callable) -> asyncio.Future:
+        """Queues a message, messages of one chat are sent in order and within rate limits"""
+        if _running_loop() is None:
+            # a handler in a worker thread: the message is queued on the event loop of its update
+            return self._spawn(self._queue_message(chat_id, send))
+        return self._get_send_queue().put(chat_id, send)
 
-        await asyncio.sleep(0.3)  # Slight delay between messages
-        await self._current_context.bot.send_message(chat_id=chat_id, text=text)
+    async def _queue_message(self, chat_id: int, send: Callable):
+        return await self._get_send_queue().put(chat_id, send)
 
     def send_message(self, text: str, chat_id: int = None):
         """Orderly sending of messages"""
-        chat_id = chat_id or self._current_chat_id or self._tmp_chat_id
+        request = _current_request.get()
+
+        if request is not None:
+            chat_id = chat_id or request.chat_id
+            if request.outbox is not None:
+                # coalesce_messages (or a handler in a worker process): sent together at the end of the handler
+                request.outbox.append((chat_id, None, text))
+                return None
+            telegram_bot = request.context.bot
+        # outside of handlers we can send only to a known chat of a running bot
+        elif chat_id and self._application:
+            telegram_bot = self._application.bot
+        else:
+            return None
+
+        return self._send_message_ordered(
+            chat_id, lambda: telegram_bot.send_message(chat_id=chat_id, text=text)
+        )
+
+    """files"""
+
+    def send_photo(self, photo: str, caption: Optional[str] = None, chat_id: int = None):
+        """
+        Sends a photo in order with the messages of the chat
+        :param photo: path of a local file (uploaded once, then sent by its file_id), a file_id or a URL
+        """
+        return self._send_files(_FilesToSend("photo", [photo], caption, False), chat_id)
+
+    def send_document(self, document: str, caption: Optional[str] = None, chat_id: int = None):
+        """
+        Sends a document (PDF, archive ...) in order with the messages of the chat
+        :param document: path of a local file (uploaded once, then sent by its file_id), a file_id or a URL
+        """
+        return self._send_files(_FilesToSend("document", [document], caption, False), chat_id)
+
+    def send_media_group(self, files: List[str], kind: str = "photo", caption: Optional[str] = None,
+                         chat_id: int = None):
+        """
+        Sends 2-10 photos or documents as one album
+        :param files: paths of local files, file_ids or URLs
+        :param kind: "photo" or "document" (Telegram doesn't mix documents with photos in an album)
+        :param caption: text under the album (the caption of the first file)
+        """
+        if kind not in ("photo", "document"):
+            raise ValueError(f"Error send_media_group: unknown kind {kind!r}, use photo or document")
+        if not 2 <= len(files) <= 10:
+            raise ValueError("Error send_media_group: an album has 2 to 10 files")
+        return self._send_files(_FilesToSend(kind, list(files), caption, True), chat_id)
+
+    def _send_files(self, files: _FilesToSend, chat_id: Optional[int]):
+        request = _current_request.get()
+        if request is not None:
+            chat_id = chat_id or request.chat_id
+            if request.outbox is not None:
+                # coalesce_messages (or a handler in a worker process): sent at the end of the handler,
+                # in order with its messages
+                request.outbox.append((chat_id, None, files))
+                return None
+            telegram_bot = request.context.bot
+        # outside of handlers we can send only to a known chat of a running bot
+        elif chat_id and self._application:
+            telegram_bot = self._application.bot
+        else:
+            return None
+        return self._queue_files(telegram_bot, chat_id, files)
+
+    def _queue_files(self, telegram_bot, chat_id: int, files: _FilesToSend) -> asyncio.Future:
+        return self._send_message_ordered(chat_id, functools.partial(
+            self._send_file, telegram_bot, chat_id, files.kind, files.files, files.caption, files.group
+        ))
+
+    def _get_file_ids(self) -> _FileIds:
+        if self._file_ids is None:
+            self._file_ids = _FileIds(self.file_id_cache)
+        return self._file_ids
+
+    async def _send_file(self, telegram_bot, chat_id: int, kind: str, files: list, caption: Optional[str],
+                         group: bool):
+        """
+        Sends the files by their cached file_id, the ones without it are uploaded (streamed from disk)
+        and their file_id is cached. Called again by the send queue after a RetryAfter.
+        """
+        from telegram import InputFile, InputMediaDocument, InputMediaPhoto
+        from telegram.error import BadRequest
+
+        file_ids = self._get_file_ids()
+        keys = [await file_ids.key(kind, item) if os.path.isfile(item) else None for item in files]
+
+        for attempt in range(2):
+            media, uploads, handles, reused = [], [], [], False
+            try:
+                # the second attempt uploads everything: a cached file_id was refused
+                found = {}
+                if not attempt:
+                    # cached file_ids first, without waiting: a send that waits for the upload of another one while
+                    # holding an upload of its own deadlocks with an album of the same files in another order
+                    for key in keys:
+                        if key is not None and key not in found:
+                            found[key] = await file_ids.get(key, wait=False)
+                    missing = [key for key, file_id in found.items() if file_id is None]
+                    if missing and all(file_ids.uploading(key) for key in missing):
+                        # nothing to upload here, so the uploads in progress can be waited for
+                        for key in missing:
+                            found[key] = await file_ids.get(key)
+                for item, key in zip(files, keys):
+                    file_id = found.get(key)
+                    if key is None:
+                        media.append(item)  # file_id or URL, as it is
+                    elif file_id is not None:
+                        media.append(file_id)
+                        reused = True
+                    else:
+                        # read_file_handle=False: the handle goes to the HTTP client, which reads it in chunks
+                        handle = open(item, "rb")
+                        handles.append(handle)
+                        media.append(InputFile(handle, filename=os.path.basename(item), attach=group,
+                                               read_file_handle=False))
+                        if key not in uploads and not file_ids.uploading(key):
+                            file_ids.start_upload(key)
+                            uploads.append(key)
+
+                try:
+                    if group:
+                        wrap = InputMediaPhoto if kind == "photo" else InputMediaDocument
+                        result = await telegram_bot.send_media_group(chat_id, [
+                            wrap(item, caption=caption if index == 0 else None) for index, item in enumerate(media)
+                        ])
+                    elif kind == "photo":
+                        result = await telegram_bot.send_photo(chat_id, media[0], caption=caption)
+                    else:
+                        result = await telegram_bot.send_document(chat_id, media[0], caption=caption)
+                except BadRequest as e:
+                    if not reused or attempt:
+                        raise
+                    _log.info("Cached file_id refused (%s), uploading again", e)
+                    for key in keys:
+                        if key is not None:
+                            file_ids.forget(key)
+                    continue
+
+                for key, message in zip(keys, result if group else (result,)):
+                    if key in uploads:
+                        file_ids.finish_upload(key, _sent_file_id(message, kind))
+                return result
+            finally:
+                for handle in handles:
+                    handle.close()
+                for key in uploads:
+                    file_ids.finish_upload(key, None)  # no-op after a successful upload
+                file_ids.save()
+
+    def get_file_stats(self) -> dict:
+        """Files sent by send_photo / send_document / send_media_group: files (cached file_ids), uploaded, reused"""
+        if self._file_ids is None:
+            return {"files": 0, "uploaded": 0, "reused": 0}
+        return self._file_ids.stats()
+
+    def get_queue_depth(self, chat_id: int = None) -> int:
+        """Number of messages that are waiting to be sent (to one chat or to all chats)"""
+        if self._message_queue is None:
+            return 0
+        return self._message_queue.depth(chat_id)
+
+    def get_send_stats(self) -> dict:
+        """Counters of the outbound queue: queued, chats, in_flight, sent, failed, retried"""
+        if self._message_queue is None:
+            return {"queued": 0, "chats": 0, "in_flight": 0, "sent": 0, "failed": 0, "retried": 0}
+        return self._message_queue.stats()
+
+    async def wait_until_sent(self):
+        """Wait until every queued message is sent"""
+        if self._message_queue is not None:
+            await self._message_queue.join()
+
+    async def broadcast(self, text_or_builder: Union[str, Callable], chat_ids, concurrency: int = 20,
+                        checkpoint: Optional[str] = None, progress: Optional[Callable] = None,
+                        progress_interval: float = 5.0) -> dict:
+        """
+        Sends a message to many chats (the bot must be running)
+        :param text_or_builder: text or function(chat_id) -> text (can be async), None - skip the chat
+        :param chat_ids: iterable or async iterable of chat ids, read as the broadcast goes
+        :param concurrency: messages in flight at the same time (the speed is limited by global_rate_limit)
+        :param checkpoint: file with the progress, a broadcast that stopped continues from it when it is run
+        again with the same chat_ids (the messages that were in flight can be sent twice)
+        :param progress: function(stats) called every progress_interval seconds and at the end
+        :return: stats - position, sent, failed, blocked (users that blocked the bot), skipped, finished,
+        elapsed, per_second (messages sent per second by this run)
+        """
+        if concurrency < 1:
+            raise ValueError("Error broadcast: concurrency must be at least 1")
+        request = _current_request.get()
+        if request is not None:
+            telegram_bot = request.context.bot
+        elif self._application is not None:
+            telegram_bot = self._application.bot
+        else:
+            raise ValueError("Error broadcast: the bot is not running")
+
+        broadcast = _Broadcast(self._get_send_queue(), telegram_bot, text_or_builder, concurrency,
+                               checkpoint, progress, progress_interval)
+        return await broadcast.run(chat_ids)
+
+    """scheduler"""
+
+    def _get_scheduler(self) -> _Scheduler:
+        if self._scheduler is None:
+            self._scheduler = _Scheduler(self._send_scheduled, self.schedule_db)
+        if self._application is not None and _running_loop() is not None:
+            self._scheduler.start()  # before run() the jobs wait for _post_init
+        return self._scheduler
+
+    async def _send_scheduled(self, chat_id: int, text: Union[str, Callable]):
+        # the timer task can be started in a handler, this task has its own copy of the context
+        _current_request.set(None)
+        if callable(text):
+            text = text(chat_id)
+            if inspect.isawaitable(text):
+                text = await text
+            if text is None:
+                return
+        future = self.send_message(text, chat_id)
+        if future is not None:
+            await future
+
+    @staticmethod
+    def _job_time(at, after, where: str) -> float:
+        """Unix time of at (datetime or unix time) or of after (seconds or timedelta from now)"""
+        if (at is None) == (after is None):
+            raise ValueError(f"Error {where}: give either at or after")
+        if after is not None:
+            if isinstance(after, datetime.timedelta):
+                after = after.total_seconds()
+            return time.time() + after
+        if isinstance(at, datetime.datetime):
+            return at.timestamp()  # a naive datetime is local time
+        return float(at)
+
+    def _add_job(self, job: _Job, where: str) -> str:
+        loop = _running_loop()
+        request = _current_request.get()
+        if loop is None and request is not None:
+            if request.loop is None:
+                raise ValueError(f"Error {where}: not available in handlers that run in a worker process")
+            # a handler in a worker thread: the heap belongs to the event loop
+            request.loop.call_soon_threadsafe(lambda: self._get_scheduler().add(job))
+            return job.id
+        return self._get_scheduler().add(job)
+
+    def schedule_message(self, chat_id: int, text: Union[str, Callable], at=None, after=None,
+                         job_id: str = None) -> str:
+        """
+        Sends a message later (through the send queue, as send_message)
+        :param text: text or function(chat_id) -> text (can be async) called when it is time, None - nothing is sent
+        :param at: datetime or unix time
+        :param after: seconds or timedelta from now (give either at or after)
+        :param job_id: id for cancel_scheduled, a job with this id is replaced (random by default)
+        :return: job id
+        """
+        when = self._job_time(at, after, "schedule_message")
+        return self._add_job(_Job(job_id or os.urandom(8).hex(), chat_id, text, when, None), "schedule_message")
 
-        if hasattr(self, '_current_context') and self._current_context:
-            asyncio.create_task(self._send_message_ordered(chat_id, text, update=Update))
+    def every(self, chat_id: int, text: Union[str, Callable], interval, at=None, after=None,
+              job_id: str = None) -> str:
+        """
+        Sends a message every interval (seconds or timedelta), the first time at / after (by default after interval)
+        With schedule_db give the job a job_id: a job with the same id and settings keeps its schedule,
+        otherwise every start of the bot adds one more job
+        :return: job id
+        """
+        if isinstance(interval, datetime.timedelta):
+            interval = interval.total_seconds()
+        if not interval or interval <= 0:
+            raise ValueError("Error every: interval must be positive")
+        if at is None and after is None:
+            after = interval
+        when = self._job_time(at, after, "every")
+        return self._add_job(_Job(job_id or os.urandom(8).hex(), chat_id, text, when, float(interval)), "every")
+
+    def cancel_scheduled(self, job_id: str) -> bool:
+        """Cancels a job of schedule_message / every, False if there is no such job"""
+        if self._scheduler is None and not self.schedule_db:
+            return False
+        return self._get_scheduler().cancel(job_id)
+
+    def get_scheduler_stats(self) -> dict:
+        """Scheduled messages: pending, heap (entries with cancelled ones), dirty (not written), fired, sent, failed"""
+        if self._scheduler is None:
+            return {"pending": 0, "heap": 0, "dirty": 0, "fired": 0, "sent": 0, "failed": 0}
+        return self._scheduler.stats()
 
     async def stop(self):
         """Cleanup when bot stops"""
         self._should_process = False
 
-        # Canceling the message processing task
-        if self._processing_task:
-            self._processing_task.cancel()
+        # timers stop before the send queue, the jobs are written to schedule_db
+        if self._scheduler is not None:
             try:
-                await self._processing_task
-            except asyncio.CancelledError:
-                pass
+                await self._scheduler.close()
             except Exception as e:
-                if self.debug_LBF_and_code:
-                    print(f"Error stopping message processor: {e}")
+                _log.warning("Error stopping scheduler: %s", e)
+            self._scheduler = None
 
-        # Clearing the queue
-        if hasattr(self, '_message_queue') and self._message_queue:
-            while not self._message_queue.empty():
-                self._message_queue.get_nowait()
-                self._message_queue.task_done()
+        # Canceling the message processing task and clearing the queue
+        if self._message_queue is not None:
+            try:
+                await self._message_queue.close()
+            except Exception as e:
+                _log.warning("Error stopping message processor: %s", e)
 
         self._processing_task = None
         self._message_queue = None
 
+        if self._edit_manager is not None:
+            await self._edit_manager.close()
+            self._edit_manager = None
+
+        if self._metrics_server is not None:
+            await self._metrics_server.close()
+            self._metrics_server = None
+
+        if self._profile_log is not None:
+            self._profile_log.close()
+            self._profile_log = None
+
+        # the changed sessions are written before exit
+        if self._sessions is not None:
+            try:
+                await self._sessions.close()
+            except Exception as e:
+                _log.warning("Error closing sessions: %s", e)
+            self._sessions = None
+
+        # running handlers finish, the waiting ones are cancelled
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+
     def answer_message(self, text: str, chat_id: int = None):
         """Sends answer"""
-        if hasattr(self, '_current_update') and self._current_update:
+        request = _current_request.get()
+
+        if request is not None:
+            message = request.update.message
+            if request.outbox is not None:
+                # coalesce_messages (or a handler in a worker process): sent together at the end of the handler
+                request.outbox.append((chat_id or request.chat_id, message.message_id, text))
+                return None
+
             # if user input chat id
             if chat_id:
-                asyncio.create_task(
-                    self._current_context.bot.send_message(
+                telegram_bot = request.context.bot
+                return self._send_message_ordered(
+                    chat_id,
+                    lambda: telegram_bot.send_message(
                         chat_id=chat_id,
                         text=text,
-                        reply_to_message_id=self._current_update.message.message_id
+                        reply_to_message_id=message.message_id
                     )
                 )
             else:
-                asyncio.create_task(
-                    self._current_update.message.reply_text(
+                return self._send_message_ordered(
+                    request.chat_id,
+                    lambda: message.reply_text(
                         text=text,
-                        reply_to_message_id=self._current_update.message.message_id
+                        reply_to_message_id=message.message_id
                     )
                 )
         else:
             # else save msg for send later
             if chat_id:
-                if chat_id not in self.pending_message:
-                    self.pending_message[chat_id] = []
-                self.pending_message[chat_id].append(('answer', text))
+                self._queue_pending(chat_id, ('answer', text))
             else:
-                if not hasattr(self, '_msg_to_send_answer'):
+                if self._msg_to_send_answer is None:
                     self._msg_to_send_answer = []
                 self._msg_to_send_answer.append(text)
 
     async def _process_pending_message(self):
         """send all waiting messages"""
-        if not hasattr(self, '_current_update') or not self._current_update:
+        request = _current_request.get()
+        if request is None:
             return
 
-        current_chat_id = self._current_update.effective_chat.id or self._tmp_chat_id
+        current_chat_id = request.chat_id
+        message = request.update.message
+        answer_id = message.message_id if message else None
+
+        # take the queues before awaiting, concurrent updates must not send them twice
+        msg_to_send, self._msg_to_send = self._msg_to_send, None
+        msg_to_send_answer, self._msg_to_send_answer = self._msg_to_send_answer, None
+        chat_pending = self._take_pending(current_chat_id)
+        outbox, request.outbox = request.outbox, None
+
+        pending = []  # (chat_id, reply_to_message_id, text)
 
         # send without chat id
-        if hasattr(self, '_msg_to_send') and self._msg_to_send:
+        if msg_to_send:
             # if we use a func in send_message
-            if isinstance(self._msg_to_send, list):
-                for msg in self._msg_to_send:
-                    await self._current_update.message.reply_text(msg)
-                self._msg_to_send = None
+            if isinstance(msg_to_send, list):
+                for msg in msg_to_send:
+                    pending.append((current_chat_id, None, msg))
             # if no func
             else:
-                await self._current_update.message.reply_text(self._msg_to_send)
-                self._msg_to_send = None
+                pending.append((current_chat_id, None, msg_to_send))
 
         # send answer for msg
-        if hasattr(self, '_msg_to_send_answer') and self._msg_to_send_answer:
-            if isinstance(self._msg_to_send_answer, list):
-                for msg in self._msg_to_send_answer:
-                    await self._current_update.message.reply_text(
-                        text=msg,
-                        reply_to_message_id=self._current_update.message.message_id
-                    )
+        if msg_to_send_answer:
+            if isinstance(msg_to_send_answer, list):
+                for msg in msg_to_send_answer:
+                    pending.append((current_chat_id, answer_id, msg))
             else:
-                await self._current_update.message.reply_text(
-                    text=self._msg_to_send_answer,
-                    reply_to_message_id=self._current_update.message.message_id
-                )
-            self._msg_to_send_answer = None
+                pending.append((current_chat_id, answer_id, msg_to_send_answer))
 
         # send message for chat_id
-        if current_chat_id in self.pending_message:
-            for msg in self.pending_message[current_chat_id]:
+        if chat_pending:
+            for msg in chat_pending:
                 if isinstance(msg, tuple) and msg[0] == 'answer':
-                    await self._current_update.message.reply_text(
-                        text=msg[1],
-                        reply_to_message_id=self._current_update.message.message_id
-                    )
+                    pending.append((current_chat_id, answer_id, msg[1]))
                 else:
-                    await self._current_update.message.reply_text(msg)
+                    pending.append((current_chat_id, None, msg))
+
+        # messages of the handler (only when coalesce_messages is on)
+        if outbox:
+            pending.extend(outbox)
+
+        if not pending:
+            return
 
-            self.pending_message[current_chat_id] = []
+        if self.coalesce_messages:
+            pending = _coalesce_messages(pending)
+
+        telegram_bot = request.context.bot
+        sent = [
+            self._queue_files(telegram_bot, chat_id, text) if isinstance(text, _FilesToSend) else
+            self._send_message_ordered(
+                chat_id,
+                lambda chat_id=chat_id, reply_to=reply_to, text=text: telegram_bot.send_message(
+                    chat_id=chat_id, text=text, reply_to_message_id=reply_to
+                )
+            )
+            for chat_id, reply_to, text in pending
+        ]
+
+        # the queue keeps the order of every chat and sends different chats concurrently
+        await asyncio.gather(*sent, return_exceptions=True)
 
     """End Send And answer For Message and delete and edit"""
 
     """btn add"""
 
-    async def _refresh_interface(self, msg: str, clear_first: bool = True):
+    async def _refresh_interface(self, msg: str, clear_first: bool = True, reply_markup=None):
         """Refresh the current interface with updated buttons"""
         if not hasattr(self, '_current_update') or not self._current_update:
             return
 
         try:
-            # Get the message object
-            message = None
-            if self._current_update.message:
-                message = self._current_update.message
-            elif hasattr(self._current_update,
-                         'callback_query') and self._current_update.callback_query and self._current_update.callback_query.message:
-                message = self._current_update.callback_query.message
-
-            if not message:
-                return
-
-            # Create new keyboard markup
-            reply_markup = None
-            if self.buttons:
-                if self.inline:
-                    keyboard = [
-                        [InlineKeyboardButton(text, callback_data=data)
-                         for text, data in self.buttons if text.strip()]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                else:
-                    # For regular buttons
-                    keyboard = [[KeyboardButton(text)] for text, _ in self.buttons]
-                    reply_markup = ReplyKeyboardMarkup(
-                        keyboard,
-                        resize_keyboard=True,
-                        one_time_keyboard=False
-                    )
-
-            # For regular messages (not callback queries)
-            if not hasattr(self._current_update, 'callback_query'):
-                await message.reply_text(
+            update = self._current_update
+            query = update.callback_query
+
+            # For regular messages (not callback queries) the menu comes as a new message
+            if query is None:
+                if update.message is None:
+                    return
+                if reply_markup is None:
+                    reply_markup = self._get_markup(self.buttons, self.inline)
+                await update.message.reply_text(
                     text=msg,
                     reply_markup=reply_markup
                 )
-            else:
-                # For callback queries, edit the existing message
-                try:
-                    keyboard = [
-                        [InlineKeyboardButton(text, callback_data=data)
-                         for text, data in self.buttons if text.strip()]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await message.edit_text(
-                        text=msg,
-                        reply_markup=reply_markup
-                    )
-                except Exception as e:
-                    try:
-                        keyboard = [
-                            [InlineKeyboardButton(text, callback_data=data)
-                             for text, data in self.buttons if text.strip()]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await message.reply_text(
-                            text=msg,
-                            reply_markup=reply_markup
-                        )
-                    except Exception as e:
-                        if self.debug_LBF_and_code:
-                            print(f"Error editing message: {e}")
+            elif query.message is not None:
+                # For callback queries, edit the message with the buttons (only inline keyboards can be edited)
+                if reply_markup is None:
+                    reply_markup = self._get_markup(self.buttons, inline=True)
+                message = query.message
+                self._get_edit_manager().edit(
+                    (message.chat_id, message.message_id), msg, reply_markup,
+                    functools.partial(self._edit_or_reply, message)
+                )
 
         except Exception as e:
-            print(f"Error in _refresh_interface: {e}")
+            _log.error("Error in _refresh_interface: %s", e)
+
+    def _get_edit_manager(self) -> _EditManager:
+        if self._edit_manager is None:
+            self._edit_manager = _EditManager(self.edit_debounce)
+        return self._edit_manager
+
+    @staticmethod
+    async def _edit_or_reply(message, text: str, reply_markup):
+        from telegram.error import BadRequest
+
+        try:
+            await message.edit_text(text=text, reply_markup=reply_markup)
+        except BadRequest as e:
+            if "message is not modified" in str(e).lower():
+                raise
+            # the message can't be edited (deleted, too old, a photo), the menu comes as a new message
+            _log.debug("Error editing message: %s", e)
+            await message.reply_text(text=text, reply_markup=reply_markup)
+
+    def get_edit_stats(self) -> dict:
+        """Edits of inline menus: requested, sent, skipped (no change), superseded, cancelled (in flight), pending"""
+        if self._edit_manager is None:
+            return {"requested": 0, "sent": 0, "skipped": 0, "superseded": 0, "cancelled": 0, "pending": 0}
+        return self._edit_manager.stats()
 
     def add_buttons(self, message: str, buttons: list):
         if not message.strip():
             raise ValueError("Error add_button: please input a message")
 
-        # Setting the current state
-
-        self.buttons = []
-        self.inline = False
-
         # Processing the buttons
+        processed_buttons = []
         for btn in buttons:
             if isinstance(btn, tuple) and len(btn) == 2:
                 btn_text, handler = btn
-                self.buttons.append((btn_text, btn_text))
+                processed_buttons.append((btn_text, btn_text))
                 if btn_text.lower() not in self.message_callbacks:
-                    self.message_callbacks[btn_text.lower()] = (self._wrap_callback(handler), (), {})
+                    self.message_callbacks[btn_text.lower()] = (
+                        self._bind_handler(handler, where="add_buttons"), (), {}
+                    )
             else:
                 btn_text = btn[0] if isinstance(btn, tuple) else btn
-                self.buttons.append((btn_text, btn_text))
-                self.message_callbacks[btn_text.lower()] = (self._wrap_callback(lambda: None), (), {})
+                processed_buttons.append((btn_text, btn_text))
+                self.message_callbacks[btn_text.lower()] = (self._bind_handler(lambda: None), (), {})
+
+        # Setting the menu of the chat (outside of handlers - of all chats)
+        self._update_menu(buttons=self._intern_buttons(processed_buttons), inline=False)
 
         # Forced interface update
         if hasattr(self, '_current_update') and self._current_update:
             if self._current_update.message:
-                asyncio.create_task(self._show_buttons(message))
+                reply_markup = self._get_markup(self.buttons, inline=False)
+                self._spawn(self._show_buttons(message, reply_markup))
 
-    async def _show_buttons(self, message: str):
+    async def _show_buttons(self, message: str, reply_markup=None):
         """Shows buttons in the current chat"""
         try:
-            keyboard = [[KeyboardButton(text)] for text, _ in self.buttons]
-            reply_markup = ReplyKeyboardMarkup(
-                keyboard,
-                resize_keyboard=True,
-                one_time_keyboard=False
-            )
+            if reply_markup is None:
+                reply_markup = self._get_markup(self.buttons, inline=False)
 
             await self._current_update.message.reply_text(
                 text=message,
                 reply_markup=reply_markup
             )
         except Exception as e:
-            print(f"Error showing buttons: {e}")
+            _log.error("Error showing buttons: %s", e)
 
     def add_buttons_inline(self, message: str, buttons: list):
         """
@@ -440,42 +3598,18 @@ class TelegramBot:
         if not message.strip():
             raise ValueError("Error add_buttons_inline: please input a message")
 
-        # Save current message and buttons
-        self.start_message = message
-        self.buttons = []
-        self.buttons_handlers.clear()
-
-        # Process buttons with proper closure
-        for i, (btn_text, handler) in enumerate(buttons):
-            callback_data = f"btn_{i}"
-            self.buttons.append((btn_text, callback_data))
+        # Save current message (before the bot starts, in handlers only the menu of the chat changes)
+        if _current_request.get() is None:
+            self.start_message = message
 
-            # Create wrapper with proper closure
-            async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                              func=handler, cb_data=callback_data):
-                try:
-                    self._current_update = update
-                    self._current_context = context
-                    if update.callback_query and update.callback_query.message:
-                        self._current_chat_id = update.callback_query.message.chat_id
-
-                    # Execute handler
-                    if asyncio.iscoroutinefunction(func):
-                        await func()
-                    else:
-                        func()
-
-                    # Process pending messages
-                    await self._process_pending_message()
-                except Exception as e:
-                    if self.debug_LBF_and_code:
-                        print(f"Button handler error ({cb_data}): {e}")
-
-            self.buttons_handlers[callback_data] = wrapper
+        # Register the handlers under the id of the menu, the chat gets the buttons and the id
+        layout, menu_id = self._build_inline_menu(buttons)
+        self._update_menu(buttons=layout, inline=True, menu=menu_id)
 
         # Update interface immediately if there's an active chat
         if hasattr(self, '_current_update') and self._current_update:
-            asyncio.create_task(self._refresh_interface(message))
+            reply_markup = self._get_markup(layout, inline=True)
+            self._spawn(self._refresh_interface(message, reply_markup=reply_markup))
 
     """End add btn"""
 
@@ -483,39 +3617,51 @@ class TelegramBot:
 
     @property
     def get_user_full_name(self):
-        if self._current_user or self._tmp_full_name:
-            return self._tmp_full_name
+        user = self._current_user
+        if user:
+            return user.full_name
         return None
 
     def get_user_name(self):
-        if self._current_user or self._tmp_user_name:
-            return self._tmp_user_name
+        user = self._current_user
+        if user:
+            return user.first_name
 
         return None
 
     def get_user_id(self):
-        if self._current_user or self._tmp_user_id:
-            return self._tmp_user_id
+        user = self._current_user
+        if user:
+            return user.id
         return None
 
     def get_user_username(self):
-        if self._current_user or self._tmp_username:
-            return self._tmp_username
+        user = self._current_user
+        if user:
+            return user.username
         return None
 
     def get_user_chat_id(self):
-        if self._current_user or self._tmp_chat_id:
-            return self._tmp_chat_id
-        return None
+        return self._current_chat_id
+
+    def get_callback_payload(self) -> Optional[str]:
+        """Payload of the clicked inline button (the third item of the button), None if it has none"""
+        update = self._current_update
+        query = update.callback_query if update else None
+        if query is None or not query.data:
+            return None
+        parts = query.data.split(":", 2)
+        return parts[2] if len(parts) == 3 else None
 
     def get_user_info(self):
-        if self._current_user:
+        user = self._current_user
+        if user:
             res = f"""
     ======================================================================
-    User: {self._current_user.full_name}
-    ID: {self._current_user.id}
-    Chat_id: {self._tmp_chat_id}
-    Username: @{self._current_user.username}
+    User: {user.full_name}
+    ID: {user.id}
+    Chat_id: {self._current_chat_id}
+    Username: @{user.username}
     ======================================================================
                 """
             return res
@@ -524,132 +3670,220 @@ class TelegramBot:
     """start"""
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        try:
-            """get user data"""
-            self._tmp_username = update.effective_user.username
-            self._tmp_user_name = update.effective_user.first_name
-            self._tmp_full_name = update.effective_user.full_name
-            self._tmp_chat_id = update.effective_chat.id
-            self._tmp_user_id = update.effective_user.id
-
-            # get name user (if you need)
-            tmp_check_get_user = False
-
-            if "get_username" in self.start_message:
-                self.start_message = self.start_message.replace("get_username", self._tmp_username, 1)
-                tmp_check_get_user = True
-
-            if "get_user_name" in self.start_message:
-                self.start_message = self.start_message.replace("get_user_name", self._tmp_user_name, 1)
-                tmp_check_get_user = True
-
-            if "get_user_fullname" in self.start_message:
-                self.start_message = self.start_message.replace("get_user_fullname", self._tmp_full_name, 1)
-                tmp_check_get_user = True
-
-
-
-            # Restore initial state
-            if tmp_check_get_user:
-                pass
-            elif hasattr(self, '_initial_buttons'):
-                self.buttons = self._initial_buttons.copy()
-            elif hasattr(self, '_initial_buttons_inline'):
-                self.inline = self._initial_buttons_inline
-            elif hasattr(self, '_initial_start_message'):
-                self.start_message = self._initial_start_message
-
-            # for hint commands
-            if self.command_hints:
-                commands_list = []
-                for command, description in self.command_hints.items():
-                    if command in self.commands:
-                        commands_list.append(BotCommand(command[1:], description))
-                        if self.debug_LBF_and_code:
-                            print(f"Adding command: {command[1:]} - {description}")
-                    else:
-                        print(f"Warning: Command {command} has hint but no handler!")
-
-                if commands_list:
-                    try:
-                        await context.bot.set_my_commands(commands_list)
-                        if self.debug_LBF_and_code:
-                            print("Commands menu updated successfully from /start")
-                            print("Current commands:", [cmd.command for cmd in commands_list])
-                    except Exception as e:
-                        print(f"Failed to set commands from /start: {e}")
-                        if hasattr(e, 'message'):
-                            print(f"Error start details: {e.message}")
-                        else:
-                            print(f"Error start details: {str(e)}")
-
-            # For inline buttons
-            if self.inline and self.buttons:
-                keyboard = [
-                    [InlineKeyboardButton(text, callback_data=data)
-                     for text, data in self.buttons]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text(
-                    text=self.start_message,
-                    reply_markup=reply_markup
-                )
-            # For regular buttons
-            elif not self.inline and self.buttons:
-                keyboard = [[KeyboardButton(text)] for text, _ in self.buttons]
-                reply_markup = ReplyKeyboardMarkup(
-                    keyboard,
-                    resize_keyboard=True,
-                    one_time_keyboard=False
-                )
-                await update.message.reply_text(
-                    text=self.start_message,
-                    reply_markup=reply_markup
-                )
-            # No buttons
-            else:
-                await update.message.reply_text(self.start_message)
+        with self._request_scope(update, context, "/start") as request:
+            try:
+                # Restore initial state (the menu of start_bot / start_bot_btn / start_bot_btn_inline)
+                if self._initial_start_message is not None:
+                    self.start_message = self._initial_start_message
+                # menus are never changed in place, so the lists can be shared
+                if self._initial_buttons is not None and self._initial_buttons_inline:
+                    # the menu could leave the registry, register it again
+                    self._add_inline_menu(self._initial_inline_menu, self._initial_inline_handlers)
+                    self._update_menu(buttons=self._initial_buttons, inline=True, menu=self._initial_inline_menu)
+                elif self._initial_buttons is not None:
+                    self._update_menu(buttons=self._initial_buttons, inline=False)
+
+                # the hint commands are pushed to Telegram at startup and when they change (_sync_commands)
+
+                # placeholders (get_username, {chat_id}, ...) are filled for this user, start_message is not changed
+                text = self._get_start_template().render(request)
+
+                # For inline or regular buttons (the markup is prebuilt when the menu is registered)
+                if self.buttons:
+                    await update.message.reply_text(
+                        text=text,
+                        reply_markup=self._get_markup(self.buttons, self.inline)
+                    )
+                # No buttons
+                else:
+                    await update.message.reply_text(text)
 
-        except Exception as e:
-            print(f"Error in start handler: {e}")
-            await update.message.reply_text("An error occurred. Please try again.")
+            except Exception as e:
+                request.failed = True
+                _log.error("Error in start handler: %s", e)
+                await update.message.reply_text("An error occurred. Please try again.")
 
     async def button_click(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()  # Important to answer callback query first
 
-        self._current_update = update
-        self._current_context = context
-        self._current_chat_id = query.message.chat_id
-
-        callback_data = query.data
-
-        if callback_data in self.buttons_handlers:
-            try:
-                handler = self.buttons_handlers[callback_data]
-                await handler(update, context)
-            except Exception as e:
-                print(f"Error in button_click handler: {e}")
-                await query.message.reply_text("An error occurred while processing the command")
+        callback_data = query.data or ""
+
+        with self._request_scope(update, context, "button_click") as request:
+            handler = None
+            menu_id, separator, _ = callback_data.partition(":")
+            if separator:
+                # "<menu id>:<index>[:<payload>]" - the menu of the message that was clicked
+                handler = self._get_inline_menu(menu_id).get(callback_data)
+            if handler is None:
+                # callback_data of buttons_handlers that were set directly
+                handler = self.buttons_handlers.get(callback_data)
+            if handler is None and callback_data.startswith("btn_") and callback_data[4:].isdigit():
+                # "btn_<index>" of messages sent by older versions: the button of the current menu of the chat
+                handlers = list(self.buttons_handlers.values())
+                index = int(callback_data[4:])
+                handler = handlers[index] if index < len(handlers) else None
+            if handler is not None:
+                try:
+                    await handler(update, context)
+                except Exception as e:
+                    request.failed = True
+                    _log.error("Error in button_click handler: %s", e)
+                    await query.message.reply_text("An error occurred while processing the command")
 
     """Command if_message"""
 
-    def if_message(self, message: Union[str, List[str]], response: Union[Callable, str, None] = None, *args, **kwargs):
+    def if_message(self, message: Union[str, List[str]], response: Union[Callable, str, None] = None, *args,
+                   match: str = "exact", executor: Optional[str] = None, cache: Optional[float] = None,
+                   cache_key: str = "global", **kwargs):
+        """
+        React to a message
+        :param message: text or list of texts
+        :param response: text or function for the answer, without it returns True if the current message matches
+        :param match: "exact" (default), "prefix" - message starts with the text, "contains" - the text is
+        anywhere in the message, "regex" - regular expression (case-insensitive)
+        :param executor: where a plain def response runs: "loop", "thread" or "process" (default bot.executor)
+        :param cache: seconds the messages of the response function are kept and sent again without calling it
+        :param cache_key: "global" - one answer for everyone, "chat" - per chat, "user" - per user
+        """
+        if match != "exact" and match not in _PatternMatcher.KINDS:
+            raise ValueError(f"Error if_message: unknown match {match!r}, use exact, prefix, contains or regex")
+        cache_options = self._cache_options(response, cache, cache_key, "if_message")
+        response = self._with_executor(response, executor)
+
         if response is not None:
-            wrapped_response = self._wrap_callback(response)  # Wrapping the callback in our function
+            name = message if isinstance(message, str) else message[0]
+            entry = (self._cache_handler(self._bind_response(response, args, kwargs), cache_options, name),
+                     args, kwargs)
+
+        if response is not None and match != "exact":
+            for msg in (message if isinstance(message, list) else [message]):
+                self._patterns.add(match, msg, entry)
+        elif response is not None:
 
             if isinstance(message, list):  # If message is a list of words
                 for msg in message:
-                    self.message_callbacks[msg.lower()] = (self._wrap_callback(response), args, kwargs)
+                    self.message_callbacks[msg.lower()] = entry
             else:
-                self.message_callbacks[message.lower()] = (response, args, kwargs)
+                self.message_callbacks[message.lower()] = entry
         # if there is no message verification
+        elif match != "exact":
+            text = self.current_user_text
+            if text is None:
+                return False
+            return any(_matches_text(match, msg, text)
+                       for msg in (message if isinstance(message, list) else [message]))
         else:
             if isinstance(message, list):
-                return self.current_user_text in [m.lower() for m in message]
+                # the same (unchanged) list object is usually passed every time, look it up by identity first
+                cached = self._keyword_sets.get(id(message))
+                if cached is not None and cached[0] is message:
+                    keywords = cached[1]
+                else:
+                    key = tuple(message)
+                    keywords = self._keyword_sets.get(key)
+                    if keywords is None:
+                        keywords = frozenset(m.lower() for m in message)
+                    if len(self._keyword_sets) >= 1024:
+                        self._keyword_sets.clear()
+                    self._keyword_sets[key] = keywords
+                    # keep a reference to the list, so its id can't be reused by another list
+                    self._keyword_sets[id(message)] = (message, keywords)
+                return self.current_user_text in keywords
             else:
                 return self.current_user_text == message.lower()
 
+    def _bind_response(self, response: Union[Callable, str], args: tuple, kwargs: dict):
+        """A text as it is, a function bound once: async def gets (update, context, *args), def gets (*args)"""
+        if not callable(response):
+            return response
+        modes = ("full", "none") if asyncio.iscoroutinefunction(response) else ("args", "none")
+        return self._bind_handler(response, args, kwargs, modes, where="if_message")
+
+    """response cache"""
+
+    def cache_response(self, ttl: float, key: str = "global", maxsize: Optional[int] = None):
+        """
+        Decorator: the messages the handler sends are kept and sent again without calling it
+        (the same as cache= of if_message / add_command)
+        :param ttl: seconds the messages are kept
+        :param key: "global" - one answer for everyone, "chat" - per chat, "user" - per user
+        :param maxsize: answers kept, the least recently used leave first (default bot.response_cache_size)
+        """
+        self._cache_options(lambda: None, ttl, key, "cache_response")
+
+        def decorator(func: Callable) -> Callable:
+            func._response_cache = (ttl, key, maxsize)
+            return func
+        return decorator
+
+    @staticmethod
+    def _cache_options(func, ttl: Optional[float], key: str, where: str) -> Optional[tuple]:
+        """(ttl, key, maxsize) of a handler: cache= of the registration or the cache_response decorator"""
+        if ttl is None:
+            return getattr(func, "_response_cache", None)
+        if not callable(func):
+            raise ValueError(f"Error {where}: cache is for functions, a text answer is already sent as it is")
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+            raise ValueError(f"Error {where}: cache must be a positive number of seconds")
+        if key not in _ResponseCache.KEYS:
+            raise ValueError(f"Error {where}: unknown cache key {key!r}, use global, chat or user")
+        return ttl, key, None
+
+    def _cache_handler(self, invoke, options: Optional[tuple], name: str):
+        """invoke(update, context) that sends the cached messages of the handler (invoke itself without a cache)"""
+        if options is None or not callable(invoke):
+            return invoke
+        ttl, key, maxsize = options
+        cache = _ResponseCache(ttl, key, maxsize or self.response_cache_size)
+        self._response_caches[name] = cache
+        warned = False
+
+        async def cached(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            nonlocal warned
+            request = _current_request.get()
+            messages = await cache.get(cache.key_of(request),
+                                       functools.partial(self._capture_messages, invoke, update, context))
+            if not messages and not warned:
+                warned = True
+                _log.warning("Cache of %s: the handler sent nothing with answer_message / send_message, "
+                             "its answers are not cached", name)
+            for reply, chat_id, text in messages:
+                if isinstance(text, _FilesToSend):
+                    self._send_files(text, chat_id)
+                elif reply:
+                    self.answer_message(text, chat_id)
+                else:
+                    self.send_message(text, chat_id)
+        cached.label = invoke.label
+        return cached
+
+    async def _capture_messages(self, invoke, update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple:
+        """Calls the handler and returns what it sent: (reply, chat_id - None for the chat of the update, text)"""
+        request = _current_request.get()
+        outbox, request.outbox = request.outbox, []
+        try:
+            await invoke(update, context)
+            captured = request.outbox
+        finally:
+            request.outbox = outbox
+        return tuple((reply_to is not None, None if chat_id == request.chat_id else chat_id, text)
+                     for chat_id, reply_to, text in captured)
+
+    def get_cache_stats(self) -> dict:
+        """Response caches: hits, misses, shared (waited for another update), size and the same per handler"""
+        stats = {"hits": 0, "misses": 0, "shared": 0, "size": 0, "handlers": {}}
+        for name, cache in self._response_caches.items():
+            stats["handlers"][name] = cache_stats = cache.stats()
+            for field, value in cache_stats.items():
+                stats[field] += value
+        return stats
+
+    def clear_response_cache(self):
+        """Forget the cached answers (for example after the prices changed)"""
+        for cache in self._response_caches.values():
+            cache.clear()
+
     """default message"""
 
     def set_default_message(self, message: str, is_def_send_msg: bool = False, reply_msg_user: bool = False):
@@ -659,49 +3893,51 @@ class TelegramBot:
 
     """add command"""
 
-    def add_command(self, command: str, answer: Union[Callable, str, None] = None, *args, **kwargs):
+    def add_command(self, command: str, answer: Union[Callable, str, None] = None, *args,
+                    executor: Optional[str] = None, cache: Optional[float] = None, cache_key: str = "global",
+                    **kwargs):
         """
         Adds a simple command that outputs text
         :param command: command name(for example "/help")
         :param answer: text to output when the command is invoked
+        :param executor: where a plain def answer runs: "loop", "thread" or "process" (default bot.executor)
+        :param cache: seconds the messages of the answer function are kept and sent again without calling it
+        :param cache_key: "global" - one answer for everyone, "chat" - per chat, "user" - per user
         """
         if not command.startswith('/'):
             command = '/' + command
+        cache_options = self._cache_options(answer, cache, cache_key, "add_command")
+        answer = self._with_executor(answer, executor)
+        # for func that expect update/context or func without parameters, resolved once
+        invoke = self._bind_handler(answer, args, kwargs, where="add_command") if callable(answer) else None
+        invoke = self._cache_handler(invoke, cache_options, command)
 
         """handler for command"""
 
         async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            self._current_update = update
-            self._current_context = context
-
-            if callable(answer):
-                try:
-                    # for func that expect update/context
-                    if asyncio.iscoroutinefunction(answer):
-                        await answer(update, context, *args, **kwargs)
-                    else:
-                        answer(update, context, *args, **kwargs)
-                except TypeError:
-                    # for func without parameters
-                    if asyncio.iscoroutinefunction(answer):
-                        await answer()
-                    else:
-                        answer()
+            with self._request_scope(update, context, command):
+                if invoke is not None:
+                    await invoke(update, context)
 
-            elif isinstance(answer, str):
-                await update.message.reply_text(answer)
+                elif isinstance(answer, str):
+                    await update.message.reply_text(answer)
 
-            await self._process_pending_message()
+                await self._process_pending_message()
 
         self.commands[command] = command_handler
+        self._commands_changed()
 
     """add hint command"""
 
-    def add_hint_command(self, command: str, info: str):
+    def add_hint_command(self, command: str, info: str, scope: Union[str, BotCommandScope, None] = None,
+                         language_code: Optional[str] = None):
         """
         Adds a hint for the command
         :param command: the name of the command (for example "/info")
         :param info: description of the hint command
+        :param scope: who sees the hint: None or "default" (everyone), "all_private_chats", "all_group_chats",
+        "all_chat_administrators" or a telegram BotCommandScope (for example BotCommandScopeChat(chat_id))
+        :param language_code: two-letter language of the users who see the hint (None - all languages)
         """
         if not command.startswith('/'):
             command = '/' + command
@@ -716,90 +3952,358 @@ class TelegramBot:
         if len(info) < 3 or len(info) > 256:
             raise ValueError("Error add_hint_command: description must be between 3 and 256 characters long.")
 
-        self.command_hints[command] = info
+        if scope == "default":
+            scope = None
+        elif isinstance(scope, str) and scope not in self._COMMAND_SCOPES:
+            raise ValueError(f"Error add_hint_command: unknown scope {scope!r}")
+        if scope is None and language_code is None:
+            self.command_hints[command] = info
+        else:
+            self._scoped_command_hints.setdefault((scope, language_code), {})[command] = info
+        self._commands_changed()
+
+    """command menu"""
+
+    # scope names of add_hint_command -> telegram classes, the scope objects are made when the menu is pushed
+    _COMMAND_SCOPES = {
+        "all_private_chats": "BotCommandScopeAllPrivateChats",
+        "all_group_chats": "BotCommandScopeAllGroupChats",
+        "all_chat_administrators": "BotCommandScopeAllChatAdministrators",
+    }
+
+    def _command_menus(self) -> dict:
+        """(scope, language_code) -> list of BotCommand for every menu of the bot"""
+        from telegram import BotCommand
+
+        menus = {}
+        for key, hints in [((None, None), self.command_hints), *self._scoped_command_hints.items()]:
+            commands_list = []
+            for command, description in hints.items():
+                if command in self.commands:
+                    commands_list.append(BotCommand(command[1:], description))
+                else:
+                    _log.warning("Command %s has hint but no handler!", command)
+            menus[key] = commands_list
+        return menus
+
+    async def _sync_commands(self, telegram_bot):
+        """Push the menus that changed since the last push, the others are skipped"""
+        async with self._command_sync_lock:
+            for (scope, language_code), commands_list in self._command_menus().items():
+                key = (scope, language_code)
+                content = json.dumps([(cmd.command, cmd.description) for cmd in commands_list])
+                digest = hashlib.sha256(content.encode()).hexdigest()
+                # an empty scoped menu that was never pushed has nothing to clear, but the default menu
+                # may still have the commands of a previous deployment
+                if self._pushed_menus.get(key) == digest or (
+                        not commands_list and key not in self._pushed_menus and key != (None, None)):
+                    self._command_sync_stats["skipped"] += 1
+                    continue
+
+                if isinstance(scope, str):
+                    import telegram
+                    scope = getattr(telegram, self._COMMAND_SCOPES[scope])()
+                try:
+                    if commands_list:
+                        await telegram_bot.set_my_commands(commands_list, scope=scope, language_code=language_code)
+                    else:
+                        await telegram_bot.delete_my_commands(scope=scope, language_code=language_code)
+                except Exception as e:
+                    self._command_sync_stats["failed"] += 1
+                    _log.error("Failed to set commands: %s", e)
+                    continue
+
+                self._pushed_menus[key] = digest
+                self._command_sync_stats["pushed"] += 1
+                _log.debug("Commands menu updated (%s, %s): %s", scope, language_code,
+                           [cmd.command for cmd in commands_list])
+
+    def _commands_changed(self):
+        """Commands or hints changed: a running bot pushes the menu again (if its content changed)"""
+        application = self._application
+        if application is None or not application.running:
+            return
+        if _running_loop() is not None:
+            self._spawn(self._sync_commands(application.bot))
+        elif self._loop is not None:
+            # another thread (a thread pool handler, a script): the push runs on the loop of the bot
+            self._loop.call_soon_threadsafe(lambda: self._spawn(self._sync_commands(application.bot)))
+
+    def get_command_sync_stats(self) -> dict:
+        """Pushes of the command menu: pushed, skipped (menu didn't change), failed"""
+        return dict(self._command_sync_stats)
 
     """Text Message Handler"""
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.current_user_text = update.message.text.lower()
-
-        self._current_update = update
-        self._current_context = context
-        self._current_user = update.effective_user
-
-        """check debug user"""
-        if self.debug_user_data:
-            user = update.effective_user
-            user_info = (
-                f"User: {user.full_name}\n",
-                f"ID: {user.id}\n",
-                f"Chat_id: {update.effective_chat.id}",
-                f"Username: @{user.username}" if user.username else "Username: Not specified"
-            )
-            print("\n" + "=" * 70)
-            print(user_info)
-            print("=" * 70 + "\n")
-
-        # We check the handlers in order of priority:
-        # 1. First, the button handlers
-        # 2. Then the if_message handlers
-        # 3. At the end, the default message is
-
-        # Check if the message is the text of the button
-        is_button_text = any(text.lower() == self.current_user_text for text, _ in self.buttons)
-
-        if is_button_text and self.current_user_text in self.message_callbacks:
-            # handler click button
-            response, args, kwargs = self.message_callbacks[self.current_user_text]
-            await self._process_response(response, args, kwargs)
-        elif self.current_user_text in self.message_callbacks:
-            # handler message with if_message
-            response, args, kwargs = self.message_callbacks[self.current_user_text]
-            await self._process_response(response, args, kwargs)
-        elif self.default_message is not None:
-            # default message
-            if self.is_default_send_msg and self.repl_msg_user:
-                await update.message.reply_text(
-                    text=self.default_message,
-                    reply_to_message_id=update.message.message_id
-                )
-            elif self.is_default_send_msg:
-                await update.message.reply_text(self.default_message)
-            else:
-                print(self.default_message)
+        with self._request_scope(update, context, "default_message") as request:
+            request.user_text = update.message.text.lower()
+
+            """check debug user"""
+            if self.debug_user_data:
+                user = update.effective_user
+                _log.info("User: %s, ID: %s, Chat_id: %s, Username: %s", user.full_name, user.id,
+                          update.effective_chat.id, f"@{user.username}" if user.username else "Not specified")
+
+            # We check the handlers in order of priority:
+            # 1. First, the button handlers
+            # 2. Then the if_message handlers
+            # 3. At the end, the default message is
+
+            entry = self._match_message(request.user_text)
+
+            if entry is not None:
+                # handler click button or handler message with if_message
+                response, args, kwargs = entry
+                request.handler = response.label if callable(response) else "if_message"
+                await self._process_response(response, args, kwargs)
+            elif self.default_message is not None:
+                # default message
+                if self.is_default_send_msg and self.repl_msg_user:
+                    await update.message.reply_text(
+                        text=self.default_message,
+                        reply_to_message_id=update.message.message_id
+                    )
+                elif self.is_default_send_msg:
+                    await update.message.reply_text(self.default_message)
+                else:
+                    _log.info("%s", self.default_message)
 
-        await self._process_pending_message()
+            await self._process_pending_message()
+
+    def _match_message(self, text: str):
+        """
+        (response, args, kwargs) for a lowercased message or None, response is a text or a bound handler
+        Exact texts (buttons and if_message share message_callbacks) are found in O(1),
+        then prefix, contains and regex rules.
+        """
+        entry = self.message_callbacks.get(text)
+        if entry is None and len(self._patterns):
+            entry = self._patterns.match(text)
+        return entry
 
     async def _process_response(self, response, args, kwargs):
-        """handler response from message_callbacks"""
+        """handler response from message_callbacks (functions are bound with their args at registration)"""
         if callable(response):
-            try:
-                if asyncio.iscoroutinefunction(response):
-                    await response(self._current_update, self._current_context, *args, **kwargs)
-                else:
-                    response(*args, **kwargs)
-            except TypeError:
-                if asyncio.iscoroutinefunction(response):
-                    await response()
-                else:
-                    response()
+            request = _current_request.get()
+            await response(request.update, request.context)
         elif isinstance(response, str):
             await self._current_update.message.reply_text(response)
 
-    """run"""
+    """admission of updates"""
 
-    def run(self):
-        if not self.token:
-            return ValueError("Token is not set")
+    def _update_priority(self, update: Update) -> int:
+        """Priority of an update by its kind (bot.update_priorities): start, callback, command or message"""
+        if update.callback_query is not None:
+            kind = "callback"
+        else:
+            text = update.message.text if update.message is not None else None
+            if text and text.startswith("/"):
+                kind = "start" if text.split(maxsplit=1)[0].split("@")[0] == "/start" else "command"
+            else:
+                kind = "message"
+        return self.update_priorities.get(kind, 2)
+
+    def _on_shed(self, update: Update, reason: str):
+        """An update is not handled (queue is full, flood of the chat or waited too long)"""
+        chat = update.effective_chat
+        _log.debug("Update %s of chat %s is shed: %s", update.update_id, chat.id if chat else None, reason)
+        if self.busy_message is None or chat is None or self._application is None:
+            return
 
-        print("Bot starting...")
-        application = Application.builder().token(self.token).build()
+        # one busy reply per chat in 10 seconds, the replies go through the send queue and its limits
+        now = time.monotonic()
+        if now - self._busy_replies.get(chat.id, -10.0) < 10:
+            return
+        if len(self._busy_replies) >= 1024:
+            self._busy_replies.clear()
+        self._busy_replies[chat.id] = now
 
+        telegram_bot = self._application.bot
+        query = update.callback_query
+        if query is not None:
+            # stops the spinner of the button
+            future = asyncio.ensure_future(telegram_bot.answer_callback_query(query.id, text=self.busy_message))
+        else:
+            future = self._send_message_ordered(
+                chat.id, lambda: telegram_bot.send_message(chat_id=chat.id, text=self.busy_message)
+            )
+        future.add_done_callback(_silence_exception)
+
+    def get_admission_stats(self) -> dict:
+        """
+        Incoming updates: queued, running, admitted, duplicates, shed (shed_full, shed_flood, shed_stale)
+        and by_priority - {priority: queued}
+        """
+        if self._admission is None:
+            return {"queued": 0, "running": 0, "admitted": 0, "duplicates": 0, "shed": 0,
+                    "shed_full": 0, "shed_flood": 0, "shed_stale": 0, "by_priority": {}}
+        return self._admission.stats()
+
+    """metrics"""
+
+    def _metric_gauges(self) -> dict:
+        application = self._application
+        return {
+            "send_queue_depth": self.get_queue_depth(),
+            "update_queue_depth": application.update_queue.qsize() if application else 0,
+        }
+
+    def _metric_counters(self) -> dict:
+        admission = self.get_admission_stats()
+        return {
+            "updates_shed_total": ("reason", {reason: admission[f"shed_{reason}"]
+                                              for reason in ("full", "flood", "stale")}),
+            "updates_duplicate_total": admission["duplicates"],
+        }
+
+    def get_metrics(self) -> dict:
+        """
+        Snapshot of the metrics: updates, updates_per_s, send_queue_depth, update_queue_depth,
+        handlers and api - {name: {calls, errors, seconds, avg_ms, p50_ms, p99_ms, buckets}}
+        (p50 / p99 are the upper bounds of their histogram buckets), admission - get_admission_stats()
+        """
+        metrics = self._metrics.snapshot()
+        metrics.update(self._metric_gauges())
+        metrics["admission"] = self.get_admission_stats()
+        return metrics
+
+    async def _serve_metrics(self, method: str, path: str, headers: dict, body: bytes):
+        if path != "/metrics":
+            return 404, b"", "text/plain"
+        if method != "GET":
+            return 405, b"", "text/plain"
+        text = self._metrics.render(self._metric_gauges(), self._metric_counters())
+        return 200, text.encode(), "text/plain; version=0.0.4; charset=utf-8"
+
+    async def _start_metrics_server(self):
+        if self.metrics_port is None or self._metrics_server is not None:
+            return
+        self._metrics_server = _HttpServer(self._serve_metrics, max_connections=4)
+        await self._metrics_server.start(self.metrics_listen, self.metrics_port)
+        _log.info("Metrics on http://%s:%s/metrics", self.metrics_listen, self._metrics_server.port)
+
+    """profiler"""
+
+    def profile_next(self, updates: int = 1):
+        """Profile the next updates and write all of them to profile_file, whatever their time"""
+        self._profile_next = updates
+
+    def _start_profile(self) -> Optional[tuple]:
+        """(profile, started, forced) if this update is profiled"""
+        if self._profiler_busy:
+            return None  # one profile at a time, the others would mix into it
+        forced = self._profile_next > 0
+        if not forced and (self.profile_threshold is None or random.random() >= self.profile_sample_rate):
+            return None
+        if self._admission is not None and self._admission.workers > 1:
+            # cProfile stays on across awaits: the updates that run meanwhile would be blamed on this one
+            self._warn_profiler_concurrent()
+            return None
+
+        import cProfile
+
+        profile = cProfile.Profile()
         try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            profile.enable()
+        except ValueError:
+            return None  # another profiler or a debugger is active
+        if forced:
+            self._profile_next -= 1
+        self._profiler_busy = True
+        return profile, time.perf_counter(), forced
+
+    def _finish_profile(self, state: tuple, request: _RequestContext):
+        profile, started, forced = state
+        profile.disable()
+        self._profiler_busy = False
+
+        elapsed = time.perf_counter() - started
+        threshold = self.profile_threshold
+        if not forced and (threshold is None or elapsed < threshold):
+            return
+
+        update = request.update
+        if update.callback_query is not None:
+            text = update.callback_query.data
+        else:
+            text = update.message.text if update.message else None
+        header = (f"{datetime.datetime.now().isoformat(timespec='seconds')} {request.handler} "
+                  f"{elapsed * 1000:.1f} ms, chat {request.chat_id}, text {text!r}")
+
+        if self._profile_log is None:
+            self._profile_log = logging.handlers.RotatingFileHandler(
+                self.profile_file, maxBytes=self.profile_file_size, backupCount=self.profile_file_count,
+                encoding="utf-8", delay=True
+            )
+        loop = _running_loop()
+        if loop is None:
+            self._write_profile(profile, header)
+            return
+        # the statistics are sorted and written in a thread, the updates go on
+        future = loop.run_in_executor(None, self._write_profile, profile, header)
+        future.add_done_callback(_silence_exception)
+
+    def _write_profile(self, profile: cProfile.Profile, header: str):
+        import io
+        import pstats
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(self.profile_top)
+        self._profile_log.handle(logging.makeLogRecord({"msg": f"{header}\n{stream.getvalue()}"}))
+
+    """run"""
+
+    async def _post_init(self, application: Application):
+        self._loop = asyncio.get_running_loop()
+        if self._initial_buttons:
+            self._get_markup(self._initial_buttons, bool(self._initial_buttons_inline))  # prebuilt for /start
+        await self._start_metrics_server()
+        if self._scheduler is not None or self.schedule_db:
+            self._get_scheduler()  # starts the timers of the jobs added before run() and of schedule_db
+        await self._sync_commands(application.bot)
+
+    async def _post_shutdown(self, application: Application):
+        await self.stop()
+
+    def _warn_profiler_concurrent(self):
+        if not self._profiler_concurrent:
+            self._profiler_concurrent = True
+            _log.warning("Profiler is off: updates are handled concurrently (concurrent_updates, run_webhook "
+                         "by default), use run() or concurrent_updates=False to profile")
+
+    def _build_application(self, concurrent_updates: Union[bool, int] = False) -> Application:
+        """Application with all handlers of the bot (the same for polling and webhook)"""
+        from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+        _start_logging("DEBUG" if self.debug_LBF_and_code else self.log_level, self.log_format, self.log_file,
+                       self.log_repeat_interval)
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .concurrent_updates(concurrent_updates)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+        )
+        if self.base_url:
+            builder = builder.base_url(self.base_url)
+        if self.shed_policy not in ("oldest", "newest"):
+            raise ValueError(f"Error shed_policy: unknown policy {self.shed_policy!r}, use oldest or newest")
+        self._admission = _AdmissionQueue(
+            self._update_priority, self._on_shed, limit=self.max_update_queue, policy=self.shed_policy,
+            chat_rate=self.chat_update_rate, chat_burst=self.chat_update_burst, max_wait=self.update_max_wait
+        )
+        builder = builder.update_queue(self._admission)
+        builder = (
+            builder
+            .request(self._make_request(self.connection_pool_size))
+            .get_updates_request(self._make_request(self.get_updates_pool_size))
+        )
+        application = builder.build()
+        self._application = application
+        self._admission.workers = application.update_processor.max_concurrent_updates
+        if self.profile_threshold is not None and self._admission.workers > 1:
+            self._warn_profiler_concurrent()
 
         # add handle command
         for command, handler in self.commands.items():
@@ -808,10 +4312,128 @@ class TelegramBot:
         application.add_handler(CommandHandler("start", self.start))
         application.add_handler(CallbackQueryHandler(self.button_click))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        return application
+
+    def _make_request(self, pool_size: int):
+        """HTTPXRequest with the connection settings of the bot (and the latency of every call in the metrics)"""
+        import httpx
+        from telegram.request import HTTPXRequest
+
+        if pool_size < 1:
+            raise ValueError(f"Error connection_pool_size: the pool needs at least one connection, got {pool_size}")
+        keepalive = pool_size if self.keepalive_connections is None else min(self.keepalive_connections, pool_size)
+        options = dict(
+            connection_pool_size=pool_size,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            write_timeout=self.write_timeout,
+            media_write_timeout=self.media_write_timeout,
+            pool_timeout=self.pool_timeout,
+            http_version="2" if self.http2 else "1.1",
+            httpx_kwargs={"limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=keepalive,
+                                                 keepalive_expiry=self.keepalive_expiry)},
+        )
+        if self.collect_metrics:
+            return _timed_request_class()(self._metrics, **options)
+        return HTTPXRequest(**options)
+
+    def run(self, concurrent_updates: Union[bool, int] = False):
+        """
+        Start the bot (long polling)
+        :param concurrent_updates: True or the number of updates that are handled at the same time,
+        so one slow handler doesn't stall other chats
+        """
+        if not self.token:
+            return ValueError("Token is not set")
+
+        application = self._build_application(concurrent_updates)  # the logging starts here
+        _log.info("Bot starting...")
 
-        print("the bot is running")
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+        _log.info("the bot is running")
         application.run_polling()
 
+    async def _serve_webhook(self, application: Application, url: Optional[str], listen: str, port: int,
+                             path: str, secret_token: Optional[str], max_connections: int,
+                             started: Optional[asyncio.Future] = None):
+        """Run the application with the built-in webhook receiver until cancelled"""
+        from telegram import Update
+
+        server = _HttpServer(
+            _WebhookReceiver(application, path, secret_token),
+            max_connections=max_connections
+        )
+        async with application:
+            await self._post_init(application)  # post_init is called only by run_polling / run_webhook of the application
+            await application.start()
+            try:
+                await server.start(listen, port)
+                if url:
+                    await application.bot.set_webhook(
+                        url=url,
+                        secret_token=secret_token,
+                        max_connections=max_connections,
+                        allowed_updates=Update.ALL_TYPES
+                    )
+                if started is not None:
+                    started.set_result(server.port)
+                await asyncio.Event().wait()  # serve until cancelled
+            finally:
+                await server.close()
+                await application.stop()
+                await self.stop()
+
+    def run_webhook(self, url: Optional[str] = None, listen: str = "0.0.0.0", port: int = 8443,
+                    path: Optional[str] = None, secret_token: Optional[str] = None,
+                    max_connections: int = 40, concurrent_updates: Union[bool, int] = True):
+        """
+        Start the bot with a webhook: Telegram sends updates to our HTTP server (no polling delay)
+        :param url: public https url for Telegram (for example "https://example.com/bot"), None - don't call setWebhook
+        (the webhook is set already, or the bot is behind a proxy that does it)
+        :param listen: address of the HTTP server
+        :param port: port of the HTTP server (behind a reverse proxy with TLS)
+        :param path: path of the webhook, by default the path of url or "/"
+        :param secret_token: Telegram sends it in every request, other requests are rejected
+        :param max_connections: requests that are handled at the same time (also sent to Telegram)
+        :param concurrent_updates: True or the number of updates that are handled at the same time
+        (False - one by one, the profiler works only then)
+        """
+        if not self.token:
+            return ValueError("Token is not set")
+
+        if path is None:
+            path = urlsplit(url).path if url else ""
+        path = "/" + path.lstrip("/")
+
+        application = self._build_application(concurrent_updates)  # the logging starts here
+        _log.info("Bot starting...")
+
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
 
-"""For use bot. Example: bot.start()"""
-bot = TelegramBot()
+        _log.info("the bot is running (webhook on %s:%s%s)", listen, port, path)
+        task = loop.create_task(
+            self._serve_webhook(application, url, listen, port, path, secret_token, max_connections)
+        )
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+
+def __getattr__(name: str):
+    """For use bot. Example: bot.start() - the bot is created on first use, so importing the module costs nothing"""
+    if name == "bot":
+        global bot
+        bot = TelegramBot()
+        return bot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,93 @@
+"""
+Broadcast to many chats against the fake Bot API.
+
+Part of the users have blocked the bot and Telegram asks to wait once in the
+middle (RetryAfter). With --crash-at the broadcast is cancelled after that many
+messages and run again from its checkpoint, as after a crash. Prints the
+throughput, the counters and how many messages were sent twice.
+
+    python benchmarks/bench_broadcast.py --chats 20000 --rate 1000
+    python benchmarks/bench_broadcast.py --chats 5000 --rate 30 --crash-at 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+async def subscribers(chats: int):
+    # as if they were read from a database
+    for chat_id in range(1, chats + 1):
+        if chat_id % 1000 == 0:
+            await asyncio.sleep(0)
+        yield chat_id
+
+
+async def run(chats: int, rate: float, concurrency: int, blocked_every: int, crash_at: int):
+    api = FakeBotApi()
+    port = await api.start()
+    api.blocked_chats = set(range(blocked_every, chats + 1, blocked_every))
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = rate
+    bot.chat_rate_limit = bot.group_rate_limit = None
+    application = bot._build_application()
+    await application.initialize()
+
+    checkpoint = os.path.join(tempfile.mkdtemp(), "broadcast.json")
+
+    def on_call(method, params):
+        if method == "sendMessage" and len(api.calls) == chats // 2:
+            api.flood_wait(1)
+
+    api.listeners.append(on_call)
+
+    def progress(stats):
+        print(f"  {stats['position']:>7} done, {stats['sent']:>7} sent, {stats['blocked']:>5} blocked, "
+              f"{stats['per_second']:7.0f}/s")
+
+    started = time.perf_counter()
+    if crash_at:
+        task = asyncio.create_task(bot.broadcast("news", subscribers(chats), concurrency, checkpoint, progress, 1))
+        while api.count("sendMessage") < crash_at:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        print("crashed, continuing from the checkpoint")
+    stats = await bot.broadcast("news", subscribers(chats), concurrency, checkpoint, progress, 1)
+    elapsed = time.perf_counter() - started
+
+    await bot.stop()
+    await application.shutdown()
+    await api.close()
+
+    delivered = Counter(params["chat_id"] for _, method, params in api.calls if method == "sendMessage")
+    delivered.subtract(params["chat_id"] for method, params in api.refused if method == "sendMessage")
+    delivered = +delivered  # without the refused ones
+    print(f"{chats} chats in {elapsed:.2f} s ({chats / elapsed:.0f}/s with global_rate_limit={rate})")
+    print(f"sent {stats['sent']}, blocked {stats['blocked']}, failed {stats['failed']}, "
+          f"delivered {len(delivered)}, sent twice {sum(1 for count in delivered.values() if count > 1)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=1000, help="global_rate_limit, messages per second")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--blocked-every", type=int, default=50, help="every n-th user has blocked the bot")
+    parser.add_argument("--crash-at", type=int, default=0, help="cancel the broadcast after this many messages")
+    options = parser.parse_args()
+    asyncio.run(run(options.chats, options.rate, options.concurrency, options.blocked_every, options.crash_at))
+
+
+if __name__ == "__main__":
+    main()
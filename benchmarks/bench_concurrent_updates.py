@@ -0,0 +1,103 @@
+"""
+Stress check for concurrent updates.
+
+Many chats talk to the bot at the same time, every handler sleeps a little and
+answers with data of its own user. Every reply must land in the chat that sent
+the message, otherwise the request context leaked between tasks.
+
+    python benchmarks/bench_concurrent_updates.py --chats 1000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+
+
+class FakeTelegram:
+    """Records every outgoing message instead of calling the Bot API"""
+
+    def __init__(self):
+        self.sent = []  # (chat_id, text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def make_update(telegram: FakeTelegram, chat_id: int, text: str):
+    chat = SimpleNamespace(id=chat_id)
+    user = SimpleNamespace(id=chat_id, first_name=f"user{chat_id}", full_name=f"user {chat_id}",
+                           username=f"user{chat_id}")
+
+    async def reply_text(text=None, reply_to_message_id=None, reply_markup=None):
+        telegram.sent.append((chat_id, text))
+
+    message = SimpleNamespace(text=text, message_id=1, chat_id=chat_id, reply_text=reply_text)
+    return SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=user)
+
+
+def make_bot(max_delay: float) -> TelegramBot:
+    bot = TelegramBot(token="benchmark")
+
+    async def whoami():
+        await asyncio.sleep(random.random() * max_delay)
+        bot.send_message(f"chat {bot.get_user_chat_id()}")
+        await asyncio.sleep(random.random() * max_delay)
+        bot.answer_message(f"user {bot.get_user_id()}")
+
+    bot.if_message("whoami", whoami)
+    return bot
+
+
+async def run(chats: int, max_delay: float, concurrent: bool, limits: bool) -> float:
+    telegram = FakeTelegram()
+    bot = make_bot(max_delay)
+    if not limits:
+        # the fake API has no flood control, measure the library only
+        bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    context = SimpleNamespace(bot=telegram)
+    updates = [make_update(telegram, chat_id, "whoami") for chat_id in range(1, chats + 1)]
+
+    started = time.perf_counter()
+    if concurrent:
+        await asyncio.gather(*(bot.handle_message(update, context) for update in updates))
+    else:
+        for update in updates:
+            await bot.handle_message(update, context)
+    await bot.wait_until_sent()
+    elapsed = time.perf_counter() - started
+    await bot.stop()
+
+    leaked = [(chat_id, text) for chat_id, text in telegram.sent
+              if text not in (f"chat {chat_id}", f"user {chat_id}")]
+    if leaked:
+        raise SystemExit(f"cross-chat leakage: {len(leaked)} replies, first: {leaked[:5]}")
+    if len(telegram.sent) != 2 * chats:
+        raise SystemExit(f"expected {2 * chats} replies, got {len(telegram.sent)}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--max-delay", type=float, default=0.01, help="max sleep of a handler, seconds")
+    parser.add_argument("--sequential", action="store_true", help="also measure one-by-one processing")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the default outbound rate limits")
+    options = parser.parse_args()
+
+    elapsed = asyncio.run(run(options.chats, options.max_delay, concurrent=True, limits=options.telegram_limits))
+    print(f"concurrent: {options.chats} chats in {elapsed:.2f}s ({options.chats / elapsed:.0f} updates/s), no leakage")
+
+    if options.sequential:
+        elapsed = asyncio.run(run(options.chats, options.max_delay, concurrent=False, limits=options.telegram_limits))
+        print(f"sequential: {options.chats} chats in {elapsed:.2f}s ({options.chats / elapsed:.0f} updates/s)")
+
+
+if __name__ == "__main__":
+    main()
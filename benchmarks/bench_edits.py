@@ -0,0 +1,102 @@
+"""
+Bursts of clicks on inline buttons.
+
+Every chat clicks a button of its menu --clicks times at once (a user tapping
+quickly). "next" - every click shows a new page, "same" - every click shows
+the menu the message already has (a "Refresh" button). Reported: Bot API
+edits and new messages per click, refused calls ("message is not modified")
+and whether the message of every chat ends on the last state.
+
+    python benchmarks/bench_edits.py --chats 100 --clicks 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi, callback_update  # noqa: E402
+
+
+async def run(scenario: str, chats: int, clicks: int, latency: float, concurrent: int) -> dict:
+    api = FakeBotApi(latency)
+    port = await api.start()
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    pages = defaultdict(int)
+
+    def click():
+        if scenario == "next":
+            pages[bot.get_user_chat_id()] += 1
+        show_menu()
+
+    def close():
+        pass
+
+    def show_menu():
+        bot.add_buttons_inline(f"page {pages[bot.get_user_chat_id()]}", [("Next", click), ("Close", close)])
+
+    show_menu()  # the menu of all chats, its first button is clicked
+
+    application = bot._build_application(concurrent or False)
+    await application.initialize()
+    await bot._post_init(application)
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    await application.start()
+
+    data = bot.buttons[0][1]
+    updates = chats * clicks
+    started = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        # the clicks of a chat come one after another
+        api.push_update(callback_update(update_id, (update_id - 1) // clicks + 1, data))
+    while api.count("answerCallbackQuery") < updates:
+        await asyncio.sleep(0.05)
+    # the last edits of the bursts
+    while bot.get_edit_stats()["pending"]:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(latency + 0.1)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.stop()
+    await api.close()
+
+    final = sum(1 for chat_id in range(1, chats + 1)
+                if (api._shown.get((chat_id, 1)) or (None,))[0] == f"page {pages[chat_id]}")
+    return {
+        "seconds": elapsed,
+        "edits_per_click": api.count("editMessageText") / updates,
+        "messages_per_click": api.count("sendMessage") / updates,
+        "refused": len(api.refused),
+        "final_state": f"{final}/{chats}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--clicks", type=int, default=10, help="clicks of every chat at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake API takes to answer")
+    parser.add_argument("--concurrent", type=int, default=0,
+                        help="concurrent_updates of the application (0 - one by one, as run() by default)")
+    options = parser.parse_args()
+
+    print(f"{options.clicks} clicks at once in each of {options.chats} chats, concurrent_updates={options.concurrent}")
+    print(f"{'':<8}{'seconds':>9}{'edits/click':>13}{'messages/click':>16}{'refused':>9}{'last state':>12}")
+    for scenario in ("next", "same"):
+        result = asyncio.run(run(scenario, options.chats, options.clicks, options.latency, options.concurrent))
+        print(f"{scenario:<8}{result['seconds']:>9.2f}{result['edits_per_click']:>13.2f}"
+              f"{result['messages_per_click']:>16.2f}{result['refused']:>9}{result['final_state']:>12}")
+
+
+if __name__ == "__main__":
+    main()
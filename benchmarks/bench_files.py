@@ -0,0 +1,104 @@
+"""
+Sending one file to many chats with send_document.
+
+The fake Bot API runs in its own process (it keeps the uploaded bodies in
+memory, the bot must not be charged for them). The first run starts with an
+empty file_id index: the file is uploaded once, streamed from disk, and the
+other chats get its file_id. The second run is a new bot with the index of the
+first one, as after a restart: nothing is uploaded.
+
+Reported: time, Bot API calls, uploaded MB and how much the peak RSS of the
+bot grew while sending (a file read into memory would add its size).
+
+    python benchmarks/bench_files.py --size-mb 50 --chats 200
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+def serve(connection):
+    """The fake Bot API: sends its port, answers until asked, then sends its counters"""
+    async def main():
+        api = FakeBotApi()
+        connection.send(await api.start())
+        loop = asyncio.get_running_loop()
+        while not await loop.run_in_executor(None, connection.poll, 0.1):
+            pass
+        connection.recv()
+        connection.send({"calls": sum(1 for _, method, _ in api.calls if method != "getMe"),
+                         "uploaded_bytes": api.uploaded_bytes})
+        await api.close()
+    asyncio.run(main())
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def send_all(port: int, path: str, chats: int, index: str) -> dict:
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    bot.file_id_cache = index
+    application = bot._build_application()
+    await application.initialize()
+    bot._application = application  # sending outside of handlers, as from a scheduled job
+
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*[bot.send_document(path, chat_id=chat_id) for chat_id in range(1, chats + 1)])
+    elapsed = time.perf_counter() - started
+    stats = bot.get_file_stats()
+
+    await application.shutdown()
+    await bot.stop()
+    return {"seconds": elapsed, "rss_growth_mb": peak_rss_mb() - rss_before, **stats}
+
+
+def run(path: str, chats: int, index: str) -> dict:
+    here, there = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(there,), daemon=True)
+    server.start()
+    result = asyncio.run(send_all(here.recv(), path, chats, index))
+    here.send("stop")
+    result.update(here.recv())
+    server.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=100)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.pdf")
+        with open(path, "wb") as file:
+            for _ in range(options.size_mb):
+                file.write(os.urandom(1 << 20))
+        index = os.path.join(directory, "file_ids.json")
+
+        print(f"{options.size_mb} MB to {options.chats} chats")
+        print(f"{'':<10}{'seconds':>9}{'API calls':>11}{'uploaded MB':>13}{'uploads':>9}{'by file_id':>12}"
+              f"{'RSS growth MB':>15}")
+        for name in ("empty", "restart"):
+            result = run(path, options.chats, index)
+            print(f"{name:<10}{result['seconds']:>9.2f}{result['calls']:>11}"
+                  f"{result['uploaded_bytes'] / (1 << 20):>13.1f}{result['uploaded']:>9}{result['reused']:>12}"
+                  f"{result['rss_growth_mb']:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Import and startup cost of the library.
+
+Every sample is a fresh interpreter that imports Library_Fast_Bot (or also
+registers a small bot, as a script does before bot.run()). Reported: the
+cumulative import time of the module from -X importtime, the wall time of the
+whole process, peak RSS and whether telegram got imported. The first run
+writes the bytecode cache, so compile time is not counted.
+
+    python benchmarks/bench_import.py --repeat 20
+    python benchmarks/bench_import.py --path /tmp/old  # another checkout, for comparison
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = "import Library_Fast_Bot"
+
+REGISTER = """
+from Library_Fast_Bot import TelegramBot
+bot = TelegramBot(token="123:benchmark")
+bot.start_bot_btn("Hello get_user_name!", [("Catalog", lambda: None), ("Help", lambda: None)])
+bot.add_buttons_inline("menu", [("Open", lambda: None), ("Close", lambda: None)])
+bot.add_command("/help", "help text")
+bot.add_hint_command("/help", "show help", scope="all_private_chats")
+bot.if_message("price", "100$")
+"""
+
+REPORT = """
+import json, resource, sys
+print(json.dumps({"rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "telegram": "telegram" in sys.modules}))
+"""
+
+
+def sample(path: str, code: str) -> dict:
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code + REPORT],
+                            env=env, cwd=path, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started
+
+    import_us = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "Library_Fast_Bot":
+            import_us = int(parts[1])
+    return dict(json.loads(result.stdout.strip().splitlines()[-1]), import_ms=import_us / 1000, wall_ms=wall * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--path", default=ROOT, help="directory with Library_Fast_Bot.py")
+    options = parser.parse_args()
+
+    print(f"{'':<10}{'import ms':>11}{'process ms':>12}{'peak RSS MB':>13}{'telegram':>10}")
+    for name, code in (("import", IMPORT), ("register", REGISTER)):
+        sample(options.path, code)  # writes __pycache__
+        samples = [sample(options.path, code) for _ in range(options.repeat)]
+        print(f"{name:<10}{statistics.median(s['import_ms'] for s in samples):>11.1f}"
+              f"{statistics.median(s['wall_ms'] for s in samples):>12.1f}"
+              f"{statistics.median(s['rss_mb'] for s in samples):>13.1f}{str(samples[0]['telegram']):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of a click on an inline button that opens another menu.
+
+Every click runs a handler that shows the next menu of a small catalog with
+add_buttons_inline (as menus usually navigate), then a click on a message
+that is a few menus old checks that it still reaches its own handler.
+Prints the cost of one click in microseconds and the number of menus kept.
+
+    python benchmarks/bench_inline_menus.py --clicks 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+
+
+async def _nothing(*args, **kwargs):
+    pass
+
+
+def make_click(chat_id: int, data: str):
+    chat = SimpleNamespace(id=chat_id)
+    user = SimpleNamespace(id=chat_id, first_name="user", full_name="user", username="user")
+    message = SimpleNamespace(message_id=1, chat_id=chat_id, edit_text=_nothing, reply_text=_nothing)
+    query = SimpleNamespace(data=data, message=message, answer=_nothing)
+    return SimpleNamespace(message=None, callback_query=query, effective_chat=chat, effective_user=user)
+
+
+async def run(clicks: int, pages: int):
+    bot = TelegramBot(token="benchmark")
+    context = SimpleNamespace(bot=None)
+    opened = []
+
+    def open_page(page: int):
+        def handler():
+            opened.append(page)
+            bot.add_buttons_inline(f"page {page}", [
+                ("Back", pages_handlers[(page - 1) % pages]),
+                ("Next", pages_handlers[(page + 1) % pages]),
+            ])
+        return handler
+
+    pages_handlers = [open_page(page) for page in range(pages)]
+    bot.start_bot_btn_inline("catalog", [("Open", pages_handlers[0])])
+
+    chat_id = 1
+    data = bot.buttons[0][1]
+    history = []
+    started = time.perf_counter()
+    for _ in range(clicks):
+        await bot.button_click(make_click(chat_id, data), context)
+        with bot._request_scope(make_click(chat_id, data), context):
+            history.append(bot.buttons)
+            data = bot.buttons[1][1]  # "Next" of the menu that was just shown
+        await asyncio.sleep(0)  # the message edit spawned by add_buttons_inline runs
+    elapsed = time.perf_counter() - started
+
+    # "Back" on the message shown three clicks ago opens the page before that one
+    opened.clear()
+    old = history[-3]
+    await bot.button_click(make_click(chat_id, old[0][1]), context)
+    expected = (clicks - 4) % pages
+    print(f"{elapsed / clicks * 1e6:.2f} us per click, {len(bot._inline_menus)} menus kept")
+    print(f"old message: opened page {opened[0]} (expected {expected})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clicks", type=int, default=20000)
+    parser.add_argument("--pages", type=int, default=20)
+    options = parser.parse_args()
+    asyncio.run(run(options.clicks, options.pages))
+
+
+if __name__ == "__main__":
+    main()
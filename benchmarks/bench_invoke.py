@@ -0,0 +1,91 @@
+"""
+Per-update overhead of calling handlers.
+
+Dispatches N updates to empty handlers of every supported shape (zero-arg,
+(update, context), extra arguments, sync and async) through handle_message
+and command handlers, and prints the cost of one update in microseconds.
+
+Run it on two revisions to compare them:
+
+    python benchmarks/bench_invoke.py --updates 50000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+
+
+def make_update(text: str):
+    chat = SimpleNamespace(id=1)
+    user = SimpleNamespace(id=1, first_name="user", full_name="user", username="user")
+    message = SimpleNamespace(text=text, message_id=1, chat_id=1)
+    return SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=user)
+
+
+def no_args():
+    pass
+
+
+async def async_no_args():
+    pass
+
+
+async def async_update_context(update, context):
+    pass
+
+
+def with_args(a, b):
+    pass
+
+
+def make_bot() -> TelegramBot:
+    bot = TelegramBot(token="benchmark")
+    bot.if_message("def ()", no_args)
+    bot.if_message("async def ()", async_no_args)
+    bot.if_message("async def (update, context)", async_update_context)
+    bot.if_message("def (a, b)", with_args, 1, 2)
+    bot.add_buttons("menu", [("button def ()", no_args)])
+    bot.add_command("/command", no_args)
+    return bot
+
+
+async def bench(updates: int) -> dict:
+    bot = make_bot()
+    context = SimpleNamespace(bot=None)
+    result = {}
+
+    cases = [(text, bot.handle_message) for text in
+             ("def ()", "async def ()", "async def (update, context)", "def (a, b)", "button def ()")]
+    cases.append(("/command def ()", bot.commands["/command"]))
+
+    for name, handler in cases:
+        update = make_update(name.replace("/command ", "/command"))
+        best = float("inf")
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(updates):
+                await handler(update, context)
+            best = min(best, time.perf_counter() - started)
+        result[name] = best / updates * 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000, help="updates per measurement")
+    options = parser.parse_args()
+
+    result = asyncio.run(bench(options.updates))
+    print("handler".ljust(32) + "us per update".rjust(14))
+    for name, value in result.items():
+        print(name.ljust(32) + f"{value:14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Overhead of the metrics.
+
+Dispatches N updates through handle_message and a command handler (the same
+handlers as bench_invoke.py) with collect_metrics on and off, and prints the
+cost of one update in microseconds and the difference.
+
+    python benchmarks/bench_metrics.py --updates 50000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_invoke import make_bot, make_update  # noqa: E402
+
+
+async def bench(updates: int) -> dict:
+    bot = make_bot()
+    context = SimpleNamespace(bot=None)
+    result = {}
+
+    cases = [(text, bot.handle_message) for text in ("def ()", "async def ()", "button def ()")]
+    cases.append(("/command", bot.commands["/command"]))
+
+    for text, handler in cases:
+        update = make_update(text)
+        best = {False: float("inf"), True: float("inf")}
+        # off and on take turns, so both see the same noise of the machine
+        for _ in range(7):
+            for collect_metrics in (False, True):
+                bot.collect_metrics = collect_metrics
+                started = time.perf_counter()
+                for _ in range(updates):
+                    await handler(update, context)
+                best[collect_metrics] = min(best[collect_metrics], time.perf_counter() - started)
+        result[text] = (best[False] / updates * 1e6, best[True] / updates * 1e6)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000, help="updates per measurement")
+    options = parser.parse_args()
+
+    result = asyncio.run(bench(options.updates))
+    print("handler".ljust(20) + "off, us".rjust(10) + "on, us".rjust(10) + "overhead, us".rjust(14))
+    for name, (off, on) in result.items():
+        print(name.ljust(20) + f"{off:10.2f}{on:10.2f}{on - off:14.2f}")
+
+if __name__ == "__main__":
+    main()
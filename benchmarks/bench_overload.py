@@ -0,0 +1,142 @@
+"""
+Overload: updates come faster than the bot can handle them.
+
+Handlers take --work-ms (an awaited database call), the application handles
+--concurrent updates at once, so it manages concurrent / work updates per
+second. Updates are pushed at --rate per second for --seconds: one in ten is
+/start, the others are free text, and --flooders chats send far more than the
+others. The run is repeated with a queue that never sheds and with the
+admission limits (max_update_queue, chat_update_rate, update_max_wait).
+
+Reported: handled and shed updates, p50 / p99 latency (pushed -> answered)
+of /start and of text, peak queue depth and peak RSS.
+
+    python benchmarks/bench_overload.py --rate 1000 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi, message_update  # noqa: E402
+
+
+def percentile(values: list, q: int) -> float:
+    if not values:
+        return float("nan")
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+async def run(limits: bool, options) -> dict:
+    api = FakeBotApi()
+    port = await api.start()
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    if limits:
+        bot.max_update_queue = options.queue
+        bot.chat_update_rate = 2
+        bot.chat_update_burst = 5
+        bot.update_max_wait = options.max_wait
+    else:
+        bot.max_update_queue = 10 ** 9
+
+    async def answer():
+        await asyncio.sleep(options.work_ms / 1000)
+        bot.answer_message("ok")
+
+    bot.add_command("/start", answer)  # answers with a reply, like the text, so both can be timed
+    bot.if_message("price", answer)
+
+    pushed = {}  # update_id -> (kind, time)
+    latencies = {"start": [], "text": []}
+
+    def on_call(method, params):
+        if method == "sendMessage":
+            reply_to = params.get("reply_to_message_id") or (params.get("reply_parameters") or {}).get("message_id")
+            kind, started = pushed.pop(reply_to, (None, None))
+            if kind is not None:
+                latencies[kind].append(time.perf_counter() - started)
+
+    application = bot._build_application(options.concurrent)
+    await application.initialize()
+    await bot._post_init(application)
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    await application.start()
+    api.listeners.append(on_call)
+
+    total = int(options.rate * options.seconds)
+    depth = 0
+    started = time.perf_counter()
+    for update_id in range(1, total + 1):
+        # the updates of one tick go at once
+        due = started + update_id / options.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if update_id % options.chats < options.flooders:
+            chat_id = update_id % options.flooders + 1  # a few chats send a lot
+        else:
+            chat_id = update_id % options.chats + 1
+        kind = "start" if update_id % 10 == 0 else "text"
+        pushed[update_id] = (kind, time.perf_counter())
+        api.push_update(message_update(update_id, chat_id, "/start" if kind == "start" else "price"))
+        depth = max(depth, application.update_queue.qsize())
+
+    # everything left in the queue is handled or shed
+    while application.update_queue.qsize() or bot.get_admission_stats()["running"]:
+        await asyncio.sleep(0.05)
+        depth = max(depth, application.update_queue.qsize())
+    await asyncio.sleep(options.work_ms / 1000 + 0.2)
+    stats = bot.get_admission_stats()
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.stop()
+    await api.close()
+    return {
+        "handled": len(latencies["start"]) + len(latencies["text"]),
+        "shed": stats["shed"],
+        "start_p50": percentile(latencies["start"], 50) * 1000,
+        "start_p99": percentile(latencies["start"], 99) * 1000,
+        "text_p50": percentile(latencies["text"], 50) * 1000,
+        "text_p99": percentile(latencies["text"], 99) * 1000,
+        "depth": depth,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=600, help="updates per second")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--work-ms", type=float, default=100)
+    parser.add_argument("--concurrent", type=int, default=32)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--flooders", type=int, default=100,
+                        help="of every --chats updates, so many come from --flooders chats")
+    parser.add_argument("--queue", type=int, default=200, help="max_update_queue with the limits")
+    parser.add_argument("--max-wait", type=float, default=2.0, help="update_max_wait with the limits")
+    options = parser.parse_args()
+
+    capacity = options.concurrent / options.work_ms * 1000
+    print(f"{options.rate:.0f} updates/s for {options.seconds:.0f} s, the bot handles ~{capacity:.0f}/s")
+    print(f"{'':<10}{'handled':>9}{'shed':>7}{'start p50':>11}{'start p99':>11}{'text p50':>10}{'text p99':>10}"
+          f"{'max depth':>11}{'RSS MB':>8}")
+    for name, limits in (("unbounded", False), ("limits", True)):
+        result = asyncio.run(run(limits, options))
+        print(f"{name:<10}{result['handled']:>9}{result['shed']:>7}{result['start_p50']:>11.0f}"
+              f"{result['start_p99']:>11.0f}{result['text_p50']:>10.0f}{result['text_p99']:>10.0f}"
+              f"{result['depth']:>11}{result['rss']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
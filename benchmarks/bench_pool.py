@@ -0,0 +1,91 @@
+"""
+Send throughput for different sizes of the connection pool.
+
+The fake Bot API runs in its own process and answers every call after
+--latency-ms, like the real network. N messages to N chats are queued at once
+outside of handlers (the rate limits are off), so the calls that run at the
+same time are bounded only by connection_pool_size. pool_timeout is None: a
+send waits for a free connection instead of failing.
+
+The last row sends with the largest pool but without keep-alive
+(keepalive_connections=0): every call opens a new connection.
+
+Reported: messages/s, time of the whole batch and failed sends.
+
+    python benchmarks/bench_pool.py --messages 2000 --latency-ms 50 --pools 1 4 16 64 256
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+def serve(connection, latency: float):
+    """The fake Bot API: sends its port and answers until asked to stop"""
+    async def main():
+        api = FakeBotApi(latency)
+        connection.send(await api.start())
+        loop = asyncio.get_running_loop()
+        while not await loop.run_in_executor(None, connection.poll, 0.1):
+            pass
+        await api.close()
+    asyncio.run(main())
+
+
+async def send_all(port: int, messages: int, pool_size: int, keepalive) -> dict:
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    bot.connection_pool_size = pool_size
+    bot.keepalive_connections = keepalive
+    bot.pool_timeout = None
+    application = bot._build_application()
+    await application.initialize()
+    bot._application = application  # sending outside of handlers, as from a scheduled job
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[bot.send_message("hello", chat_id=chat_id)
+                                     for chat_id in range(1, messages + 1)], return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    await application.shutdown()
+    await bot.stop()
+    failed = sum(1 for result in results if isinstance(result, BaseException))
+    return {"messages_per_s": messages / elapsed, "seconds": elapsed, "failed": failed}
+
+
+def run(messages: int, latency: float, pool_size: int, keepalive=None) -> dict:
+    here, there = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(there, latency), daemon=True)
+    server.start()
+    try:
+        return asyncio.run(send_all(here.recv(), messages, pool_size, keepalive))
+    finally:
+        here.send("stop")
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--pools", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    options = parser.parse_args()
+
+    runs = [(f"pool {size}", size, None) for size in options.pools]
+    runs.append((f"pool {max(options.pools)}, no keep-alive", max(options.pools), 0))
+    print(f"{'':<28}{'messages/s':>12}{'seconds':>10}{'failed':>8}")
+    for name, size, keepalive in runs:
+        result = run(options.messages, options.latency_ms / 1000, size, keepalive)
+        print(f"{name:<28}{result['messages_per_s']:>12.0f}{result['seconds']:>10.2f}{result['failed']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Cached answers of an expensive if_message handler.
+
+The handler "reads a price list from a database" (sleeps --query-ms) and
+answers with it. N updates of different chats arrive at once and are handled
+concurrently, with and without cache=. Reported: how many times the handler
+ran, updates/s and the counters of get_cache_stats().
+
+    python benchmarks/bench_response_cache.py --updates 500 --query-ms 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi, message_update  # noqa: E402
+
+
+async def run(updates: int, query_ms: float, cache: bool) -> dict:
+    api = FakeBotApi()
+    port = await api.start()
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    calls = 0
+
+    async def price_list():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(query_ms / 1000)  # the database
+        bot.answer_message("\n".join(f"item {i}: {i * 10}$" for i in range(50)))
+
+    bot.if_message("price", price_list, cache=60 if cache else None)
+
+    done = asyncio.Event()
+    answered = 0
+
+    def on_call(method, params):
+        nonlocal answered
+        if method == "sendMessage":
+            answered += 1
+            if answered == updates:
+                done.set()
+
+    application = bot._build_application(updates)
+    await application.initialize()
+    await bot._post_init(application)
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    await application.start()
+    api.listeners.append(on_call)
+
+    started = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        api.push_update(message_update(update_id, update_id, "price"))
+    await asyncio.wait_for(done.wait(), timeout=600)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.stop()
+    await api.close()
+    stats = bot.get_cache_stats()
+    return {"handler_calls": calls, "updates_per_s": updates / elapsed,
+            "hits": stats["hits"], "misses": stats["misses"], "shared": stats["shared"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--query-ms", type=float, default=50)
+    options = parser.parse_args()
+
+    print(f"{'':<10}{'handler calls':>15}{'updates/s':>12}{'hits':>8}{'misses':>8}{'shared':>8}")
+    for name, cache in (("no cache", False), ("cache", True)):
+        result = asyncio.run(run(options.updates, options.query_ms, cache))
+        print(f"{name:<10}{result['handler_calls']:>15}{result['updates_per_s']:>12.0f}"
+              f"{result['hits']:>8}{result['misses']:>8}{result['shared']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of message routing in handle_message.
+
+Registers N reply-keyboard buttons and N if_message keywords and measures the
+cost of routing one incoming text. The cost must stay flat when N grows; the
+old linear button scan is measured next to it for comparison.
+
+With --patterns it registers N prefix, N contains and N regex rules instead
+and routes a ~100 character message: the cost must depend on the length of
+the message, not on the number of rules.
+
+    python benchmarks/bench_routing.py --sizes 10 100 1000 10000
+    python benchmarks/bench_routing.py --patterns --sizes 100 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+
+
+def make_update(text: str):
+    chat = SimpleNamespace(id=1)
+    user = SimpleNamespace(id=1, first_name="user", full_name="user", username="user")
+    message = SimpleNamespace(text=text, message_id=1, chat_id=1)
+    return SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=user)
+
+
+def make_bot(size: int) -> TelegramBot:
+    bot = TelegramBot(token="benchmark")
+    bot.add_buttons("menu", [(f"Button {i}", lambda: None) for i in range(size)])
+    for i in range(size):
+        bot.if_message(f"Keyword {i}", "reply")
+    return bot
+
+
+def per_call(statement, number: int) -> float:
+    """Best time of one call, in microseconds"""
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e6
+
+
+def bench(size: int, number: int) -> dict:
+    bot = make_bot(size)
+    button = f"button {size - 1}"
+    keyword = f"keyword {size - 1}"
+    keywords = [f"Keyword {i}" for i in range(size)]
+
+    with bot._request_scope(make_update(keyword), None) as request:
+        request.user_text = keyword
+        return {
+            "button": per_call(lambda: bot._match_message(button), number),
+            "keyword": per_call(lambda: bot._match_message(keyword), number),
+            "miss": per_call(lambda: bot._match_message("unknown text"), number),
+            "if_message(list)": per_call(lambda: bot.if_message(keywords), number),
+            "old button scan": per_call(
+                lambda: any(text.lower() == button for text, _ in bot.buttons), max(1, number // size)
+            ),
+        }
+
+
+def bench_patterns(size: int, number: int) -> dict:
+    bot = TelegramBot(token="benchmark")
+    for i in range(size):
+        bot.if_message(f"cmd{i} ", "reply", match="prefix")
+        bot.if_message(f"kw{i}z", "reply", match="contains")
+        bot.if_message(rf"order-{i}-\d+", "reply", match="regex")
+
+    filler = "this message is about one hundred characters long, like most messages "
+    texts = {
+        "prefix": f"cmd{size - 1} {filler}",
+        "contains": f"{filler} kw{size - 1}z",
+        "regex": f"{filler} order-{size - 1}-42",
+        "miss": f"{filler} nothing to see",
+    }
+
+    started = time.perf_counter()
+    bot._match_message("warm up")  # the automatons are compiled on the first message
+    result = {"compile, ms": (time.perf_counter() - started) * 1000}
+    for name, text in texts.items():
+        assert (bot._match_message(text) is None) == (name == "miss"), name
+        result[name] = per_call(lambda text=text: bot._match_message(text), number)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--number", type=int, default=20000, help="calls per measurement")
+    parser.add_argument("--patterns", action="store_true", help="prefix / contains / regex rules")
+    options = parser.parse_args()
+
+    if options.patterns:
+        rows = [(size, bench_patterns(size, max(1, options.number // 10))) for size in options.sizes]
+    else:
+        rows = [(size, bench(size, options.number)) for size in options.sizes]
+    columns = list(rows[0][1])
+    print("us per call".ljust(10) + "".join(column.rjust(18) for column in columns))
+    for size, result in rows:
+        print(str(size).ljust(10) + "".join(f"{result[column]:18.3f}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
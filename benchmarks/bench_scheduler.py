@@ -0,0 +1,136 @@
+"""
+Many pending scheduled messages: schedule_message against a task per timer.
+
+"tasks" is what handlers do without the scheduler: a task that sleeps until
+the message is due (asyncio.sleep), cancelled with task.cancel(). "heap" is
+schedule_message / cancel_scheduled. Every variant runs in its own process,
+so the peak RSS belongs to it alone.
+
+N timers are scheduled an hour ahead, half of them are cancelled. Then
+--due timers are scheduled over the next seconds (--due-rate per second) and
+sent to the fake Bot API.
+Reported: µs per schedule and per cancel, RSS growth and how late the due
+messages reached the API (p50 / p99 from their due time).
+
+    python benchmarks/bench_scheduler.py --timers 200000 --due 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(variant: str, timers: int, due: int, due_rate: float) -> dict:
+    api = FakeBotApi()
+    port = await api.start()
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    application = bot._build_application()
+    await application.initialize()
+    await bot._post_init(application)
+
+    async def later(chat_id: int, text: str, delay: float):
+        await asyncio.sleep(delay)
+        await bot.send_message(text, chat_id)
+
+    def schedule(chat_id: int, text: str, delay: float):
+        if variant == "heap":
+            return bot.schedule_message(chat_id, text, after=delay)
+        return asyncio.create_task(later(chat_id, text, delay))
+
+    def cancel(job):
+        if variant == "heap":
+            bot.cancel_scheduled(job)
+        else:
+            job.cancel()
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    jobs = [schedule(chat_id, "reminder", 3600) for chat_id in range(1, timers + 1)]
+    schedule_us = (time.perf_counter() - started) / timers * 1e6
+    await asyncio.sleep(0)  # the tasks start
+    rss_growth = rss_mb() - rss_before
+
+    started = time.perf_counter()
+    for job in jobs[::2]:
+        cancel(job)
+    cancel_us = (time.perf_counter() - started) / len(jobs[::2]) * 1e6
+    await asyncio.sleep(0)
+
+    # chat_id -> when the message is due
+    due_at = {}
+    lateness = []
+    done = asyncio.Event()
+
+    def on_call(method, params):
+        if method == "sendMessage" and params["chat_id"] in due_at:
+            lateness.append(time.time() - due_at.pop(params["chat_id"]))
+            if len(lateness) == due:
+                done.set()
+
+    api.listeners.append(on_call)
+    for index in range(due):
+        delay = 0.5 + index / due_rate
+        due_at[-(index + 1)] = time.time() + delay
+        schedule(-(index + 1), "due", delay)
+    await asyncio.wait_for(done.wait(), timeout=120)
+
+    for job in jobs[1::2]:
+        cancel(job)
+    await application.shutdown()
+    await bot.stop()
+    await api.close()
+    lateness_ms = sorted(value * 1000 for value in lateness)
+    return {"variant": variant, "schedule_us": schedule_us, "cancel_us": cancel_us, "rss_growth_mb": rss_growth,
+            "late_p50_ms": statistics.median(lateness_ms),
+            "late_p99_ms": lateness_ms[int(len(lateness_ms) * 0.99) - 1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timers", type=int, default=200_000)
+    parser.add_argument("--due", type=int, default=1000)
+    parser.add_argument("--due-rate", type=float, default=100, help="due messages per second")
+    parser.add_argument("--variant", choices=["tasks", "heap"], help="run only this variant")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+    options = parser.parse_args()
+
+    if options.variant:
+        results = [asyncio.run(run(options.variant, options.timers, options.due, options.due_rate))]
+    else:
+        results = []
+        for variant in ("tasks", "heap"):
+            command = [sys.executable, os.path.abspath(__file__), "--variant", variant, "--json",
+                       "--timers", str(options.timers), "--due", str(options.due),
+                       "--due-rate", str(options.due_rate)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if options.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    print(f"{'':<8}{'schedule µs':>13}{'cancel µs':>11}{'RSS growth MB':>15}{'late p50 ms':>13}{'late p99 ms':>13}")
+    for result in results:
+        print(f"{result['variant']:<8}{result['schedule_us']:>13.2f}{result['cancel_us']:>11.2f}"
+              f"{result['rss_growth_mb']:>15.1f}{result['late_p50_ms']:>13.1f}{result['late_p99_ms']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Memory of per-chat sessions.
+
+N chats open their own menu one after another (and a part of them gets a
+message queued for later). The number of sessions in memory must stop at
+max_sessions and the process memory must stay flat however many chats there
+are. With --db the sessions are also written to SQLite in the background.
+
+    python benchmarks/bench_sessions.py --chats 500000 --max-sessions 100000
+    python benchmarks/bench_sessions.py --chats 200000 --db /tmp/sessions.db
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+
+
+def make_update(chat_id: int):
+    chat = SimpleNamespace(id=chat_id)
+    user = SimpleNamespace(id=chat_id, first_name="user", full_name="user", username="user")
+    return SimpleNamespace(message=None, callback_query=None, effective_chat=chat, effective_user=user)
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(chats: int, max_sessions: int, db: str, report_every: int):
+    bot = TelegramBot(token="benchmark")
+    bot.max_sessions = max_sessions
+    bot.session_db = db
+    menus = [[(f"Item {i}", f"Item {i}"), ("Back", "Back")] for i in range(10)]
+
+    started = time.perf_counter()
+    for chat_id in range(1, chats + 1):
+        with bot._request_scope(make_update(chat_id), None):
+            bot.buttons = menus[chat_id % len(menus)]  # a menu of its own
+        if chat_id % 10 == 0:
+            bot.answer_message("see you later", chat_id=chat_id)
+        if chat_id % 100 == 0:
+            await asyncio.sleep(0)  # other updates (and the write-behind task) run in between
+        if chat_id % report_every == 0:
+            stats = bot.get_session_stats()
+            print(f"{chat_id:>9} chats: {stats['sessions']:>7} sessions, ~{stats['memory'] / 2 ** 20:6.1f} MB, "
+                  f"peak RSS {peak_rss_mb():7.1f} MB, {stats['evicted']:>7} evicted, {stats['dirty']:>6} dirty")
+    elapsed = time.perf_counter() - started
+    await bot.stop()
+    print(f"{elapsed / chats * 1e6:.2f} us per menu change")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=300_000)
+    parser.add_argument("--max-sessions", type=int, default=100_000)
+    parser.add_argument("--db", default=None, help="SQLite file for the write-behind backend")
+    parser.add_argument("--report-every", type=int, default=50_000)
+    options = parser.parse_args()
+    asyncio.run(run(options.chats, options.max_sessions, options.db, options.report_every))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Offline benchmark of the whole bot against a fake Bot API.
+
+The bot runs with long polling (the same application as run()) against
+fake_bot_api.FakeBotApi, which hands out scripted updates through getUpdates
+and answers every call locally. Every workload runs in its own process, so
+the peak RSS belongs to it alone.
+
+Workloads: start (/start with a reply keyboard), text (if_message), button
+(a reply-keyboard button), inline (button_click of an inline button) and
+command (add_command).
+
+Reported: updates/s, p50 / p99 latency from the moment the update is queued
+in getUpdates to the reply reaching the API, Bot API calls per update
+(getUpdates not counted) and peak RSS. All updates are queued at once, so the
+latency includes the time they wait for their turn.
+
+    python benchmarks/bench_suite.py --updates 5000 --chats 1000
+    python benchmarks/bench_suite.py --workload inline --concurrent 256 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi, callback_update, message_update  # noqa: E402
+
+REPLIES = ("sendMessage", "editMessageText")
+
+
+def setup_start(bot: TelegramBot):
+    bot.start_bot_btn("Hello get_user_name!", [("Catalog", lambda: None), ("Help", lambda: None)])
+
+
+def setup_text(bot: TelegramBot):
+    bot.if_message("price", "100$")
+
+
+def setup_button(bot: TelegramBot):
+    bot.add_buttons("menu", [("Catalog", lambda: bot.answer_message("catalog")), ("Help", lambda: None)])
+
+
+def setup_inline(bot: TelegramBot):
+    bot.start_bot_btn_inline("menu", [("Open", lambda: bot.send_message("opened")), ("Close", lambda: None)])
+
+
+def setup_command(bot: TelegramBot):
+    bot.add_command("/help", "help text")
+    bot.add_hint_command("/help", "show help")
+
+
+WORKLOADS = {
+    "start": (setup_start, lambda bot, update_id, chat_id: message_update(update_id, chat_id, "/start")),
+    "text": (setup_text, lambda bot, update_id, chat_id: message_update(update_id, chat_id, "price")),
+    "button": (setup_button, lambda bot, update_id, chat_id: message_update(update_id, chat_id, "Catalog")),
+    # callback_data of the first button of the menu that every chat has
+    "inline": (setup_inline, lambda bot, update_id, chat_id: callback_update(update_id, chat_id, bot.buttons[0][1])),
+    "command": (setup_command, lambda bot, update_id, chat_id: message_update(update_id, chat_id, "/help")),
+}
+
+
+def percentile(values: list, q: int) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+async def run_workload(name: str, updates: int, chats: int, concurrent: int, limits: bool) -> dict:
+    setup, make_update = WORKLOADS[name]
+    api = FakeBotApi()
+    port = await api.start()
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    if not limits:
+        # the fake API has no flood control, measure the library only
+        bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    setup(bot)
+
+    waiting = defaultdict(deque)  # chat_id -> times the updates of the chat were pushed
+    latencies = []
+    done = asyncio.Event()
+
+    def on_call(method, params):
+        if method in REPLIES and waiting[params["chat_id"]]:
+            latencies.append(time.perf_counter() - waiting[params["chat_id"]].popleft())
+            if len(latencies) == updates:
+                done.set()
+
+    # the same application as run(), started the way run_polling starts it
+    application = bot._build_application(concurrent or False)
+    await application.initialize()
+    await bot._post_init(application)
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    await application.start()
+    calls_before = len(api.calls)
+    api.listeners.append(on_call)
+
+    started = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        chat_id = (update_id - 1) % chats + 1
+        waiting[chat_id].append(time.perf_counter())
+        api.push_update(make_update(bot, update_id, chat_id))
+    await asyncio.wait_for(done.wait(), timeout=600)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.stop()
+    await api.close()
+
+    methods = Counter(method for _, method, _ in api.calls[calls_before:] if method != "getUpdates")
+    return {
+        "workload": name,
+        "updates": updates,
+        "updates_per_s": updates / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "api_calls_per_update": sum(methods.values()) / updates,
+        "api_calls": dict(methods),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=list(WORKLOADS), action="append",
+                        help="run only this workload (can be repeated)")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=1000, help="updates are spread over this many chats")
+    parser.add_argument("--concurrent", type=int, default=0,
+                        help="concurrent_updates of the application (0 - one by one, as run() by default)")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the default outbound rate limits")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+    options = parser.parse_args()
+
+    workloads = options.workload or list(WORKLOADS)
+    if len(workloads) == 1:
+        results = [asyncio.run(run_workload(workloads[0], options.updates, options.chats,
+                                            options.concurrent, options.telegram_limits))]
+    else:
+        # one process per workload, so every peak RSS is its own
+        results = []
+        for name in workloads:
+            command = [sys.executable, os.path.abspath(__file__), "--workload", name, "--json",
+                       "--updates", str(options.updates), "--chats", str(options.chats),
+                       "--concurrent", str(options.concurrent)]
+            if options.telegram_limits:
+                command.append("--telegram-limits")
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if options.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    print(f"{'workload':<10}{'updates/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'API calls/upd':>15}{'peak RSS MB':>13}")
+    for result in results:
+        print(f"{result['workload']:<10}{result['updates_per_s']:>12.0f}{result['p50_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{result['api_calls_per_update']:>15.2f}{result['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Local harness for run_webhook: POSTs synthetic updates to the built-in webhook
+receiver, while the bot replies to a fake Bot API (no real Telegram involved).
+
+Reports webhook throughput, the latency of the HTTP answer and the end-to-end
+latency from the POST until the reply reaches the Bot API.
+
+    python benchmarks/bench_webhook.py --updates 5000 --clients 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import TelegramBot  # noqa: E402
+from fake_bot_api import FakeBotApi, message_update  # noqa: E402
+
+SECRET = "benchmark-secret"
+
+
+async def post(reader, writer, port: int, body: bytes, secret: str = SECRET) -> int:
+    writer.write(
+        f"POST /webhook HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: application/json\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    await reader.readexactly(length)
+    return status
+
+
+def percentile(values: list, q: float) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+async def run(updates: int, clients: int, concurrent_updates: int):
+    api = FakeBotApi()
+    api_port = await api.start()
+
+    bot = TelegramBot(token="123:benchmark")
+    bot.base_url = f"http://127.0.0.1:{api_port}/bot"
+    bot.global_rate_limit = bot.chat_rate_limit = bot.group_rate_limit = None
+    bot.if_message("ping", "pong")
+
+    posted = {}  # chat_id -> time of the POST
+    delivered = {}  # chat_id -> time the reply reached the Bot API
+    done = asyncio.Event()
+
+    def on_call(method, params):
+        if method == "sendMessage":
+            delivered[params["chat_id"]] = time.perf_counter()
+            if len(delivered) == updates:
+                done.set()
+
+    api.listeners.append(on_call)
+
+    application = bot._build_application(concurrent_updates)
+    started = asyncio.get_running_loop().create_future()
+    server = asyncio.create_task(
+        bot._serve_webhook(application, None, "127.0.0.1", 0, "/webhook", SECRET, clients, started)
+    )
+    port = await started
+
+    # the secret token is checked
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    assert await post(reader, writer, port, b"{}", secret="wrong") == 403
+    writer.close()
+
+    acks = []
+    queue = asyncio.Queue()
+    for chat_id in range(1, updates + 1):
+        queue.put_nowait(chat_id)
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while not queue.empty():
+            chat_id = queue.get_nowait()
+            body = json.dumps(message_update(chat_id, chat_id, "ping")).encode()
+            posted[chat_id] = sent = time.perf_counter()
+            assert await post(reader, writer, port, body) == 200
+            acks.append(time.perf_counter() - sent)
+        writer.close()
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    await asyncio.wait_for(done.wait(), timeout=60)
+    elapsed = time.perf_counter() - begin
+
+    server.cancel()
+    await asyncio.gather(server, return_exceptions=True)
+    await api.close()
+
+    end_to_end = [delivered[chat_id] - posted[chat_id] for chat_id in posted]
+    print(f"{updates} updates, {clients} clients: {updates / elapsed:.0f} updates/s")
+    print(f"HTTP answer: p50 {percentile(acks, 50) * 1000:.2f} ms, p99 {percentile(acks, 99) * 1000:.2f} ms")
+    print(f"end-to-end:  p50 {percentile(end_to_end, 50) * 1000:.2f} ms, "
+          f"p99 {percentile(end_to_end, 99) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=20, help="parallel connections (Telegram max_connections)")
+    parser.add_argument("--concurrent-updates", type=int, default=256)
+    options = parser.parse_args()
+    asyncio.run(run(options.updates, options.clients, options.concurrent_updates))
+
+
+if __name__ == "__main__":
+    main()
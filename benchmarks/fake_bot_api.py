@@ -0,0 +1,238 @@
+"""
+Local fake of the Telegram Bot API for benchmarks.
+
+Answers the methods the library uses with plausible results and records every
+call, so the bot can run against it with TelegramBot.base_url:
+
+    api = FakeBotApi()
+    port = await api.start()
+    bot.base_url = f"http://127.0.0.1:{port}/bot"
+    api.push_update(message_update(1, 1, "/start"))  # returned by getUpdates
+"""
+import asyncio
+import email.parser
+import json
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Library_Fast_Bot import _HttpServer  # noqa: E402
+
+
+class FakeBotApi:
+    """Bot API stand-in: every call is recorded as (time, method, params)"""
+
+    def __init__(self, latency: float = 0.0, max_body: int = 64 << 20):
+        self.latency = latency  # seconds added to every answer, like a real network
+        self.calls = []
+        self.listeners = []  # callables (method, params) called for every request
+        self._message_id = 0
+        self._updates = deque()  # for getUpdates
+        self._new_updates = asyncio.Event()
+        self.pushed = {}  # update_id -> time it was pushed
+        self.blocked_chats = set()  # sendMessage to them fails with 403, as for a user who blocked the bot
+        self._flood_wait = 0  # the next call fails with 429 and this retry_after
+        self.refused = []  # (method, params) of the calls that got an error
+        self.uploaded_bytes = 0  # size of the uploaded files
+        self._file_id = 0
+        self._shown = {}  # (chat_id, message_id) -> (text, reply_markup) of edited messages
+        self._server = _HttpServer(self._handle, max_connections=1000, max_body=max_body)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        await self._server.start(host, port)
+        return self._server.port
+
+    async def close(self):
+        self._new_updates.set()  # pending long polls answer at once
+        await self._server.close()
+
+    def count(self, method: str) -> int:
+        return sum(1 for _, name, _ in self.calls if name == method)
+
+    def push_update(self, update: dict):
+        """Queue an update for getUpdates"""
+        self.pushed[update["update_id"]] = time.perf_counter()
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def flood_wait(self, seconds: int):
+        """The next call is refused with 429 Too Many Requests"""
+        self._flood_wait = seconds
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters):
+        answer = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            answer["parameters"] = parameters
+        return code, json.dumps(answer).encode(), "application/json"
+
+    async def _handle(self, method: str, path: str, headers: dict, body: bytes):
+        # /bot<token>/<method>
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._parse(headers, body)
+        self.calls.append((time.perf_counter(), api_method, params))
+        for listener in self.listeners:
+            listener(api_method, params)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._flood_wait and api_method != "getUpdates":
+            seconds, self._flood_wait = self._flood_wait, 0
+            self.refused.append((api_method, params))
+            return self._error(429, f"Too Many Requests: retry after {seconds}", retry_after=seconds)
+        if api_method == "sendMessage" and params.get("chat_id") in self.blocked_chats:
+            self.refused.append((api_method, params))
+            return self._error(403, "Forbidden: bot was blocked by the user")
+
+        answer = getattr(self, f"api_{api_method}", None)
+        if answer is None:
+            result = True
+        else:
+            result = answer(params)
+            if asyncio.iscoroutine(result):
+                result = await result
+            if isinstance(result, tuple):
+                self.refused.append((api_method, params))
+                return result  # an error of _error()
+        return 200, json.dumps({"ok": True, "result": result}).encode(), "application/json"
+
+    def _parse(self, headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            return self._parse_multipart(content_type, body)
+
+        params = {}
+        for name, value in parse_qsl(body.decode()):
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        return params
+
+    def _parse_multipart(self, content_type: str, body: bytes) -> dict:
+        """Form fields as params, files as {"file": name, "size": bytes}"""
+        form = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params = {"multipart": True}
+        for part in form.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            content = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                self.uploaded_bytes += len(content)
+                params[name] = {"file": part.get_filename(), "size": len(content)}
+            else:
+                try:
+                    params[name] = json.loads(content)
+                except ValueError:
+                    params[name] = content.decode()
+        return params
+
+    def _new_file_id(self, kind: str) -> dict:
+        self._file_id += 1
+        return {"file_id": f"{kind}{self._file_id}", "file_unique_id": f"u{self._file_id}", "file_size": 1}
+
+    def _file_message(self, params: dict, kind: str, media) -> dict:
+        # a string is a file_id (or URL) sent again, anything else was uploaded
+        file = {"file_id": media, "file_unique_id": media, "file_size": 1} if isinstance(media, str) \
+            else self._new_file_id(kind)
+        message = self._message(params)
+        if kind == "photo":
+            message["photo"] = [{**file, "width": 800, "height": 600}]
+        else:
+            message["document"] = file
+        return message
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = params.get("chat_id", 1)
+        return {
+            "message_id": params.get("message_id", self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "channel" if isinstance(chat_id, str) else "private" if int(chat_id) > 0 else "group", "title": "chat"},
+            "text": params.get("text", ""),
+        }
+
+    def api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def api_sendMessage(self, params):
+        return self._message(params)
+
+    def api_editMessageText(self, params):
+        key = (params.get("chat_id"), params.get("message_id"))
+        shown = (params.get("text"), params.get("reply_markup"))
+        if self._shown.get(key) == shown:
+            return self._error(400, "Bad Request: message is not modified: specified new message content and reply "
+                                    "markup are exactly the same as a current content and reply markup of the message")
+        self._shown[key] = shown
+        return self._message(params)
+
+    def api_sendPhoto(self, params):
+        return self._file_message(params, "photo", params.get("photo"))
+
+    def api_sendDocument(self, params):
+        return self._file_message(params, "document", params.get("document"))
+
+    def api_sendMediaGroup(self, params):
+        messages = []
+        for item in params["media"]:
+            media = item["media"]
+            # attach://<name> - uploaded in the same request
+            uploaded = isinstance(media, str) and media.startswith("attach://")
+            messages.append(self._file_message(params, item["type"], None if uploaded else media))
+        return messages
+
+    async def api_getUpdates(self, params):
+        # long polling: confirmed updates (below offset) are dropped, the rest is returned or awaited
+        offset = int(params.get("offset") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and params.get("timeout") and self._server._server.is_serving():
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return list(islice(self._updates, int(params.get("limit") or 100)))
+
+    def api_getWebhookInfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Update with a text message from a private chat (user id = chat id)"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}", "username": f"user{chat_id}"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, chat_id: int, data: str, message_id: int = 1) -> dict:
+    """Update with a click on an inline button"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}", "username": f"user{chat_id}"}
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+        "from": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"},
+        "text": "menu",
+    }
+    return {
+        "update_id": update_id,
+        "callback_query": {"id": str(update_id), "from": user, "chat_instance": str(chat_id),
+                           "message": message, "data": data},
+    }